@@ -20,12 +20,53 @@ import logging
 import argparse
 import os.path
 import time
+import concurrent.futures
+import threading
 from pprint import pprint
+from collections import OrderedDict, deque
+from bisect import bisect_left
 from os import path
 from decimal import Decimal
 import random
+import re
+import mmap
+import cProfile
+import pstats
+import tracemalloc
+import io
+import zlib
+import struct
+from array import array
+import hashlib
+import gzip
+import base64
+import heapq
+import itertools
+import tempfile
+import csv
+import calendar
+import stat
+
+# numpy is optional, only the report/query subcommand uses it and falls back to
+# plain python without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 tmp_file = "doge.tmp"
+chunk_folder = "doge.chunks"
+queue_file = "doge.queue"
+trace_file = "doge.trace"
+snapshot_file = "doge.snap"
+schedule_file = "doge.schedule"
+txcache_file = "doge.txcache"
+profile_folder = "doge.profiles"
+profile_dir = "doge.prof"
+archive_file = "doge.archive"
+details_file = "doge.details"
+notify_file = "doge.notify"
+printer_file = "doge.printer"
 running_folder = os.path.dirname(os.path.abspath(__file__))
 
 IEFBR14 = '''//DOGEBR14 JOB CLASS=C,MSGCLASS=Z,MSGLEVEL=(1,1),
@@ -75,89 +116,513 @@ IDCAMS = '''//DOGEVSM JOB (BAL),
      LISTCAT ALL ENTRY({vsam_file})                                
 /*'''
 
+# Extra step that builds the DOGETRAN page directory, page number to first key on the page
+PAGES_STEP = '''//DOGEPAGE EXEC PGM=IDCAMS
+//SYSPRINT DD   SYSOUT=*
+//INDATA1  DD *
+{pages}
+/*
+//SYSIN    DD *
+ DELETE {vsam_file}.PAGES CLUSTER PURGE
+ IF LASTCC = 8 THEN
+   DO
+       SET LASTCC = 0
+       SET MAXCC = 0
+   END
+ /* DOGETRAN PAGE DIRECTORY */
+ DEFINE CLUSTER (                    -
+        NAME( {vsam_file}.PAGES )    -
+        VOLUME( {volume} )           -
+        INDEXED                      -
+        KEYS( 10,0 )                 -
+        RECORDSIZE ( 80,80 )         -
+        RECORDS( 1100 )              -
+        UNIQUE                       -
+        ) -
+        DATA ( NAME({vsam_file}.PAGES.DATA)) -
+        INDEX ( NAME({vsam_file}.PAGES.INDEX))
+ IF LASTCC=0 THEN                    -
+     REPRO INFILE(INDATA1)           -
+     OUTDATASET({vsam_file}.PAGES)
+/*'''
+
+# Extra step that builds an alternate index and path on the wallet address (columns 12-45)
+AIX_STEP = '''//DOGEAIX  EXEC PGM=IDCAMS
+//SYSPRINT DD   SYSOUT=*
+//SYSIN    DD *
+ /* ALTERNATE INDEX ON THE WALLET ADDRESS */
+ DEFINE ALTERNATEINDEX (             -
+        NAME( {vsam_file}.AIX )      -
+        RELATE( {vsam_file} )        -
+        VOLUME( {volume} )           -
+        KEYS( 34,11 )                -
+        RECORDSIZE ( {average},{maximum} ) -
+        RECORDS( {records} )         -
+        NONUNIQUEKEY                 -
+        UPGRADE                      -
+        ) -
+        DATA ( NAME({vsam_file}.AIX.DATA)) -
+        INDEX ( NAME({vsam_file}.AIX.INDEX))
+ IF LASTCC=0 THEN                    -
+     DEFINE PATH (                   -
+        NAME( {vsam_file}.PATH )     -
+        PATHENTRY( {vsam_file}.AIX ) -
+        )
+ IF LASTCC=0 THEN                    -
+     BLDINDEX INDATASET({vsam_file}) -
+        OUTDATASET({vsam_file}.AIX)
+ IF LASTCC=0 THEN                    -
+     LISTCAT ALL ENTRY({vsam_file}.AIX)
+/*'''
+
+# Runs after the DOGEVSM job(s) in front of it (JES2 holds duplicate job names)
+# and prints a completion marker to the class D printer for the submission queue
+DONE_JCL = '''//DOGEVSM JOB (BAL),
+//             'DOGEBANK DONE',
+//             CLASS=A,
+//             MSGCLASS=Z,
+//             MSGLEVEL=(1,1),
+//             USER={user},PASSWORD={password}
+//DOGEDONE EXEC PGM=IEBGENER
+//SYSPRINT DD   DUMMY
+//SYSIN    DD   DUMMY
+//SYSUT2   DD   SYSOUT=D
+//SYSUT1   DD *
+DOGEVSAM99 {token}
+/*'''
+
+IDCAMS_REPRO = '''//DOGEVSM JOB (BAL),
+//             'VSAM {sequence:03d}/{total:03d}',
+//             CLASS=A,
+//             MSGCLASS=Z,
+//             TIME=1440,
+//             MSGLEVEL=(1,1),
+//*             NOTIFY={user},
+//             USER={user},PASSWORD={password}
+//{step} EXEC PGM=IDCAMS
+//SYSPRINT DD   SYSOUT=*
+//INDATA1  DD *
+{records}
+/*
+//SYSIN    DD *
+ /* ADD THE NEXT CHUNK, REPLACE MAKES RESUBMITTING A CHUNK SAFE */
+ REPRO INFILE(INDATA1)               -
+     OUTDATASET({vsam_file})         -
+     REPLACE
+ IF LASTCC=0 THEN                    -
+     LISTCAT ALL ENTRY({vsam_file})
+/*'''
+
+
+RECORD_FORMAT = "{:010d} {:<034} {:<10.10} {:+018.8f}"
+FORMAT_CHUNK_SIZE = 50000
+# Bytes of card images ExternalSorter holds before spilling a sorted run
+SORT_BUDGET = 64 * 1024 * 1024
+
+def format_record_chunk(rows):
+    ''' Formats a chunk of (key, address, label, amount) rows as newline
+        separated card image bytes. Lives at module level so it can be
+        handed to a worker process. '''
+    return "\n".join([RECORD_FORMAT.format(*row) for row in rows]).encode('ascii', 'replace')
+
+def format_records(rows, workers=None, chunk_size=FORMAT_CHUNK_SIZE):
+    ''' Formats (key, address, label, amount) rows in to VSAM records
+
+        The rows are sorted by key once and split in to key ordered chunks.
+        Each chunk is formatted and encoded in its own worker process and the
+        results are joined back in chunk order, so the output never needs to
+        be sorted again. Inputs that fit in one chunk, or workers=1, are
+        formatted in this process since starting a pool costs more than it
+        saves. Returns the card images as bytes, one record per line. '''
+    rows = sorted(rows, key=lambda row: row[0])
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+
+    if workers <= 1:
+        return b"\n".join([format_record_chunk(chunk) for chunk in chunks])
+
+    logger.debug("Formatting %s records in %s chunks with %s workers", len(rows), len(chunks), workers)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return b"\n".join(pool.map(format_record_chunk, chunks))
+
+def card_key(card):
+    return card[:10]
+
+class ExternalSorter(object):
+    ''' Sorts more VSAM cards than fit in memory
+
+        Cards are held until they take up about budget bytes, then sorted by
+        key and spilled to a temporary run file (in folder, or the system temp
+        folder). merged() k-way merges the runs and whatever is still held with
+        heapq.merge, so only one card per run is in memory at a time. Duplicate
+        keys are dropped during the merge (the card added first wins) and with
+        a limit the cards are windowed as they go past, the same way
+        window_records would. Use it in a with block, or close() it, so the
+        runs are removed. '''
 
-def generate_fake_records(number_of_records=100):
-    ''' Generates fake records JCL '''
+    def __init__(self, budget=SORT_BUDGET, folder=None):
+        self.budget = budget
+        self.folder = folder
+        self.cards = []
+        self.held = 0
+        self.runs = []
+        self.count = 0
+        self.duplicates = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, card):
+        self.cards.append(card)
+        self.held += sys.getsizeof(card) + 8
+        self.count += 1
+        if self.held >= self.budget:
+            self.spill()
+
+    def extend(self, cards):
+        for card in cards:
+            self.add(card)
+
+    def spill(self):
+        ''' Writes the cards held so far to a new sorted run '''
+        if not self.cards:
+            return
+        self.cards.sort(key=card_key)
+        with tempfile.NamedTemporaryFile('w', prefix='doge.run.', dir=self.folder, delete=False) as f:
+            f.write('\n'.join(self.cards) + '\n')
+        self.runs.append(f.name)
+        logger.debug("Spilled run %s, %s cards to %s", len(self.runs), len(self.cards), f.name)
+        self.cards = []
+        self.held = 0
+
+    @staticmethod
+    def read_run(filename):
+        with open(filename, 'r') as f:
+            for line in f:
+                yield line.rstrip('\n')
+
+    def unique(self, cards):
+        last = None
+        for card in cards:
+            key = card[:10]
+            if key == last:
+                self.duplicates += 1
+                continue
+            last = key
+            yield card
+
+    @staticmethod
+    def window(cards, limit=7648, reverse=True):
+        ''' window_records for a key ordered stream of cards '''
+        cards = iter(cards)
+        if reverse:
+            # The two balance records and the last limit-2 after them
+            head = list(itertools.islice(cards, 2))
+            return head + list(deque(cards, maxlen=limit - 2))
+        head = list(itertools.islice(cards, limit - 1))
+        control = deque(cards, maxlen=1)
+        return head + list(control)
+
+    def merged(self, limit=None, reverse=True):
+        ''' Returns the sorted, deduplicated and (with a limit) windowed cards,
+            as an iterator without a limit and a list with one '''
+        self.cards.sort(key=card_key)
+        streams = [self.read_run(run) for run in self.runs] + [iter(self.cards)]
+        logger.debug("Merging %s cards from %s run(s)", self.count, len(streams))
+        cards = self.unique(heapq.merge(*streams, key=card_key))
+        if limit is None:
+            return cards
+        return self.window(cards, limit, reverse)
+
+    def close(self):
+        for run in self.runs:
+            try:
+                os.remove(run)
+            except OSError:
+                pass
+        self.runs = []
+        self.cards = []
+
+def generate_fake_records(number_of_records=100, workers=None, budget=None, limit=None, reverse=True):
+    ''' Generates fake records JCL
+
+        With a budget (bytes) the records are made and formatted a chunk at a
+        time and sorted with an ExternalSorter instead of in memory. The keys
+        are then random rather than sampled so the odd duplicate is dropped
+        in the merge. With a limit the records are windowed like
+        window_records(records, reverse, limit). '''
     fake_labels = ['CIBC', 'DOGE Bank LLC', 'SUCH FUNDS', 'WOW MONEY','Fake','Banco do Brazil','Kraken','MTGOX']
-    logger.debug("Generating {} fake records.".format(number_of_records))
-    record = "{key:010d} {address:<034} {label:<10.10} {amount:+018.8f}"
-    records = []
-    records.append(record.format(key=1,address=0,label="Available", amount=+87654321.12345678))
-    records.append(record.format(key=2,address=0,label="Pending", amount=-123456.654321))
+    logger.debug("Generating %s fake records.", number_of_records)
+    now = int(time.time())
+    rows = []
+    rows.append((1, 0, "Available", +87654321.12345678))
+    rows.append((2, 0, "Pending", -123456.654321))
+    rows.append((9999999999, '0', 'Control Record', 0))
+
+    if budget:
+        with ExternalSorter(budget) as sorter:
+            sorter.extend(format_record_chunk(rows).decode('ascii').split("\n"))
+            remaining = max(int(number_of_records) - 1, 0)
+            while remaining:
+                rows = [(random.randint(1000000000, now), "nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu", fake_labels[random.randint(0,7)], random.uniform(-10000000,10000000))
+                        for _ in range(min(remaining, FORMAT_CHUNK_SIZE))]
+                remaining -= len(rows)
+                sorter.extend(format_record_chunk(rows).decode('ascii').split("\n"))
+            return list(sorter.merged(limit=limit, reverse=reverse))
 
-    for i in range(1,int(number_of_records)):
-        records.append(record.format(key=random.randint(1000000000,int(time.time())),address="nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu",label=fake_labels[random.randint(0,7)], amount=random.uniform(-10000000,10000000)))
+    # Unique keys, a duplicate would (rightly) fail validate_records
+    for key in random.sample(range(1000000000, now + 1), max(int(number_of_records) - 1, 0)):
+        rows.append((key, "nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu", fake_labels[random.randint(0,7)], random.uniform(-10000000,10000000)))
 
-    records.append(record.format(key=9999999999,address='0',amount=0,label='Control Record'))
-    records.sort()
+    records = format_records(rows, workers=workers).decode('ascii').split("\n")
+    if limit:
+        records = window_records(records, reverse=reverse, limit=limit)
     return records
 
 
 
-def get_records(host='localhost', rpcUser=None, rpcPass=None, rpcPort=22555):
-    ''' Gets DOGECOIN records from dogecoin RPC server '''
-    
+class DogeError(Exception):
+    ''' Base class of the errors raised instead of exiting, see DogeSync '''
+
+class RPCError(DogeError):
+    ''' dogecoind couldn't be reached, refused the logon or failed a call '''
 
+class ReaderError(DogeError):
+    ''' The VSAM job didn't reach every tk4- reader '''
+
+class PrinterError(DogeError):
+    ''' The tk4- class D printer couldn't be read '''
+
+class RecordError(DogeError):
+    ''' The VSAM deck failed validate_records, problems has what's wrong '''
+    def __init__(self, message, problems=None):
+        super(RecordError, self).__init__(message)
+        self.problems = problems or []
+
+class CICSCondition(DogeError):
+    ''' An emulated KSDS request raised NOTFND, ENDFILE or INVREQ, see KSDS '''
+    def __init__(self, condition, key=None):
+        super(CICSCondition, self).__init__("{} {}".format(condition, key) if key else condition)
+        self.condition = condition
+
+RPC_HEADERS = {'content-type': 'application/json'}
+
+def rpc_server(host='localhost', rpcUser=None, rpcPass=None, rpcPort=22555):
+    ''' Returns the dogecoind URL and the same URL with the password masked
+
+        rpcUser and rpcPass default to rpcuser and rpcpassword from
+        ~/.dogecoin/dogecoin.conf. '''
     try:
         with open(path.join(path.expanduser("~"), '.dogecoin', 'dogecoin.conf'), mode='r') as f:
             config_string = '[dogecoin]\n' + f.read()
     except:
-        config_string = None
+        config_string = '[dogecoin]\n'
     
     config = configparser.ConfigParser()
     config.read_string(config_string)
 
-    if not rpcUser and 'rpcuser' in config['dogecoin']:
+    if not rpcUser and config.has_option('dogecoin', 'rpcuser'):
         rpcUser = config['dogecoin']['rpcuser']
             
-    if not rpcPass and 'rpcpassword' in config['dogecoin']:
+    if not rpcPass and config.has_option('dogecoin', 'rpcpassword'):
         rpcPass = config['dogecoin']['rpcpassword']
     
     if rpcUser is None or rpcPass is None:
-        logger.critical("rpcuser or rpcPass not in .dogecoin/dogecoin.conf and not passed to function")
-        sys.exit(-1)
+        raise RPCError("rpcuser or rpcPass not in .dogecoin/dogecoin.conf and not passed to function")
 
     serverURL = 'http://{user}:{passw}@{host}:{port}'.format(user=rpcUser,passw=rpcPass,host=host,port=rpcPort)
     serverPrint = 'http://{user}:{passw}@{host}:{port}'.format(user=rpcUser,passw=('*' * len(rpcPass)),host=host,port=rpcPort)
+    return serverURL, serverPrint
 
-    logger.debug("Connecting to {}".format(serverPrint))
-    
-    headers = {'content-type': 'application/json'}
+class RPCTimeout(RPCError):
+    ''' The run deadline passed before dogecoind answered '''
+
+# dogecoind is starting up or rescanning, worth asking again
+RPC_IN_WARMUP = -28
+
+class RPCPolicy(object):
+    ''' Deadlines, retries and hedging for the dogecoind calls of one run
+
+        Every call gets at most call_timeout seconds and none starts (or waits
+        longer than what's left) once run_deadline seconds have passed since
+        the policy was made. Reads that time out, can't connect or find the
+        wallet warming up are retried at most retries times each, and
+        retry_budget times in all, after a random (full jitter) back off of up
+        to backoff * 2^attempt seconds. With hedge_after a read that hasn't
+        answered in that many seconds is sent again on a second connection and
+        the first reply wins. Sends never go through a policy, see send_doge. '''
+
+    def __init__(self, call_timeout=10, run_deadline=None, retries=2, retry_budget=4, backoff=0.5, hedge_after=None, clock=time.time, sleep=time.sleep):
+        self.call_timeout = call_timeout
+        self.retries = retries
+        self.retry_budget = retry_budget
+        self.backoff = backoff
+        self.hedge_after = hedge_after
+        self.clock = clock
+        self.sleep = sleep
+        self.deadline = clock() + run_deadline if run_deadline else None
+        self.retried = 0
+
+    def remaining(self):
+        ''' Seconds left before the run deadline, None without one '''
+        if self.deadline is None:
+            return None
+        return self.deadline - self.clock()
+
+    def timeout(self, method):
+        ''' The timeout for the next method call, RPCTimeout if there's no time left '''
+        remaining = self.remaining()
+        if remaining is None:
+            return self.call_timeout
+        if remaining <= 0:
+            raise RPCTimeout("Run deadline passed before {}".format(method))
+        return min(self.call_timeout, remaining)
+
+    def retry(self, attempt):
+        ''' Seconds to wait before retrying a read that failed attempt+1 times,
+            None if it can't be retried '''
+        if attempt >= self.retries or self.retried >= self.retry_budget:
+            return None
+        delay = random.uniform(0, self.backoff * 2 ** attempt)
+        remaining = self.remaining()
+        if remaining is not None and remaining <= delay:
+            return None
+        self.retried += 1
+        return delay
+
+def post_rpc(serverURL, payload, timeout, traffic=None):
+    ''' One JSON-RPC round trip, returns the decoded reply. Goes through
+        traffic (a Capture or Replay, --capture or --replay) if there is one. '''
+    def post():
+        return requests.post(serverURL, headers=RPC_HEADERS, data=payload, timeout=timeout).json()
 
-    record = "{key:010d} {address:<034} {label:<10.10} {amount:+018.8f}"
-    records = []
+    if traffic:
+        return traffic.rpc(payload, post)
+    return post()
 
-    logger.debug("Getting current balance")
+def hedged_post(serverURL, payload, timeout, hedge_after, traffic=None, log=None):
+    ''' Posts payload and, if there's no reply in hedge_after seconds, posts it
+        again on a second connection. Returns the first decoded reply. '''
+    def post():
+        return post_rpc(serverURL, payload, timeout, traffic=traffic)
+
+    log = log or logger
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
     try:
-        payload = json.dumps({"method": 'getbalance', "params": [], "jsonrpc": "1.0"})
-        balance = requests.post(serverURL, headers=headers, data=payload, timeout=10).json()['result']
-        records.append(record.format(key=1,address=0,label="Available", amount=balance))
-        logger.debug("Adding the following record: {}".format(record.format(key=1,address=0,label="Available", amount=balance)))
+        futures = [pool.submit(post)]
+        done, _ = concurrent.futures.wait(futures, timeout=hedge_after)
+        if not done:
+            log.debug("No reply in %ss, sending a hedged request", hedge_after)
+            futures.append(pool.submit(post))
+        error = None
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                return future.result()
+            except (ValueError, requests.exceptions.RequestException) as e:
+                error = error or e
+        raise error
+    finally:
+        # The slower request is left to finish (or time out) on its own
+        pool.shutdown(wait=False)
 
-    except ValueError:
-        logger.critical("Invalid Logon using {}".format(serverURL))
-        sys.exit(-1)
-    
-    except requests.exceptions.ConnectTimeout:
-        logger.critical("Could not connect to {}".format(serverURL))
-        sys.exit(-1)
-    logger.debug("Current balance {}".format(balance))
+def rpc_post(server, payload, method, timeout=None, policy=None, retry=True, traffic=None, log=None):
+    ''' Posts a JSON-RPC payload (one call or a batch) to server (from
+        rpc_server) and returns the decoded reply
+
+        Only reads (retry True) are retried or hedged, and only with a policy.
+        A send that got no reply may still have gone through, so it isn't.
+        The calls go through traffic (see post_rpc) and are logged to log,
+        the module's logger by default. '''
+    log = log or logger
+    serverURL, serverPrint = server
+    attempt = 0
+    while True:
+        if policy:
+            timeout = policy.timeout(method)
+        try:
+            if policy and retry and policy.hedge_after:
+                reply = hedged_post(serverURL, payload, timeout, policy.hedge_after, traffic=traffic, log=log)
+            else:
+                reply = post_rpc(serverURL, payload, timeout, traffic=traffic)
+        except ValueError:
+            raise RPCError("Invalid Logon using {}".format(serverPrint))
+        except requests.exceptions.ReadTimeout as e:
+            if not retry:
+                raise RPCError("No reply to {} from {} in {}s, not retrying as it may have gone through: {}".format(method, serverPrint, timeout, e))
+            failure = "No reply to {} from {} in {}s".format(method, serverPrint, timeout)
+        except requests.exceptions.RequestException as e:
+            failure = "Could not connect to {}: {}".format(serverPrint, e)
+        else:
+            errors = [r.get('error') for r in reply] if isinstance(reply, list) else [reply.get('error')]
+            warming = [error for error in errors if isinstance(error, dict) and error.get('code') == RPC_IN_WARMUP]
+            if not warming:
+                return reply
+            failure = "{} failed: {}".format(method, warming[0].get('message'))
+        delay = policy.retry(attempt) if policy and retry else None
+        if delay is None:
+            raise RPCError(failure)
+        attempt += 1
+        log.warning("%s, retry %s in %.2fs", failure, attempt, delay)
+        policy.sleep(delay)
 
-    logger.debug("Getting current unconfirmed balance")
+def rpc_call(server, method, params=(), timeout=None, policy=None, retry=True, traffic=None, log=None):
+    ''' Calls one dogecoind JSON-RPC method on server (from rpc_server) and
+        returns its result, see rpc_post '''
+    payload = json.dumps({"method": method, "params": list(params), "jsonrpc": "1.0"})
+    reply = rpc_post(server, payload, method, timeout=timeout, policy=policy, retry=retry, traffic=traffic, log=log)
+    if reply.get('error'):
+        raise RPCError("{} failed: {}".format(method, reply['error']))
+    return reply['result']
 
-    payload = json.dumps({"method": 'getunconfirmedbalance', "params": [], "jsonrpc": "1.0"})
-    pending = requests.post(serverURL, headers=headers, data=payload).json()['result']
-    records.append(record.format(key=2,address=0,label="Pending", amount=pending))
-    logger.debug("Adding the following record: {}".format(record.format(key=2,address=0,label="Pending", amount=pending)))
+def get_records(host='localhost', rpcUser=None, rpcPass=None, rpcPort=22555, workers=None, cache=None, details=None, policy=None,
+                traffic=None, log=None, debug_sample=1):
+    ''' Gets DOGECOIN records from dogecoin RPC server
 
-    logger.debug("Current unconfirmed balance {}".format(pending))
+        With a TransactionCache the transactions are enriched with gettransaction
+        and, if details is a dict, the txid, confirmations and fee of every
+        record are put in it by record key. The calls follow policy (an
+        RPCPolicy) if there is one. Raises RPCError if dogecoind can't be
+        reached or refuses a call. The calls go through traffic (see
+        post_rpc) and are logged to log, at DEBUG only every debug_sample'th
+        transaction (--debug-sample) is. '''
+    log = log or logger
+    if not debug_sample or debug_sample < 1:
+        raise ValueError("debug_sample has to be 1 or more, not {!r}".format(debug_sample))
 
-    logger.debug("Getting all transactions")
+    server = rpc_server(host=host, rpcUser=rpcUser, rpcPass=rpcPass, rpcPort=rpcPort)
 
-    payload = json.dumps({"method": 'listtransactions', "params": [], "jsonrpc": "1.0"})
-    recent  = requests.post(serverURL, headers=headers, data=payload).json()['result']
-    logger.debug("Total records from wallet: {}".format(len(recent)))
-    for activity in recent:
+    log.debug("Connecting to %s", server[1])
+
+    rows = []
+    keys = set()
+
+    log.debug("Getting current balance")
+    balance = rpc_call(server, 'getbalance', timeout=10, policy=policy, traffic=traffic, log=log)
+    rows.append((1, 0, "Available", balance))
+    log.debug("Adding the following record: %s %s %s %s", 1, 0, "Available", balance)
+    log.debug("Current balance %s", balance)
+
+    log.debug("Getting current unconfirmed balance")
+
+    pending = rpc_call(server, 'getunconfirmedbalance', timeout=10, policy=policy, traffic=traffic, log=log)
+    rows.append((2, 0, "Pending", pending))
+    log.debug("Adding the following record: %s %s %s %s", 2, 0, "Pending", pending)
+
+    log.debug("Current unconfirmed balance %s", pending)
+
+    log.debug("Getting all transactions")
+
+    recent = rpc_call(server, 'listtransactions', timeout=10, policy=policy, traffic=traffic, log=log)
+    log.debug("Total records from wallet: %s", len(recent))
+    if cache is not None:
+        enrich_transactions(server, recent, cache, policy=policy, traffic=traffic, log=log)
+    # Per transaction messages are only built at DEBUG, and then only for
+    # every --debug-sample'th transaction
+    debug = log.isEnabledFor(logging.DEBUG)
+    for count, activity in enumerate(recent):
         key = activity['timereceived']
         address = activity['address']
         amount = activity['amount']
@@ -165,172 +630,3059 @@ def get_records(host='localhost', rpcUser=None, rpcPass=None, rpcPort=22555):
             label = activity['label']
         except:
             label = ''
-        dup = False
-        for x in records:
-            if str(key) in x:
-                dup = True
-        if not dup:
-            logger.debug("Adding the following record: {}".format(record.format(key=key,address=address,amount=amount,label=label)))
-            records.append(record.format(key=key,address=address,amount=amount,label=label))
+        if key not in keys:
+            keys.add(key)
+            if debug and count % debug_sample == 0:
+                log.debug("Adding the following record: %s", RECORD_FORMAT.format(key, address, label, amount))
+            rows.append((key, address, label, amount))
+            if cache is not None and details is not None and activity.get('txid') in cache:
+                details['{:010d}'.format(key)] = cache.get(activity['txid'])
         else:
-            logger.debug("Duplicate record! No insert: {}".format(record.format(key=key,address=address,amount=amount,label=label)))
+            if debug and count % debug_sample == 0:
+                log.debug("Duplicate record! No insert: %s", RECORD_FORMAT.format(key, address, label, amount))
 
-    records.append(record.format(key=9999999999,address='0',amount=0,label='Control Record'))
-    logger.debug("Adding the following record: {}".format(record.format(key=9999999999,address='0',amount=0,label='Control Record')))
-    logger.debug("Total records being sent (including balance, pending and control record): {}".format(len(records)))
-    return records
+    rows.append((9999999999, '0', 'Control Record', 0))
+    log.debug("Adding the following record: %s %s %s %s", 9999999999, '0', 'Control Record', 0)
+    log.debug("Total records being sent (including balance, pending and control record): %s", len(rows))
+    return format_records(rows, workers=workers).decode('ascii').split("\n")
+
+class TransactionCache(object):
+    ''' Persistent LRU cache of gettransaction details keyed by txid
+
+        Only the fields the detail screen and send reconciliation need are
+        kept (txid, confirmations, fee, time). Once a transaction has
+        deep_confirmations it can't change any more so it's never fetched
+        again, its confirmation count is just kept up to date from
+        listtransactions. The least recently used entries are dropped past
+        capacity. '''
+
+    FIELDS = ['txid', 'confirmations', 'fee', 'time', 'blockhash']
+
+    def __init__(self, state_file=None, capacity=50000, deep_confirmations=100):
+        self.state_file = state_file or path.join(running_folder, txcache_file)
+        self.capacity = capacity
+        self.deep_confirmations = deep_confirmations
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.fetched = 0
+        try:
+            with open(self.state_file, 'r') as f:
+                for entry in json.load(f):
+                    self.entries[entry['txid']] = entry
+        except (IOError, ValueError, KeyError, TypeError):
+            self.entries = OrderedDict()
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, txid):
+        entry = self.entries.get(txid)
+        if entry is not None:
+            self.entries.move_to_end(txid)
+        return entry
+
+    def put(self, transaction):
+        entry = {field: transaction.get(field) for field in self.FIELDS}
+        self.entries[entry['txid']] = entry
+        self.entries.move_to_end(entry['txid'])
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return entry
+
+    def stale(self, activity):
+        ''' True if this listtransactions entry needs a gettransaction call '''
+        entry = self.get(activity['txid'])
+        if entry is None:
+            return True
+        confirmations = activity.get('confirmations', entry['confirmations'])
+        if entry['confirmations'] is not None and entry['confirmations'] >= self.deep_confirmations:
+            entry['confirmations'] = max(entry['confirmations'], confirmations)
+            self.hits += 1
+            return False
+        return True
+
+    def save(self):
+        temp = '{}.tmp'.format(self.state_file)
+        with open(temp, 'w') as f:
+            json.dump(list(self.entries.values()), f)
+        os.replace(temp, self.state_file)
+
+def enrich_transactions(server, transactions, cache, batch_size=100, policy=None, traffic=None, log=None):
+    ''' Fetches gettransaction for the transactions the cache can't answer
+
+        The calls go out as JSON-RPC batches of batch_size, retried like any
+        other read under policy. A reply that failed or can't be matched to a
+        transaction in its batch (dogecoind answers one that isn't valid with
+        "id": null, and a whole batch it can't parse with a single error) is
+        logged and skipped, the rest of the batches still go in the cache.
+        Returns the number of transactions asked for. '''
+    log = log or logger
+    stale = []
+    seen = set()
+    for activity in transactions:
+        txid = activity.get('txid')
+        if txid and txid not in seen:
+            seen.add(txid)
+            if cache.stale(activity):
+                stale.append(txid)
+    log.debug("%s of %s transactions need gettransaction, %s cached", len(stale), len(transactions), len(transactions) - len(stale))
+
+    for start in range(0, len(stale), batch_size):
+        batch = stale[start:start + batch_size]
+        payload = json.dumps([{"method": 'gettransaction', "params": [txid], "jsonrpc": "1.0", "id": i} for i, txid in enumerate(batch)])
+        replies = rpc_post(server, payload, 'gettransaction', timeout=10, policy=policy, traffic=traffic, log=log)
+        if not isinstance(replies, list):
+            log.warning("gettransaction batch of %s (%s to %s) failed: %s", len(batch), batch[0], batch[-1],
+                        replies.get('error') if isinstance(replies, dict) else replies)
+            continue
+        for reply in replies:
+            number = reply.get('id') if isinstance(reply, dict) else None
+            if not isinstance(number, int) or isinstance(number, bool) or not 0 <= number < len(batch):
+                log.warning("gettransaction reply for no transaction in the batch (id %r): %s", number,
+                            reply.get('error') if isinstance(reply, dict) else reply)
+                continue
+            result = reply.get('result')
+            if reply.get('error') or not isinstance(result, dict) or not result.get('txid'):
+                log.warning("gettransaction %s failed: %s", batch[number], reply.get('error'))
+                continue
+            cache.put(result)
+            cache.fetched += 1
+    return len(stale)
 
 def test(user='DOGE', password='DOGECOIN',target='localhost', port=3505):
     ''' send IEFBR14 job to hercules sockdev '''
-    logger.debug("Sending IEFBR14 to {}:{}".format(target,port))
+    logger.debug("Sending IEFBR14 to %s:%s", target, port)
     send_jcl(hostname=target, port=port, jcl=IEFBR14.format(user=user,password=password))
 
 def test_print(user='DOGE', password='DOGECOIN',target='localhost', port=3505):
     ''' send IEFBR14 job to hercules sockdev '''
     print(IEFBR14.format(user=user,password=password))
 
-def send_jcl(hostname='localhost',port=3505, jcl="", print_jcl=False):
-    logger.debug("Sending VSAM update JCL to tk4- reader using {}:{}".format(hostname,port))
+def send_jcl(hostname='localhost',port=3505, jcl="", print_jcl=False, timeout=None, traffic=None, log=None):
+    log = log or logger
+    log.debug("Sending VSAM update JCL to tk4- reader using %s:%s", hostname, port)
     if print_jcl:
         print("PRINTING JCL:\n{}\n{}\n{}\n".format('-'*80,jcl, '-'*80))
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((hostname,port))
-    s.sendall(jcl.encode())
-    s.close()
+    # Already encoded buffers are passed through as is so fan-out only encodes once
+    if isinstance(jcl, str):
+        jcl = jcl.encode()
+
+    def send():
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if timeout:
+            s.settimeout(timeout)
+        try:
+            s.connect((hostname,port))
+            s.sendall(jcl)
+        finally:
+            s.close()
+
+    if traffic:
+        traffic.reader('{}:{}'.format(hostname, port), jcl, send)
+    else:
+        send()
+
+def parse_reader_targets(targets, default_port=3505):
+    ''' Converts a list of host[:port] strings to (host, port) tuples '''
+    readers = []
+    for target in targets:
+        for entry in str(target).split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+            if ':' in entry:
+                host, port = entry.rsplit(':', 1)
+                readers.append((host, int(port)))
+            else:
+                readers.append((entry, int(default_port)))
+    return readers
+
+def send_jcl_all(targets, jcl="", print_jcl=False, timeout=10, retries=2, retry_delay=1, traffic=None, log=None):
+    ''' Submits one rendered JCL job to multiple tk4- readers at the same time
+
+        Returns a dict keyed on "host:port" with the status, number of attempts,
+        elapsed seconds and last error (if any) for every reader. '''
+    log = log or logger
+    if print_jcl:
+        print("PRINTING JCL:\n{}\n{}\n{}\n".format('-'*80,jcl, '-'*80))
+    payload = jcl.encode() if isinstance(jcl, str) else jcl
+
+    def submit(hostname, port):
+        status = {'status': 'failed', 'attempts': 0, 'elapsed': 0, 'error': None}
+        begin = time.time()
+        for attempt in range(1, int(retries) + 2):
+            status['attempts'] = attempt
+            try:
+                send_jcl(hostname=hostname, port=port, jcl=payload, timeout=timeout, traffic=traffic, log=log)
+                status['status'] = 'sent'
+                status['error'] = None
+                break
+            except OSError as e:
+                status['error'] = str(e)
+                log.warning("Sending JCL to %s:%s failed (attempt %s of %s): %s", hostname, port, attempt, int(retries) + 1, e)
+                if attempt <= int(retries):
+                    time.sleep(retry_delay)
+        status['elapsed'] = time.time() - begin
+        return status
+
+    results = {}
+    if not targets:
+        return results
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        futures = {pool.submit(submit, hostname, port): "{}:{}".format(hostname, port) for hostname, port in targets}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+            log.debug("Reader %s status: %s", futures[future], results[futures[future]])
+    return results
+
+def submit_vsam_update(args, jcl):
+    ''' Sends the VSAM update JCL to --hostname/--rdrport or every --readers target
+
+        Returns True only if every reader accepted the job so the tmp file is not
+        updated (and the job is resent next run) when one of them failed. When
+        --profiles are synced together args.reader_queue is a single worker
+        executor so jobs from every wallet reach the reader one at a time. '''
+    reader_queue = getattr(args, 'reader_queue', None)
+    if isinstance(reader_queue, concurrent.futures.Executor):
+        return reader_queue.submit(send_vsam_update, args, jcl).result()
+    return send_vsam_update(args, jcl)
+
+def send_vsam_update(args, jcl, log=None):
+    ''' Sends jcl to the reader(s) in args, through args.traffic (--capture
+        or --replay) if there is one '''
+    log = log or logger
+    traffic = getattr(args, 'traffic', None)
+    if not args.readers:
+        send_jcl(hostname=args.hostname,port=args.rdrport, jcl=jcl, print_jcl=args.print, traffic=traffic, log=log)
+        return True
+    targets = parse_reader_targets(args.readers, default_port=args.rdrport)
+    results = send_jcl_all(targets, jcl=jcl, print_jcl=args.print, timeout=args.rdrtimeout, retries=args.rdrretries,
+                           traffic=traffic, log=log)
+    failed = [target for target in results if results[target]['status'] != 'sent']
+    for target in sorted(results):
+        log.debug("Reader %(status)s %(target)s: %(attempts)s attempt(s) in %(elapsed).2fs", dict(results[target], target=target))
+    if failed:
+        log.error("JCL submission failed for reader(s): %s", ', '.join(sorted(failed)))
+        return False
+    return True
+
+class SubmissionQueue(object):
+    ''' Coalescing VSAM job queue
+
+        Holds at most one pending job, newer wallet snapshots replace it, and
+        only submits once the previous job has printed its DOGEVSAM99 marker to
+        the class D printer (or has been in flight longer than stale_after
+        seconds). State is kept in a JSON file between runs, along with the
+        held job's records so uploaded(records) can record them as sent
+        whenever the job goes, even from a later printer only pass. '''
+
+    def __init__(self, submit, user='herc01', password='cul8tr', state_file=None, stale_after=900, owner='DOGE.VSAM', uploaded=None):
+        self.submit = submit
+        self.owner = owner
+        self.uploaded = uploaded
+        self.user = user.upper()
+        self.password = password.upper()
+        self.state_file = state_file or path.join(running_folder, queue_file)
+        self.stale_after = stale_after
+        self.inflight = None
+        self.pending = None
+        self.records = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            self.inflight = state.get('inflight')
+            self.pending = state.get('pending')
+            self.records = state.get('records')
+        except (IOError, ValueError):
+            self.inflight = None
+            self.pending = None
+            self.records = None
+
+    def save(self):
+        with open(self.state_file, 'w') as f:
+            json.dump({'inflight': self.inflight, 'pending': self.pending, 'records': self.records}, f)
+
+    def busy(self):
+        ''' True while the last submitted job hasn't been seen to finish '''
+        if not self.inflight:
+            return False
+        if time.time() - self.inflight['submitted'] > self.stale_after:
+            logger.warning("VSAM job %s never reported back after %s seconds, assuming it's gone", self.inflight['token'], self.stale_after)
+            self.inflight = None
+            return False
+        return True
+
+    def offer(self, jcl, records=None):
+        ''' Queue the latest VSAM job (built from records), replacing any pending one. Returns True if it was submitted '''
+        if self.pending:
+            logger.debug("Replacing pending VSAM job with newer wallet snapshot")
+        self.pending = jcl
+        self.records = records
+        return self.pump()
+
+    def job_finished(self, token):
+        ''' Marks the in flight job done when its marker shows up on the printer '''
+        if self.inflight and self.inflight['token'] == token:
+            logger.debug("VSAM job %s finished after %.1f seconds", token, time.time() - self.inflight['submitted'])
+            self.inflight = None
+        self.save()
+
+    def pump(self):
+        ''' Submits the pending job if nothing is in flight. Returns True if a job was sent '''
+        if not self.pending or self.busy():
+            if self.pending:
+                logger.debug("VSAM job %s still running, holding latest snapshot", self.inflight['token'])
+            self.save()
+            return False
+        token = job_token(self.owner)
+        jcl = self.pending + '\n' + DONE_JCL.format(user=self.user, password=self.password, token=token)
+        if not self.submit(jcl):
+            self.save()
+            return False
+        logger.debug("Submitted VSAM job %s", token)
+        self.inflight = {'token': token, 'submitted': time.time()}
+        if self.uploaded and self.records is not None:
+            self.uploaded(self.records)
+        self.pending = None
+        self.records = None
+        self.save()
+        return True
+
+def job_token(owner):
+    ''' A DOGEVSAM99 marker token, the VSAM file it's for then 8 hex digits so
+        wallets sharing a printer can tell their markers apart '''
+    return '{}.{:08X}'.format(owner.upper(), random.getrandbits(32))
+
+def token_owner(token):
+    ''' The VSAM file a job_token is for, None for a token from before they had one '''
+    return token.rpartition('.')[0] or None
+
+printer_lock = threading.Lock()
 
-def generate_IDCAMS_JCL(user='herc01',password='cul8tr',vsam_file='DOGE.VSAM',records='', volume='pub012', reverse=True):
+def share_printer(commands, mine, stale_after=900, filename=None, owners=None):
+    ''' Splits what a drain read off the printer between the wallets sharing it
 
-    if len(records) > 7648:
+        Printer output is gone once it's read, so the commands mine() doesn't
+        want (other wallets' DOGEVSAM99 markers, DOGECICS99 sends when this
+        wallet doesn't send) go in a backlog file next to the script and the
+        wallet they belong to picks them up on its next drain. Nothing is kept
+        for ever: whatever nobody claimed for stale_after seconds is dropped
+        (a marker's queue has given up on it by then and a send that old
+        mustn't be paid out any more), and so are the markers of VSAM files
+        that aren't in owners (the --profiles syncing now) when it's given.
+        Everything dropped is logged. Returns the commands (and backlog) that
+        are mine. '''
+    filename = filename or path.join(running_folder, printer_file)
+    now = time.time()
+    with printer_lock:
+        try:
+            with open(filename, 'r') as f:
+                backlog = json.load(f)
+        except (IOError, ValueError):
+            backlog = []
+        own = []
+        rest = []
+        for command in backlog + [dict(command, seen=now) for command in commands]:
+            if mine(command):
+                own.append(command)
+            elif now - command['seen'] > stale_after:
+                if 'done' in command:
+                    logger.warning("Dropping job marker %s, nobody claimed it in %ss", command['done'], stale_after)
+                else:
+                    logger.warning("Dropping DOGESEND of %s to %s printed %ss ago, no wallet sending claimed it", command['amount'], command['address'], int(now - command['seen']))
+            elif 'done' in command and owners is not None and token_owner(command['done']) not in owners:
+                logger.warning("Dropping job marker %s, there's no %s profile", command['done'], token_owner(command['done']))
+            else:
+                rest.append(command)
+        if backlog or rest:
+            logger.debug("Keeping %s printer command(s) for other wallets in %s", len(rest), filename)
+            with open(filename, 'w') as f:
+                json.dump(rest, f)
+    return [{key: value for key, value in command.items() if key != 'seen'} for command in own]
+
+def save_chunk_manifest(chunks, vsam_file, folder=None):
+    ''' Writes each chunk's JCL and a manifest.json with the order, key range and status of every chunk '''
+    folder = folder or path.join(running_folder, chunk_folder)
+    os.makedirs(folder, exist_ok=True)
+    manifest = {'vsam_file': vsam_file.upper(), 'created': int(time.time()), 'chunks': []}
+    for chunk in chunks:
+        jcl_file = '{:03d}.jcl'.format(chunk['sequence'])
+        with open(path.join(folder, jcl_file), 'w') as f:
+            f.write(chunk['jcl'])
+        entry = {k: v for k, v in chunk.items() if k != 'jcl'}
+        entry['jcl_file'] = jcl_file
+        entry.setdefault('status', 'pending')
+        manifest['chunks'].append(entry)
+    with open(path.join(folder, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def load_chunk_manifest(folder=None):
+    ''' Reads manifest.json and each chunk's JCL back from the chunk folder '''
+    folder = folder or path.join(running_folder, chunk_folder)
+    with open(path.join(folder, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    for chunk in manifest['chunks']:
+        with open(path.join(folder, chunk['jcl_file']), 'r') as f:
+            chunk['jcl'] = f.read()
+    return manifest
+
+def submit_vsam_chunks(args, chunks, folder=None):
+    ''' Submits chunked IDCAMS jobs in key order, recording each chunk's status in the manifest
+
+        Stops at the first chunk that could not be sent, later chunks stay pending
+        so they can be resubmitted with --resubmit-chunk once the reader is back. '''
+    ok = True
+    for chunk in chunks:
+        if not ok:
+            chunk['status'] = 'pending'
+            continue
+        logger.debug("Submitting chunk %s (%s records, keys %s to %s)", chunk['sequence'], chunk['records'], chunk['first_key'], chunk['last_key'])
+        try:
+            ok = submit_vsam_update(args, chunk['jcl'])
+        except OSError as e:
+            logger.error("Submitting chunk %s failed: %s", chunk['sequence'], e)
+            ok = False
+        chunk['status'] = 'submitted' if ok else 'failed'
+    save_chunk_manifest(chunks, args.vsam_file, folder=folder)
+    return ok
+
+def resubmit_chunk(args, sequence, folder=None):
+    ''' Resubmits a single chunk from the last chunked load '''
+    manifest = load_chunk_manifest(folder=folder)
+    chunks = manifest['chunks']
+    matches = [chunk for chunk in chunks if chunk['sequence'] == int(sequence)]
+    if not matches:
+        logger.critical("Chunk %s not found in %s chunk manifest", sequence, manifest['vsam_file'])
+        return False
+    chunk = matches[0]
+    if chunk['sequence'] == 1:
+        logger.warning("Chunk 1 deletes and redefines %s, every other chunk has to be resubmitted after it", manifest['vsam_file'])
+    try:
+        ok = submit_vsam_update(args, chunk['jcl'])
+    except OSError as e:
+        logger.error("Resubmitting chunk %s failed: %s", chunk['sequence'], e)
+        ok = False
+    chunk['status'] = 'submitted' if ok else 'failed'
+    save_chunk_manifest(chunks, manifest['vsam_file'], folder=folder)
+    return ok
+
+def window_records(records, reverse=True, limit=7648):
+    ''' Trims records to the 7648 that fit on the volume, keeping the balance and control records '''
+    if len(records) > limit:
         if reverse:
-            logger.debug("Records exceeds maximum records length of 7648. Getting last 7648 records. To get first 7648 records use --start-records-at-one")
+            logger.debug("Records exceeds maximum records length of %(limit)s. Getting last %(limit)s records. To get first %(limit)s records use --start-records-at-one", {'limit': limit})
             record0000000001 = records[0]
             record0000000002 = records[1]
-            records = records[-7648:]
+            records = records[-limit:]
             records[0] = record0000000001
             records[1] = record0000000002
         else:
-            logger.debug("Records exceeds maximum records length of 7648. Getting first 7648 records because --start-records-at-one was passed to script")
+            logger.debug("Records exceeds maximum records length of %(limit)s. Getting first %(limit)s records because --start-records-at-one was passed to script", {'limit': limit})
             record9999999999 = records[-1]
-            records = records[:7648]
+            records = records[:limit]
             records[-1] = record9999999999
+    return records
+
+# The cards a VSAM load is made of, one character per column: d a digit, x any
+# printable character, s a sign, c the DOGEMAIN line colour (R or G), a blank,
+# a point or a slash. A transaction (and the balance and control records) is
+# laid out by generate_fake_records/get_records: key, address, label and amount
+# each in their own columns. The summary and recent cards are
+# generate_summary_records' and the page directory generate_page_directory's.
+# Every card is 80 bytes at most.
+CARD_WIDTH = 80
+CARD_LAYOUTS = {
+    'record': 'd' * 10 + ' ' + 'x' * 34 + ' ' + 'x' * 10 + ' s' + 'd' * 8 + '.' + 'd' * 8,
+    'summary': 'd' * 10 + (' s' + 'd' * 16) * 3 + ' dd/dd/dddd',
+    'recent': 'd' * 10 + ' c ' + 'x' * 47,
+    'page': 'd' * 10 + ' ' + 'x' * 10 + ' ' + 'd' * 5,
+}
+CARD_NAMES = {'record': 'key/address/label/amount', 'summary': 'dashboard summary',
+              'recent': 'recent transaction', 'page': 'page directory'}
+CARD_CLASSES = OrderedDict([('d', '0123456789'), ('x', ''.join(map(chr, range(0x20, 0x7f)))), ('s', '+-'),
+                            ('c', 'RG'), (' ', ' '), ('.', '.'), ('/', '/')])
+
+def card_layout(key):
+    ''' The CARD_LAYOUTS layout of the VSAM card with this key '''
+    if key == '0000000003':
+        return 'summary'
+    if key in ('0000000004', '0000000005'):
+        return 'recent'
+    return 'record'
+
+def card_pattern(layout):
+    ''' The regular expression for a CARD_LAYOUTS layout, for checking without numpy '''
+    return re.compile(''.join('[{}]{{{}}}'.format(re.escape(CARD_CLASSES[column]), len(list(run)))
+                              for column, run in itertools.groupby(CARD_LAYOUTS[layout])))
+
+def card_classes():
+    ''' Every byte's CARD_CLASSES as bits, a 256 entry numpy table '''
+    classes = numpy.zeros(256, dtype=numpy.uint8)
+    for bit, characters in enumerate(CARD_CLASSES.values()):
+        classes[[ord(character) for character in characters]] |= 1 << bit
+    return classes
+
+def card_columns(layout):
+    ''' The CARD_CLASSES bit every column of a CARD_LAYOUTS layout takes, as
+        CARD_WIDTH numpy bytes. Columns past the layout only take the blanks
+        the cards are padded with. '''
+    bits = {column: 1 << bit for bit, column in enumerate(CARD_CLASSES)}
+    return numpy.array([bits[column] for column in CARD_LAYOUTS[layout].ljust(CARD_WIDTH)], dtype=numpy.uint8)
+
+def check_cards(cards, layout=None):
+    ''' Checks every card against its layout and every key against the one before it
+
+        layout is the CARD_LAYOUTS layout of every card, by default it's picked
+        from each card's key (card_layout). With numpy the cards are packed in
+        to one CARD_WIDTH column array of bytes, every byte is turned in to
+        its CARD_CLASSES bits with one table lookup and every column of every
+        card is checked against its layout's card_columns at once, the keys
+        are compared as one array too. Returns the index of every card that
+        doesn't fit its layout, the index of every card whose key isn't above
+        the one before it and every card's layout. '''
+    if numpy is None:
+        keys = [card[:10] for card in cards]
+        layouts = [layout or card_layout(key) for key in keys]
+        patterns = {name: card_pattern(name) for name in set(layouts)}
+        bad = [number for number, card in enumerate(cards) if not patterns[layouts[number]].fullmatch(card)]
+        # Keys have to go up for REPRO, compare every key with the one before it
+        order = [number for number, (previous, key) in enumerate(zip(keys, keys[1:]), 1) if key <= previous]
+        return bad, order, layouts
+
+    count = len(cards)
+    lengths = numpy.fromiter(map(len, cards), dtype='int64', count=count)
+    packed = ''.join(card[:CARD_WIDTH].ljust(CARD_WIDTH) for card in cards)
+    columns = numpy.frombuffer(packed.encode('ascii', 'replace'), dtype=numpy.uint8).reshape(count, CARD_WIDTH)
+    keys = columns[:, :10].copy().view('S10').ravel()
+    if layout:
+        layouts = numpy.full(count, layout, dtype='U7')
+    else:
+        layouts = numpy.full(count, 'record', dtype='U7')
+        layouts[keys == b'0000000003'] = 'summary'
+        layouts[(keys == b'0000000004') | (keys == b'0000000005')] = 'recent'
+    classes = card_classes().take(columns)
+    good = numpy.zeros(count, dtype=bool)
+    for name in CARD_LAYOUTS:
+        rows = layouts == name
+        if rows.any():
+            fits = numpy.bitwise_and(classes[rows], card_columns(name)).all(axis=1)
+            good[rows] = fits & (lengths[rows] == len(CARD_LAYOUTS[name]))
+    if not packed.isascii():
+        # The ? a character past ASCII was packed as would pass as printable
+        good &= numpy.fromiter((card.isascii() for card in cards), dtype=bool, count=count)
+    bad = numpy.flatnonzero(~good).tolist()
+    order = (numpy.flatnonzero(keys[1:] <= keys[:-1]) + 1).tolist()
+    return bad, order, layouts.tolist()
+
+def card_problem(card, layout):
+    ''' What's wrong with a card check_cards found bad '''
+    if len(card) > CARD_WIDTH:
+        return 'card is {} bytes, longer than RECORDSIZE(80,80)'.format(len(card))
+    if not card.isascii() or not card.isprintable():
+        return 'card has characters that can\'t be sent to the reader'
+    if len(card) != len(CARD_LAYOUTS[layout]):
+        return 'a field overflows its column, card is {} bytes instead of {}'.format(len(card), len(CARD_LAYOUTS[layout]))
+    return 'card doesn\'t match the {} layout'.format(CARD_NAMES[layout])
+
+def validate_records(records, pages=None):
+    ''' Checks a record deck before it's sent to the reader
+
+        A bad deck is only found out after IDCAMS has already deleted the
+        cluster, so this checks everything REPRO and the KICKS programs rely
+        on, on the deck as it is sent (generate_IDCAMS_JCL's validate): every
+        card fits RECORDSIZE(80,80) and has its fields in the right columns
+        for its layout (an address, label, amount or dashboard total that
+        overflows pushes the rest of the card over), keys are in ascending
+        order with no duplicates and the deck ends with the 9999999999 control
+        record. pages, the page directory, is checked the same way. Returns a
+        list of problems, one per bad card, as dicts of card number, key and
+        problem (page directory cards are numbered after the deck). An empty
+        list means the deck is good. '''
+    problems = []
+    for offset, cards, layout, prefix in ((0, records, None, ''), (len(records), pages or [], 'page', 'page directory ')):
+        bad, order, layouts = check_cards(cards, layout)
+        for number in bad:
+            problems.append({'card': offset + number + 1, 'key': cards[number][:10], 'problem': prefix + card_problem(cards[number], layouts[number])})
+        for number in order:
+            previous, key = cards[number - 1][:10], cards[number][:10]
+            problem = 'duplicate key' if key == previous else 'key out of order (after {})'.format(previous)
+            problems.append({'card': offset + number + 1, 'key': key, 'problem': prefix + problem})
+
+    if not records or records[-1][:10] != '9999999999':
+        problems.append({'card': len(records), 'key': records[-1][:10] if records else '', 'problem': 'control record 9999999999 missing from the end'})
+    return sorted(problems, key=lambda problem: problem['card'])
+
+def deck_error(problems):
+    ''' The RecordError for a deck validate_records found problems with '''
+    return RecordError("{} bad card(s) in the VSAM deck, first: card {card} key {key}: {problem}".format(len(problems), **problems[0]), problems)
+
+def reserved_key(key):
+    ''' Keys below 0000000010 (balances and dashboard summary) and the control record aren't transactions '''
+    return key < '0000000010' or key == '9999999999'
+
+def edited_amount(amount):
+    ''' Formats a record amount (+00001234.50000000) like PIC Z(02),Z(03),Z(02)9.9(8) '''
+    return '{:>10}.{}'.format('{:,}'.format(int(amount[1:9])), amount[10:18])
+
+def generate_summary_records(records, now=None):
+    ''' Works out everything the DOGEMAIN dashboard shows so it doesn't have to
+
+        0000000003 holds available, pending and total as S9(8)V9(8) SIGN LEADING
+        SEPARATE plus the date as MM/DD/YYYY. 0000000004 and 0000000005 hold the
+        second to last and last transaction already formatted for RECNT1/RECNT2
+        with R (sent) or G (received) for the line colour. '''
+    now = now or time.time()
+    balances = {'0000000001': Decimal(0), '0000000002': Decimal(0)}
+    transactions = []
+    for record in records:
+        key = record[:10]
+        try:
+            amount = Decimal(record[57:75])
+        except ArithmeticError:
+            continue
+        if key in balances:
+            balances[key] = amount
+        elif not reserved_key(key) and len(record) >= 75:
+            transactions.append(record)
+    transactions.sort()
+
+    def signed(amount):
+        amount = '{:+018.8f}'.format(amount)
+        return amount[0] + amount[1:9] + amount[10:18]
+
+    def recent(key, record):
+        if not record:
+            return "{key} G {line:47}".format(key=key, line='')
+        date = datetime.datetime.fromtimestamp(int(record[:10]), datetime.timezone.utc).strftime('%m/%d/%Y')
+        line = "{date} {label:<10.10} {sign}{amount} DOGE".format(date=date, label=record[46:56], sign=record[57], amount=edited_amount(record[57:75]))
+        return "{key} {color} {line}".format(key=key, color='R' if record[57] == '-' else 'G', line=line)
+
+    last_two = ([None, None] + transactions)[-2:]
+    summary = "0000000003 {available} {pending} {total} {date}".format(
+        available=signed(balances['0000000001']), pending=signed(balances['0000000002']),
+        total=signed(balances['0000000001'] + balances['0000000002']),
+        date=datetime.datetime.fromtimestamp(now, datetime.timezone.utc).strftime('%m/%d/%Y'))
+    logger.debug("Dashboard summary record: %s", summary)
+    return [summary, recent('0000000004', last_two[0]), recent('0000000005', last_two[1])]
+
+def generate_page_directory(records, rows=7):
+    ''' Builds the DOGETRAN page directory, one record per screen of transactions
+
+        Each record is keyed on the page number and holds the key of the first
+        transaction on that page and the total number of pages, so DOGETRAN can
+        find any page with one keyed READ instead of browsing backwards. '''
+    keys = sorted(r[:10] for r in records if not reserved_key(r[:10]))
+    starts = keys[::rows] or ['9999999999']
+    logger.debug("Generating page directory with %s pages of %s transactions", len(starts), rows)
+    page = "{page:010d} {start:<10.10} {pages:05d}"
+    return [page.format(page=number, start=start, pages=len(starts)) for number, start in enumerate(starts, 1)]
+
+def generate_address_index(vsam_file, volume, records):
+    ''' Returns the IDCAMS step that defines and builds the address alternate index
+
+        Each AIX record is a 5 byte header, the 34 byte address and a 10 byte
+        prime key for every transaction with that address, so the record size
+        is worked out from the busiest address in this load. '''
+    addresses = {}
+    for record in records:
+        addresses[record[11:45]] = addresses.get(record[11:45], 0) + 1
+    busiest = max(addresses.values()) if addresses else 1
+    average = 5 + 34 + 10 * max(len(records) // max(len(addresses), 1), 1)
+    maximum = 5 + 34 + 10 * busiest
+    if maximum > 32600:
+        logger.warning("Address index records for the busiest address (%s transactions) are too big, BLDINDEX will fail for it", busiest)
+        maximum = 32600
+    logger.debug("Address index for %s addresses, busiest has %s transactions", len(addresses), busiest)
+    return AIX_STEP.format(vsam_file=vsam_file, volume=volume, average=min(average, maximum),
+                           maximum=maximum, records=max(len(addresses), 1))
+
+def generate_IDCAMS_JCL(user='herc01',password='cul8tr',vsam_file='DOGE.VSAM',records='', volume='pub012', reverse=True, page_directory=True, summary=True, address_index=False, validate=False):
+    ''' Renders the IDCAMS job that loads records in to VSAM
+
+        With validate the deck as it's sent (the summary cards and page
+        directory included) goes through validate_records first and a bad
+        one raises RecordError. '''
+
+    if summary:
+        # Summary records count against the 7648 that fit on the volume
+        records = window_records(records, reverse=reverse, limit=7645)
+        records = records[:2] + generate_summary_records(records) + records[2:]
+    else:
+        records = window_records(records, reverse=reverse)
+
+    user = user.upper()
+    password = password.upper()
+    volume = volume.upper()
+    vsam_file = vsam_file.upper()
+    pages = generate_page_directory(records) if page_directory else None
+    if validate:
+        problems = validate_records(records, pages)
+        if problems:
+            raise deck_error(problems)
+    logger.debug("Generating IDCAMS JCL with the following options: user: %s password: %s vsam_file: %s volume: %s", user, password, vsam_file, volume)
+    jcl = IDCAMS.format(user=user,password=password,vsam_file=vsam_file,records='\n'.join(records),volume=volume)
+    if page_directory:
+        jcl += '\n' + PAGES_STEP.format(vsam_file=vsam_file,volume=volume,pages='\n'.join(pages))
+    if address_index:
+        jcl += '\n' + generate_address_index(vsam_file, volume, records)
+    return jcl
+
+def generate_IDCAMS_JCL_chunks(user='herc01',password='cul8tr',vsam_file='DOGE.VSAM',records='', volume='pub012', reverse=True, chunk_size=1000, page_directory=True, summary=True, address_index=False, validate=False):
+    ''' Splits the records in to key ordered chunks with one IDCAMS job per chunk
+
+        The first job does the DELETE/DEFINE and loads the first chunk, every job
+        after that REPROs the next chunk in to the existing cluster. All the jobs
+        are named DOGEVSM so JES2 runs them one at a time in the order they were
+        submitted. Returns a list of chunks (sequence, step name, key range,
+        number of records and JCL). validate is generate_IDCAMS_JCL's, the
+        whole deck is checked before it's split. '''
+
+    if summary:
+        records = window_records(records, reverse=reverse, limit=7645)
+        records = records + generate_summary_records(records)
+    else:
+        records = window_records(records, reverse=reverse)
+    records = sorted(records, key=lambda r: r[:10])
+    chunk_size = max(int(chunk_size), 1)
+    pages = generate_page_directory(records) if page_directory else None
+    if validate:
+        problems = validate_records(records, pages)
+        if problems:
+            raise deck_error(problems)
 
     user = user.upper()
     password = password.upper()
     volume = volume.upper()
     vsam_file = vsam_file.upper()
-    logger.debug("Generating IDCAMS JCL with the following options: user: {user} password: {password} vsam_file: {vsam_file} volume: {volume}".format(user=user,password=password,vsam_file=vsam_file,volume=volume))
-    return IDCAMS.format(user=user,password=password,vsam_file=vsam_file,records='\n'.join(records),volume=volume)
+    total = (len(records) + chunk_size - 1) // chunk_size
+    logger.debug("Generating %s chunked IDCAMS jobs of up to %s records for %s", total, chunk_size, vsam_file)
+
+    chunks = []
+    for sequence, start in enumerate(range(0, len(records), chunk_size), 1):
+        chunk = records[start:start + chunk_size]
+        if sequence == 1:
+            step = 'DOGECAMS'
+            jcl = IDCAMS.format(user=user,password=password,vsam_file=vsam_file,records='\n'.join(chunk),volume=volume)
+        else:
+            step = 'DOGEC{:03d}'.format(sequence)
+            jcl = IDCAMS_REPRO.format(user=user,password=password,vsam_file=vsam_file,records='\n'.join(chunk),
+                                      step=step, sequence=sequence, total=total)
+        chunks.append({'sequence': sequence, 'job': 'DOGEVSM', 'step': step,
+                       'first_key': chunk[0][:10], 'last_key': chunk[-1][:10],
+                       'records': len(chunk), 'jcl': jcl})
+    if page_directory and chunks:
+        # The directory covers every chunk so it's built by the last job
+        chunks[-1]['jcl'] += '\n' + PAGES_STEP.format(vsam_file=vsam_file,volume=volume,pages='\n'.join(pages))
+    if address_index and chunks:
+        # Built once every chunk has been loaded in to the base cluster
+        chunks[-1]['jcl'] += '\n' + generate_address_index(vsam_file, volume, records)
+    return chunks
 
 def new_records(old_records, new_records):
     if old_records == new_records:
-        logger.debug("no new records, update not required, force update with --force".format(running_folder,tmp_file))
+        logger.debug("no new records, update not required, force update with --force")
         return False
     else:
         logger.debug("new records in wallet, sending update")
         return True
 
-def get_commands(timeout=2, hostname='localhost', port=3506):
-# From https://www.binarytides.com/receive-full-data-with-the-recv-socket-function-in-python/
-    
-    logger.debug('Connecting to tk4- printer {}:{} to get transactions.'.format(hostname,port))
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((hostname,port))
-    s.setblocking(0)
+class RecordArchive(object):
+    ''' Append only, columnar archive of every wallet transaction ever seen
 
-    total_data=[]
-    data=''
-    begin=time.time()
+        VSAM only holds the 7648 records that fit on the volume, the archive
+        keeps the rest. The file is a run of blocks, each one:
 
-    while 1:
-        if total_data and time.time()-begin > timeout:
-            break
-        elif time.time()-begin > timeout*2:
-            break
-        
+        * a fixed header: magic, version, row count, min and max key and the
+          compressed sizes of the two sections below
+        * the addresses and labels first seen in this block (zlib'd JSON),
+          everything else refers to them by their position in the dictionary
+        * the columns as zlib'd little endian typed arrays: int64 keys, int64
+          amounts in koinu and uint32 address and label dictionary codes
+
+        Opening only reads the headers and dictionaries. Range scans skip
+        every block whose min/max key is outside the range. The Available and
+        Pending balance cards of the last sync are kept next to it in
+        <filename>.balances (JSON) since they aren't transactions. '''
+
+    MAGIC = b'DOGA'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBIqqII')
+    BLOCK_ROWS = 65536
+    KOINU = Decimal(100000000)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.balances_file = filename + '.balances'
+        self.blocks = []
+        self.addresses = []
+        self.labels = []
+        self.address_codes = {}
+        self.label_codes = {}
+        self.end = 0
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return
+        size = os.path.getsize(self.filename)
+        with open(self.filename, 'rb') as f:
+            offset = 0
+            while offset + self.HEADER.size <= size:
+                magic, version, rows, low, high, dictionary, columns = self.HEADER.unpack(f.read(self.HEADER.size))
+                if magic != self.MAGIC or version != self.VERSION:
+                    raise ValueError("{} is not a DOGE record archive".format(self.filename))
+                end = offset + self.HEADER.size + dictionary + columns
+                if end > size:
+                    # A block cut short by a crash, the next append writes over it
+                    break
+                addresses, labels = json.loads(zlib.decompress(f.read(dictionary)))
+                self.add_dictionary(addresses, labels)
+                self.blocks.append({'offset': offset + self.HEADER.size + dictionary, 'rows': rows,
+                                    'min': low, 'max': high, 'size': columns})
+                f.seek(columns, os.SEEK_CUR)
+                offset = end
+        self.end = offset
+
+    def add_dictionary(self, addresses, labels):
+        for address in addresses:
+            self.address_codes[address] = len(self.addresses)
+            self.addresses.append(address)
+        for label in labels:
+            self.label_codes[label] = len(self.labels)
+            self.labels.append(label)
+
+    def __len__(self):
+        return sum(block['rows'] for block in self.blocks)
+
+    @staticmethod
+    def little_endian(column):
+        if sys.byteorder == 'big':
+            column.byteswap()
+        return column
+
+    def read_block(self, block):
+        ''' Returns the keys, koinu, address and label code arrays of a block '''
+        with open(self.filename, 'rb') as f:
+            f.seek(block['offset'])
+            data = zlib.decompress(f.read(block['size']))
+        rows = block['rows']
+        columns = []
+        start = 0
+        for typecode in 'qqII':
+            column = array(typecode)
+            end = start + rows * column.itemsize
+            column.frombytes(data[start:end])
+            columns.append(self.little_endian(column))
+            start = end
+        return columns
+
+    def append(self, records):
+        ''' Appends the transactions in records that aren't archived yet
+
+            The balance, summary and control records aren't kept. Returns the
+            number of transactions added. '''
+        rows = {}
+        balances = {}
+        for record in records:
+            key = int(record[:10])
+            if record[:10] in ('0000000001', '0000000002'):
+                balances[record[:10]] = record
+            elif not reserved_key(record[:10]) and key != 9999999999:
+                rows[key] = record
+        if balances:
+            with open(self.balances_file + '.tmp', 'w') as f:
+                json.dump(dict(self.balances(), **balances), f)
+            os.replace(self.balances_file + '.tmp', self.balances_file)
+        # Only a block whose min/max range covers one of the keys can have it
+        # already, the wallet's recent transactions only touch the last block
+        candidates = sorted(rows)
+        for block in self.blocks:
+            first = bisect_left(candidates, block['min'])
+            if first < len(candidates) and candidates[first] <= block['max']:
+                for key in self.read_block(block)[0]:
+                    rows.pop(key, None)
+        keys = sorted(rows)
+        for start in range(0, len(keys), self.BLOCK_ROWS):
+            self.write_block([rows[key] for key in keys[start:start + self.BLOCK_ROWS]])
+        logger.debug("Archived %s new transactions, %s in %s", len(keys), len(self), self.filename)
+        return len(keys)
+
+    def write_block(self, records):
+        known_addresses = len(self.addresses)
+        known_labels = len(self.labels)
+        keys, koinu, address_codes, label_codes = array('q'), array('q'), array('I'), array('I')
+        for record in records:
+            address = record[11:45]
+            label = record[46:56].rstrip()
+            if address not in self.address_codes:
+                self.add_dictionary([address], [])
+            if label not in self.label_codes:
+                self.add_dictionary([], [label])
+            keys.append(int(record[:10]))
+            koinu.append(int(Decimal(record[57:75]) * self.KOINU))
+            address_codes.append(self.address_codes[address])
+            label_codes.append(self.label_codes[label])
+        dictionary = zlib.compress(json.dumps([self.addresses[known_addresses:], self.labels[known_labels:]]).encode())
+        columns = zlib.compress(b''.join(self.little_endian(column).tobytes() for column in (keys, koinu, address_codes, label_codes)))
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, len(records), keys[0], keys[-1], len(dictionary), len(columns))
+        with open(self.filename, 'ab') as f:
+            # Drop any half written block left by a crash
+            f.truncate(self.end)
+            f.write(header + dictionary + columns)
+            f.flush()
+            os.fsync(f.fileno())
+        self.blocks.append({'offset': self.end + len(header) + len(dictionary), 'rows': len(records),
+                            'min': keys[0], 'max': keys[-1], 'size': len(columns)})
+        self.end = self.blocks[-1]['offset'] + len(columns)
+
+    def scan_blocks(self, start=None, end=None):
+        ''' Yields the (key, address, label, amount) rows of every block that
+            overlaps start <= key <= end, one key ordered list per block '''
+        start = 0 if start is None else start
+        end = 9999999998 if end is None else end
+        for block in self.blocks:
+            if block['max'] < start or block['min'] > end:
+                continue
+            keys, koinu, address_codes, label_codes = self.read_block(block)
+            yield [(key, self.addresses[address], self.labels[label], Decimal(amount) / self.KOINU)
+                   for key, amount, address, label in zip(keys, koinu, address_codes, label_codes)
+                   if start <= key <= end]
+
+    def scan(self, start=None, end=None):
+        ''' Returns (key, address, label, amount) for every archived transaction
+            with start <= key <= end, in key order '''
+        rows = [row for block in self.scan_blocks(start, end) for row in block]
+        rows.sort()
+        return rows
+
+    def balances(self):
+        ''' The balance cards of the last sync by key, empty if there wasn't one '''
         try:
-            data = s.recv(8192)
-            if data:
-                total_data.append(data)
-                #change the beginning time for measurement
-                begin=time.time()
-            else:
-                #sleep for sometime to indicate a gap
-                time.sleep(0.1)
-        except:
-            pass
-    
-    doge_send = []
-    for line in total_data:
-        address = False
-        amount = False
-        if 'DOGECICS99' in line.decode():
-            logger.debug('Found DOGECICS transaction: {}'.format(line.decode()))
-            if len(line.decode().split()) == 3:
-                address = line.decode().split()[1]
-                amount = line.decode().split()[2]
-                logger.debug('Correct record entry appending {} {}'.format(address, amount))
-            doge_send.append({'address' : address, 'amount' : amount})
-    return doge_send
-    
-def send_doge(address, amount=0, host='localhost', rpcUser=None, rpcPass=None, rpcPort=22555):
-    ''' Sends amount of dogecoin to address '''
-    logger.debug('Connecting to {}:{} to send {} to {}'.format(host,rpcPort, amount, address))
+            with open(self.balances_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
 
-    try:
-        with open(path.join(path.expanduser("~"), '.dogecoin', 'dogecoin.conf'), mode='r') as f:
-            config_string = '[dogecoin]\n' + f.read()
-    except:
-        config_string = None
-    
-    config = configparser.ConfigParser()
-    config.read_string(config_string)
+    def balance_cards(self):
+        balances = self.balances()
+        if len(balances) < 2:
+            logger.warning("No balances synced in to %s yet, Available and Pending will be zero", self.filename)
+        zero = format_record_chunk([(1, 0, "Available", 0), (2, 0, "Pending", 0)]).decode('ascii').split("\n")
+        return [balances.get('0000000001', zero[0]), balances.get('0000000002', zero[1])]
 
-    if not rpcUser and 'rpcuser' in config['dogecoin']:
-        rpcUser = config['dogecoin']['rpcuser']
-            
-    if not rpcPass and 'rpcpassword' in config['dogecoin']:
-        rpcPass = config['dogecoin']['rpcpassword']
-    
-    if rpcUser is None or rpcPass is None:
-        logger.critical("rpcuser or rpcPass not in .dogecoin/dogecoin.conf and not passed to function")
-        sys.exit(-1)
+    def records(self, start=None, end=None, workers=None, budget=None, limit=None, reverse=True):
+        ''' Rebuilds a VSAM record deck from the archive without the wallet
 
-    serverURL = 'http://{user}:{passw}@{host}:{port}'.format(user=rpcUser,passw=rpcPass,host=host,port=rpcPort)
-    serverPrint = 'http://{user}:{passw}@{host}:{port}'.format(user=rpcUser,passw=('*' * len(rpcPass)),host=host,port=rpcPort)
+            Available and Pending are the wallet's balances at the last sync
+            that was archived, whatever range is rebuilt. With a budget (bytes)
+            the blocks are formatted one at a time and sorted with an
+            ExternalSorter instead of in memory. With a limit the records are
+            windowed like window_records(records, reverse, limit). '''
+        if budget:
+            with ExternalSorter(budget) as sorter:
+                for rows in self.scan_blocks(start, end):
+                    if rows:
+                        sorter.extend(format_record_chunk(rows).decode('ascii').split("\n"))
+                sorter.extend(self.balance_cards())
+                sorter.extend(format_record_chunk([(9999999999, '0', 'Control Record', 0)]).decode('ascii').split("\n"))
+                return list(sorter.merged(limit=limit, reverse=reverse))
+        rows = self.scan(start, end) + [(9999999999, '0', 'Control Record', 0)]
+        records = self.balance_cards() + format_records(rows, workers=workers).decode('ascii').split("\n")
+        if limit:
+            records = window_records(records, reverse=reverse, limit=limit)
+        return records
 
-    logger.debug("Connecting to {}".format(serverPrint))
-    
-    headers = {'content-type': 'application/json'}
+def load_ledger(folder=None):
+    ''' Loads the locally held transactions for report/query as columns
 
-    logger.debug("Sending {} to {}".format(amount, address))
-    try:
-        payload = json.dumps({"method": 'sendtoaddress', "params": [address, amount], "jsonrpc": "1.0"})
-        reply = requests.post(serverURL, headers=headers, data=payload, timeout=10).json()
-        r = reply['result']
-    except ValueError:
-        logger.critical("Invalid Logon using {}".format(serverURL))
-        sys.exit(-1)
-    except requests.exceptions.ConnectTimeout:
-        logger.critical("Could not connect to {}".format(serverURL))
-        sys.exit(-1)
-    logger.debug("Reply from dogecoin wallet: {}".format(r))
+        Uses the archive (everything ever seen) if there is one, otherwise the
+        snapshot or tmp file (what was last sent to VSAM). Returns a dict of
+        key, koinu, label and address code arrays, the label and address
+        dictionaries and where it came from. '''
+    folder = folder or running_folder
+    archive = path.join(folder, archive_file)
+    if os.path.isfile(archive):
+        archive = RecordArchive(archive)
+        columns = [array(typecode) for typecode in 'qqII']
+        for block in archive.blocks:
+            for column, data in zip(columns, archive.read_block(block)):
+                column.extend(data)
+        keys, koinu, labels, addresses = columns[0], columns[1], columns[3], columns[2]
+        return {'keys': keys, 'koinu': koinu, 'labels': labels, 'addresses': addresses,
+                'label_names': archive.labels, 'address_names': archive.addresses, 'source': archive.filename}
 
-# Create a default logger for when module is imported
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.WARNING)
-logger_formatter = logging.Formatter('%(levelname)-8s :: %(funcName)-22s :: %(message)s')
-ch = logging.StreamHandler()
-ch.setFormatter(logger_formatter)
-ch.setLevel(logging.WARNING)
-logger.addHandler(ch)
+    snapshot = load_snapshot(path.join(folder, snapshot_file))
+    if snapshot is not None:
+        with snapshot:
+            records = snapshot.records()
+        source = snapshot.filename
+    elif os.path.isfile(path.join(folder, tmp_file)):
+        with open(path.join(folder, tmp_file), 'r') as f:
+            records = f.read().split('\n')
+        source = path.join(folder, tmp_file)
+    else:
+        raise IOError("No {}, {} or {} in {} to report on".format(archive_file, snapshot_file, tmp_file, folder))
 
-def main():
-    """Main function for running the script"""
-    desc = '''DOGEdcams data generator for DOGE Bank. Used to send and receive funds between KICKS on TK4- and DogeCICS.'''
+    ledger = {'keys': array('q'), 'koinu': array('q'), 'labels': array('I'), 'addresses': array('I'),
+              'label_names': [], 'address_names': [], 'source': source}
+    label_codes = {}
+    address_codes = {}
+    for record in records:
+        if len(record) < 75 or reserved_key(record[:10]) or record[:10] == '9999999999':
+            continue
+        label = record[46:56].rstrip()
+        address = record[11:45]
+        if label not in label_codes:
+            label_codes[label] = len(ledger['label_names'])
+            ledger['label_names'].append(label)
+        if address not in address_codes:
+            address_codes[address] = len(ledger['address_names'])
+            ledger['address_names'].append(address)
+        ledger['keys'].append(int(record[:10]))
+        ledger['koinu'].append(int(Decimal(record[57:75]) * RecordArchive.KOINU))
+        ledger['labels'].append(label_codes[label])
+        ledger['addresses'].append(address_codes[address])
+    return ledger
+
+def utc_day(date, end=False):
+    ''' --since/--until YYYY-MM-DD as a UTC time stamp, the last second of the day if end '''
+    return calendar.timegm(time.strptime(date, '%Y-%m-%d')) + (86399 if end else 0)
+
+def koinu_to_doge(koinu):
+    return '{}{}.{:08d}'.format('-' if koinu < 0 else '', abs(koinu) // 100000000, abs(koinu) % 100000000)
+
+def periods(keys, period):
+    ''' The day (YYYY-MM-DD) or month (YYYY-MM) of every key, in UTC. With numpy
+        they're datetime64 day/month numbers, turned in to names by period_name '''
+    if numpy is not None:
+        unit = 'datetime64[D]' if period == 'day' else 'datetime64[M]'
+        return keys.astype('datetime64[s]').astype(unit).astype('int64')
+    width = 10 if period == 'day' else 7
+    names = {}
+    groups = []
+    for key in keys:
+        day = key // 86400
+        if day not in names:
+            names[day] = datetime.datetime.fromtimestamp(day * 86400, datetime.timezone.utc).strftime('%Y-%m-%d')[:width]
+        groups.append(names[day])
+    return groups
+
+def period_name(group, period):
+    if numpy is not None:
+        return str(numpy.datetime64(group, 'D' if period == 'day' else 'M'))
+    return group
+
+def group_sums(groups, koinu):
+    ''' Per group transaction count, received, sent and net in koinu
+
+        With numpy it's a stable argsort on the group followed by reduceat over
+        each run of the same group, all int64 so the sums are exact. '''
+    if numpy is not None:
+        groups = numpy.asarray(groups)
+        koinu = numpy.asarray(koinu, dtype='int64')
+        if not len(koinu):
+            return []
+        order = numpy.argsort(groups, kind='stable')
+        groups = groups[order]
+        koinu = koinu[order]
+        starts = numpy.flatnonzero(numpy.concatenate(([True], groups[1:] != groups[:-1])))
+        counts = numpy.diff(numpy.append(starts, len(koinu)))
+        received = numpy.add.reduceat(numpy.where(koinu > 0, koinu, 0), starts)
+        sent = numpy.add.reduceat(numpy.where(koinu < 0, koinu, 0), starts)
+        return [(group.item(), int(count), int(r), int(s), int(r + s))
+                for group, count, r, s in zip(groups[starts], counts, received, sent)]
+    totals = {}
+    for group, amount in zip(groups, koinu):
+        total = totals.setdefault(group, [0, 0, 0])
+        total[0] += 1
+        total[1 if amount > 0 else 2] += amount
+    return [(group, count, r, s, r + s) for group, (count, r, s) in sorted(totals.items())]
+
+def report(ledger, kind='monthly', period='month', since=None, until=None, label=None, address=None):
+    ''' Works out a report over the ledger, returns its column names and rows
+
+        * balance: the balance at the end of every day/month
+        * labels: count, received, sent and net per label
+        * monthly: count, received, sent and net per day/month '''
+    keys, koinu, labels, addresses = ledger['keys'], ledger['koinu'], ledger['labels'], ledger['addresses']
+    label_code = ledger['label_names'].index(label) if label in ledger['label_names'] else -1
+    address_code = ledger['address_names'].index(address) if address in ledger['address_names'] else -1
+    filtered = since is not None or until is not None or label or address
+
+    if numpy is not None:
+        # The typed arrays are shared with numpy, not copied
+        keys = numpy.frombuffer(keys, dtype='int64')
+        koinu = numpy.frombuffer(koinu, dtype='int64')
+        labels = numpy.frombuffer(labels, dtype='uint32')
+        addresses = numpy.frombuffer(addresses, dtype='uint32')
+        if filtered:
+            wanted = numpy.ones(len(keys), dtype=bool)
+            if since is not None:
+                wanted &= keys >= since
+            if until is not None:
+                wanted &= keys <= until
+            if label:
+                wanted &= labels == label_code
+            if address:
+                wanted &= addresses == address_code
+            keys, koinu, labels = keys[wanted], koinu[wanted], labels[wanted]
+    elif filtered:
+        wanted = [i for i, key in enumerate(keys)
+                  if (since is None or key >= since) and (until is None or key <= until)
+                  and (not label or labels[i] == label_code) and (not address or addresses[i] == address_code)]
+        keys = [keys[i] for i in wanted]
+        koinu = [koinu[i] for i in wanted]
+        labels = [labels[i] for i in wanted]
+
+    if kind == 'labels':
+        return ['label', 'count', 'received', 'sent', 'net'], [
+            (ledger['label_names'][group], count, koinu_to_doge(r), koinu_to_doge(s), koinu_to_doge(n))
+            for group, count, r, s, n in sorted(group_sums(labels, koinu), key=lambda row: ledger['label_names'][row[0]])]
+
+    rows = [(period_name(group, period), count, r, s, n) for group, count, r, s, n in group_sums(periods(keys, period), koinu)]
+    if kind == 'balance':
+        balance = 0
+        balances = []
+        for group, count, r, s, n in rows:
+            balance += n
+            balances.append((group, count, koinu_to_doge(n), koinu_to_doge(balance)))
+        return [period, 'count', 'change', 'balance'], balances
+    return [period, 'count', 'received', 'sent', 'net'], [
+        (group, count, koinu_to_doge(r), koinu_to_doge(s), koinu_to_doge(n)) for group, count, r, s, n in rows]
+
+def write_report(columns, rows, output='text', stream=None):
+    stream = stream or sys.stdout
+    if output == 'json':
+        json.dump([dict(zip(columns, row)) for row in rows], stream, indent=1)
+        stream.write('\n')
+    elif output == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    else:
+        widths = [max([len(str(column))] + [len(str(row[i])) for row in rows]) for i, column in enumerate(columns)]
+        stream.write('  '.join(str(column).ljust(width) for column, width in zip(columns, widths)).rstrip() + '\n')
+        for row in rows:
+            stream.write('  '.join(str(value).rjust(width) if i else str(value).ljust(width)
+                                   for i, (value, width) in enumerate(zip(row, widths))).rstrip() + '\n')
+
+def report_main(argv):
+    ''' dogedcams.py report|query: reports over the locally held records, never
+        calls the wallet or the mainframe '''
+    arg_parser = argparse.ArgumentParser(prog='dogedcams.py report', description="Reports over the transactions held locally (doge.archive, doge.snap or doge.tmp). Makes no wallet or mainframe calls.",
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    arg_parser.add_argument('kind', help="balance: balance over time, labels: totals per label, monthly: sent vs received per period", choices=['balance', 'labels', 'monthly'], nargs='?', default='monthly')
+    arg_parser.add_argument('--period', help="Group balance and monthly reports by", choices=['day', 'month'], default='month')
+    arg_parser.add_argument('--output', help="Output format", choices=['text', 'csv', 'json'], default='text')
+    arg_parser.add_argument('--since', help="Only transactions from this date (YYYY-MM-DD)", default=None)
+    arg_parser.add_argument('--until', help="Only transactions up to and including this date (YYYY-MM-DD)", default=None)
+    arg_parser.add_argument('--label', help="Only transactions with this label", default=None)
+    arg_parser.add_argument('--address', help="Only transactions with this address", default=None)
+    arg_parser.add_argument('--folder', help="Folder holding the local records (e.g. doge.profiles/<name>)", default=running_folder)
+    args = arg_parser.parse_args(argv)
+
+    # Reports are in UTC
+    since = until = None
+    if args.since:
+        since = utc_day(args.since)
+    if args.until:
+        until = utc_day(args.until, end=True)
+    try:
+        ledger = load_ledger(args.folder)
+    except IOError as e:
+        logger.critical(e)
+        sys.exit(-1)
+    logger.debug("Reporting on %s transactions from %s (numpy: %s)", len(ledger['keys']), ledger['source'], numpy is not None)
+    columns, rows = report(ledger, args.kind, period=args.period, since=since, until=until, label=args.label, address=args.address)
+    write_report(columns, rows, output=args.output)
+
+class KSDS(object):
+    ''' Emulates a key sequenced cluster loaded by REPRO, to count what the
+        KICKS programs' file requests cost without a tk4-
+
+        Cards go in to data CIs in key order. A CI holds (ci_size - 16) //
+        record_size records (the CIDF and a pair of RDFs take 16 bytes) less
+        ci_free percent, and a control area has cis_per_ca CIs of which
+        ca_free percent are left empty. The sequence set has an index CI per
+        control area and every index set level above it index_entries entries
+        per CI, up to one root. Data and index CIs go through LRU pools of
+        buffers and index_buffers CIs (BUFND/BUFNI), a CI that isn't in its
+        pool is an I/O. The defaults are a 4K CI and a track of them per
+        control area, set them from the LISTCAT the DOGEVSM job prints.
+
+        Browses work like CICS: READNEXT after STARTBR/RESETBR returns the
+        record at the start key (or the next one up), READPREV after STARTBR
+        needs the start key to exist and changing direction returns the same
+        record again. Every request adds to stats: requests, index_io and
+        data_io, ci_moves and ca_moves for browsing across CI and control area
+        boundaries, and compares (key compares in index and data CIs) for the
+        CPU. '''
+    COUNTERS = ('requests', 'index_io', 'data_io', 'ci_moves', 'ca_moves', 'compares')
+
+    def __init__(self, records, ci_size=4096, cis_per_ca=12, ci_free=0, ca_free=0, index_entries=64,
+                 buffers=2, index_buffers=1, record_size=80):
+        self.records = sorted(records, key=lambda record: record[:10])
+        self.keys = [record[:10] for record in self.records]
+        per_ci = max((ci_size - 16) // record_size, 1)
+        self.per_ci = max(per_ci - per_ci * ci_free // 100, 1)
+        self.per_ca = max(cis_per_ca - cis_per_ca * ca_free // 100, 1)
+        self.cis_per_ca = cis_per_ca
+        self.index_entries = max(index_entries, 2)
+        self.buffers = max(buffers, 1)
+        self.index_buffers = max(index_buffers, 1)
+        self.data_cis = max((len(self.keys) + self.per_ci - 1) // self.per_ci, 1)
+        # Index CIs on each level, the sequence set (level 0) has one per control area
+        self.widths = [(self.data_cis + self.per_ca - 1) // self.per_ca]
+        while self.widths[-1] > 1:
+            self.widths.append((self.widths[-1] + self.index_entries - 1) // self.index_entries)
+        self.data_pool = OrderedDict()
+        self.index_pool = OrderedDict()
+        self.stats = dict.fromkeys(self.COUNTERS, 0)
+        self.browsing = False
+        self.position = 0
+        self.direction = None
+        self.start = None
+
+    def describe(self):
+        return "{} records, {} per CI, {} CIs in {} control areas, {} index levels".format(
+            len(self.keys), self.per_ci, self.data_cis, self.widths[0], len(self.widths))
+
+    def flush(self):
+        ''' Empties the buffer pools, the next request starts cold '''
+        self.data_pool.clear()
+        self.index_pool.clear()
+
+    def reset(self):
+        ''' Returns the stats so far and starts counting again '''
+        stats, self.stats = self.stats, dict.fromkeys(self.COUNTERS, 0)
+        return stats
+
+    def ci(self, position):
+        ''' Data CI and control area of the record at position '''
+        n = position // self.per_ci
+        return n // self.per_ca * self.cis_per_ca + n % self.per_ca, n // self.per_ca
+
+    def fetch(self, pool, size, ci, counter):
+        if ci in pool:
+            pool.move_to_end(ci)
+            return
+        self.stats[counter] += 1
+        pool[ci] = True
+        if len(pool) > size:
+            pool.popitem(last=False)
+
+    def search(self, key):
+        ''' Goes down the index from the root to the data CI for key, returns
+            the position of the first record with a key at or after it '''
+        position = bisect_left(self.keys, key)
+        last = min(position, len(self.keys) - 1)
+        ci, ca = self.ci(max(last, 0))
+        for level in reversed(range(len(self.widths))):
+            number = ca // self.index_entries ** level
+            if level:
+                entries = min(self.index_entries, self.widths[level - 1] - number * self.index_entries)
+            else:
+                entries = min(self.per_ca, self.data_cis - number * self.per_ca)
+            # Binary search of the entries in the index CI
+            self.stats['compares'] += max(entries, 1).bit_length()
+            self.fetch(self.index_pool, self.index_buffers, (level, number), 'index_io')
+        self.fetch(self.data_pool, self.buffers, ci, 'data_io')
+        # A data CI is searched from its first record
+        self.stats['compares'] += last - last // self.per_ci * self.per_ci + 1
+        return position
+
+    def step(self, position):
+        ''' Moves the browse to the record at position, crossing in to the next
+            control area reads its sequence set CI '''
+        if not 0 <= position < len(self.keys):
+            raise CICSCondition('ENDFILE')
+        ci, ca = self.ci(position)
+        current, current_ca = self.ci(self.position)
+        if ci != current:
+            self.stats['ci_moves'] += 1
+        if ca != current_ca:
+            self.stats['ca_moves'] += 1
+            self.fetch(self.index_pool, self.index_buffers, (0, ca), 'index_io')
+        self.fetch(self.data_pool, self.buffers, ci, 'data_io')
+        self.stats['compares'] += 1
+        self.position = position
+        return self.records[position]
+
+    def read(self, key):
+        ''' EXEC CICS READ RIDFLD(key) '''
+        self.stats['requests'] += 1
+        position = self.search(key)
+        if position == len(self.keys) or self.keys[position] != key:
+            raise CICSCondition('NOTFND', key)
+        return self.records[position]
+
+    def startbr(self, key, equal=False):
+        ''' EXEC CICS STARTBR RIDFLD(key), GTEQ unless equal '''
+        self.stats['requests'] += 1
+        if self.browsing:
+            raise CICSCondition('INVREQ', key)
+        self.position = self.search(key)
+        if self.position == len(self.keys) or equal and self.keys[self.position] != key:
+            self.position = 0
+            raise CICSCondition('NOTFND', key)
+        self.browsing = True
+        self.direction = None
+        self.start = key
+
+    def resetbr(self, key, equal=False):
+        ''' EXEC CICS RESETBR RIDFLD(key) '''
+        if not self.browsing:
+            self.stats['requests'] += 1
+            raise CICSCondition('INVREQ', key)
+        self.browsing = False
+        self.startbr(key, equal)
+
+    def readnext(self):
+        ''' EXEC CICS READNEXT '''
+        self.stats['requests'] += 1
+        if not self.browsing:
+            raise CICSCondition('INVREQ')
+        position = self.position + (self.direction == 'next')
+        self.direction = 'next'
+        return self.step(position)
+
+    def readprev(self):
+        ''' EXEC CICS READPREV '''
+        self.stats['requests'] += 1
+        if not self.browsing:
+            raise CICSCondition('INVREQ')
+        if self.direction is None and self.keys[self.position] != self.start:
+            raise CICSCondition('NOTFND', self.start)
+        position = self.position - (self.direction == 'prev')
+        self.direction = 'prev'
+        return self.step(position)
+
+    def endbr(self):
+        ''' EXEC CICS ENDBR '''
+        self.stats['requests'] += 1
+        if not self.browsing:
+            raise CICSCondition('INVREQ')
+        self.browsing = False
+
+def dogemain_screen(vsam, summary=True):
+    ''' DOGE-MAIN-SCREEN: keyed READs of the three summary records, or without
+        them the original browse back from 9999999999 then RESETBR to the
+        balances '''
+    if summary:
+        for key in ('0000000003', '0000000004', '0000000005'):
+            vsam.read(key)
+        return
+    vsam.startbr('9999999999')
+    for _ in range(3):
+        vsam.readprev()
+    vsam.resetbr('0000000001')
+    vsam.readnext()
+    vsam.readnext()
+    vsam.endbr()
+
+def dogetran_page(vsam, directory, page):
+    ''' FIND-PAGE, LET-ER-RIP and DOGE-LIST-TRANSACTIONS: READs the page
+        anchor from the directory and browses 7 transactions from its key.
+        Returns the number of pages '''
+    anchor = directory.read('{:010d}'.format(page))
+    vsam.startbr(anchor[11:21])
+    for _ in range(7):
+        if vsam.readnext()[:10] == '9999999999':
+            break
+    vsam.endbr()
+    return int(anchor[22:27])
+
+def dogetran_browse(vsam, start, back=False):
+    ''' The DOGETRAN before the page directory: STARTBR on the last key shown,
+        BACK-IT-UP 15 TIMES for PF7, skip a record and list 7. Returns the
+        last key read, the next screen starts from it '''
+    vsam.startbr(start)
+    if back:
+        for _ in range(15):
+            if start != '0000000002':
+                start = vsam.readprev()[:10]
+    start = vsam.readnext()[:10]
+    for _ in range(7):
+        start = vsam.readnext()[:10]
+        if start == '9999999999':
+            break
+    vsam.endbr()
+    return start
+
+def dogedeet_screen(vsam, key, direction=None):
+    ''' DOGE-START-BROWSE and DOGE-SHOW-TRANSACTION for ENTER (None), PF8 ('F')
+        or PF7 ('B'). Returns the key shown, None for BAD-KEY '''
+    try:
+        vsam.startbr(key, equal=True)
+    except CICSCondition:
+        return None
+    if not reserved_key(key):
+        read = vsam.readprev if direction == 'B' else vsam.readnext
+        for _ in range(2 if direction else 1):
+            key = read()[:10]
+    # DOGEDEET has no ENDBR, the browse ends with the task
+    vsam.browsing = False
+    return None if reserved_key(key) else key
+
+def emulate_screens(vsam, directory=None, summary=True, screens=3, warm=False):
+    ''' Replays a session of each KICKS program against vsam, and the DOGEPAGE
+        directory if there is one: the DOGEMAIN dashboard, DOGETRAN's first
+        page then up to screens PF8s and as many PF7s, and DOGEDEET on the
+        first transaction then up to screens PF8s and PF7s. The buffers are
+        emptied before every screen unless warm. Returns a (program, screen,
+        counters...) row per screen '''
+    files = [f for f in (vsam, directory) if f is not None]
+    rows = []
+
+    def screen(program, name, request, *args):
+        for f in files:
+            if not warm:
+                f.flush()
+            f.reset()
+        result = request(*args)
+        rows.append((program, name) + tuple(sum(f.stats[counter] for f in files) for counter in KSDS.COUNTERS))
+        return result
+
+    screen('DOGEMAIN', 'dashboard', dogemain_screen, vsam, summary)
+
+    page = 1
+    if directory is not None:
+        pages = screen('DOGETRAN', 'page 1', dogetran_page, vsam, directory, page)
+        for _ in range(screens):
+            if page == pages:
+                break
+            page += 1
+            screen('DOGETRAN', 'PF8 page {}'.format(page), dogetran_page, vsam, directory, page)
+        for _ in range(screens):
+            if page == 1:
+                break
+            page -= 1
+            screen('DOGETRAN', 'PF7 page {}'.format(page), dogetran_page, vsam, directory, page)
+    else:
+        start = screen('DOGETRAN', 'page 1', dogetran_browse, vsam, '0000000002')
+        for _ in range(screens):
+            if start == '9999999999':
+                break
+            page += 1
+            start = screen('DOGETRAN', 'PF8 page {}'.format(page), dogetran_browse, vsam, start)
+        for _ in range(screens):
+            if page == 1:
+                break
+            page -= 1
+            start = screen('DOGETRAN', 'PF7 page {}'.format(page), dogetran_browse, vsam, start, True)
+
+    shown = next((key for key in vsam.keys if not reserved_key(key)), None)
+    if shown is not None:
+        screen('DOGEDEET', 'ENTER', dogedeet_screen, vsam, shown)
+        for name, direction in (('PF8', 'F'), ('PF7', 'B')):
+            for _ in range(screens):
+                key = screen('DOGEDEET', name, dogedeet_screen, vsam, shown, direction)
+                if key is None:
+                    break
+                shown = key
+    return rows
+
+def emulate(records, summary=True, page_directory=True, reverse=True, screens=3, warm=False, **geometry):
+    ''' Lays records out like generate_IDCAMS_JCL does DOGE.VSAM and
+        DOGE.VSAM.PAGES, loads them in to KSDSs with geometry and replays
+        emulate_screens. Returns the DOGE.VSAM KSDS and the rows '''
+    if summary:
+        records = window_records(records, reverse=reverse, limit=7645)
+        records = records + generate_summary_records(records)
+    else:
+        records = window_records(records, reverse=reverse)
+    vsam = KSDS(records, **geometry)
+    directory = KSDS(generate_page_directory(records), **geometry) if page_directory else None
+    return vsam, emulate_screens(vsam, directory, summary=summary, screens=screens, warm=warm)
+
+def emulate_main(argv):
+    ''' dogedcams.py emulate: replays the KICKS programs' file requests against
+        an emulated DOGE.VSAM, never calls the wallet or the mainframe '''
+    arg_parser = argparse.ArgumentParser(prog='dogedcams.py emulate', description="Loads the records (doge.snap or doge.tmp, or --fake) in to an emulated DOGE.VSAM and replays DOGEMAIN, DOGETRAN and DOGEDEET screens against it, counting the file requests, CI I/O and key compares for each screen. Makes no wallet or mainframe calls.",
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    arg_parser.add_argument('--fake', help="Emulate with this many fake records instead of the local records", type=int, default=None)
+    arg_parser.add_argument('--folder', help="Folder holding the local records (e.g. doge.profiles/<name>)", default=running_folder)
+    arg_parser.add_argument('--no-summary', help="Without the DOGEMAIN summary records, replays the old DOGEMAIN", action="store_false", dest="summary")
+    arg_parser.add_argument('--no-page-directory', help="Without the page directory, replays the old DOGETRAN", action="store_false", dest="page_directory")
+    arg_parser.add_argument('--baseline', help="Also replay the original layout (no summary records or page directory) to compare against", action="store_true")
+    arg_parser.add_argument('--start-records-at-one', help="Keep the first 7,648 records rather than the most recent", action="store_false")
+    arg_parser.add_argument('--ci-size', help="Data CI size (LISTCAT CISIZE)", type=int, default=4096)
+    arg_parser.add_argument('--cis-per-ca', help="CIs per control area (LISTCAT CI/CA)", type=int, default=12)
+    arg_parser.add_argument('--ci-free', help="Percent of each CI left free at load (FREESPACE)", type=int, default=0)
+    arg_parser.add_argument('--ca-free', help="Percent of each control area's CIs left free at load (FREESPACE)", type=int, default=0)
+    arg_parser.add_argument('--index-entries', help="Entries per index set CI", type=int, default=64)
+    arg_parser.add_argument('--buffers', help="Data buffers (BUFND)", type=int, default=2)
+    arg_parser.add_argument('--index-buffers', help="Index buffers (BUFNI)", type=int, default=1)
+    arg_parser.add_argument('--screens', help="PF8 and PF7 presses in DOGETRAN and DOGEDEET", type=int, default=3)
+    arg_parser.add_argument('--warm', help="Keep the buffers between screens instead of starting each one cold", action="store_true")
+    arg_parser.add_argument('--output', help="Output format", choices=['text', 'csv', 'json'], default='text')
+    args = arg_parser.parse_args(argv)
+
+    if args.fake:
+        records = generate_fake_records(args.fake)
+    else:
+        snapshot = load_snapshot(path.join(args.folder, snapshot_file))
+        if snapshot is not None:
+            with snapshot:
+                records = snapshot.records()
+        elif os.path.isfile(path.join(args.folder, tmp_file)):
+            with open(path.join(args.folder, tmp_file), 'r') as records_file:
+                records = records_file.read().split('\n')
+        else:
+            logger.critical("No %s or %s in %s to emulate, use --fake", snapshot_file, tmp_file, args.folder)
+            sys.exit(-1)
+
+    geometry = {'ci_size': args.ci_size, 'cis_per_ca': args.cis_per_ca, 'ci_free': args.ci_free, 'ca_free': args.ca_free,
+                'index_entries': args.index_entries, 'buffers': args.buffers, 'index_buffers': args.index_buffers}
+    layouts = [(args.summary, args.page_directory)]
+    if args.baseline and layouts[0] != (False, False):
+        layouts.append((False, False))
+
+    rows = []
+    for summary, page_directory in layouts:
+        layout = '+'.join(name for name, used in (('summary', summary), ('pages', page_directory)) if used) or 'browse'
+        vsam, screens = emulate(records, summary=summary, page_directory=page_directory, reverse=args.start_records_at_one,
+                                screens=args.screens, warm=args.warm, **geometry)
+        if args.output == 'text':
+            print("{}: {}".format(layout, vsam.describe()))
+        rows += [(layout,) + row for row in screens]
+        rows.append((layout, 'total', '') + tuple(sum(column) for column in list(zip(*screens))[2:]))
+    write_report(('layout', 'program', 'screen') + KSDS.COUNTERS, rows, output=args.output)
+
+class RecordSnapshot(object):
+    ''' Fixed width, memory mapped copy of the last uploaded records
+
+        The file is one 80 byte header card followed by the records as sorted
+        80 byte cards (no newlines). The header holds the record count and a
+        SHA-1 of the cards, so "did the wallet change" is a digest compare and
+        key lookups are a binary search over the mapped file, nothing is read
+        in full. Written to a temp file and renamed so a crash never leaves
+        half a snapshot behind. '''
+
+    CARD = 80
+    MAGIC = b'DOGESNAP'
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        try:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # mmap refuses empty files
+            self.file.close()
+            raise ValueError("{} is empty".format(filename))
+        header = self.buffer[:self.CARD].split()
+        if len(header) != 4 or header[0] != self.MAGIC or int(header[1]) != self.VERSION:
+            self.close()
+            raise ValueError("{} is not a DOGE record snapshot".format(filename))
+        self.count = int(header[2])
+        self.digest = header[3].decode('ascii')
+        if len(self.buffer) != self.CARD * (self.count + 1):
+            self.close()
+            raise ValueError("{} is truncated".format(filename))
+
+    @classmethod
+    def cards(cls, records):
+        ''' Returns the sorted records as one run of 80 byte cards '''
+        return b''.join(record.encode('ascii', 'replace').ljust(cls.CARD) for record in sorted(records))
+
+    @classmethod
+    def write(cls, filename, records):
+        ''' Atomically replaces filename with a snapshot of records '''
+        cards = cls.cards(records)
+        header = '{} {:02d} {:010d} {}'.format(cls.MAGIC.decode('ascii'), cls.VERSION, len(cards) // cls.CARD, hashlib.sha1(cards).hexdigest())
+        temp = '{}.tmp'.format(filename)
+        with open(temp, 'wb') as f:
+            f.write(header.encode('ascii').ljust(cls.CARD))
+            f.write(cards)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, filename)
+
+    def close(self):
+        if getattr(self, 'buffer', None) is not None:
+            self.buffer.close()
+            self.buffer = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def record(self, index):
+        ''' Returns record number index (0 based, negative counts from the end) '''
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        offset = self.CARD * (index + 1)
+        return self.buffer[offset:offset + self.CARD].decode('ascii').rstrip()
+
+    def _key(self, index):
+        offset = self.CARD * (index + 1)
+        return self.buffer[offset:offset + 10]
+
+    def find(self, key):
+        ''' Binary search for key, returns its index or None '''
+        key = '{:010d}'.format(int(key)).encode('ascii')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._key(low) == key:
+            return low
+        return None
+
+    def get(self, key):
+        ''' Returns the record for key or None '''
+        index = self.find(key)
+        return None if index is None else self.record(index)
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def records(self, start=0, stop=None):
+        ''' Returns records[start:stop], only the cards in that range are touched '''
+        start, stop, step = slice(start, stop).indices(self.count)
+        cards = self.buffer[self.CARD * (start + 1):self.CARD * (stop + 1)]
+        return [cards[i:i + self.CARD].decode('ascii').rstrip() for i in range(0, len(cards), self.CARD)]
+
+    def tail(self, limit=7648):
+        ''' Returns the last limit records '''
+        return self.records(max(self.count - limit, 0))
+
+    def matches(self, records):
+        ''' True if records are the same as the ones in the snapshot '''
+        return len(records) == self.count and hashlib.sha1(self.cards(records)).hexdigest() == self.digest
+
+    def verify(self):
+        ''' Checks the cards against the header digest (this one does read everything) '''
+        return hashlib.sha1(self.buffer[self.CARD:]).hexdigest() == self.digest
+
+def load_snapshot(filename):
+    ''' Opens the snapshot in filename, None if there isn't a usable one '''
+    if not os.path.isfile(filename):
+        return None
+    try:
+        return RecordSnapshot(filename)
+    except (IOError, ValueError) as e:
+        logger.warning("Ignoring record snapshot: %s", e)
+        return None
+
+# DOGEMAIN/DOGESEND spool DOGEMSG as 'DOGECICS99' X(34) ZZ,ZZZ,ZZ9.99999999 and the
+# submission queue marker job prints 'DOGEVSAM99 <token>'. Only lines with either
+# eyecatcher are pulled out of the spool, then matched against the record layout.
+PRINTER_LINE = re.compile(rb'DOGE(?:CICS|VSAM)99[^\r\n\f]*')
+DOGECICS99_RECORD = re.compile(rb'DOGECICS99 +(\S{1,34}) +([0-9][0-9,]*\.[0-9]{1,8}) *$')
+DOGEVSAM99_RECORD = re.compile(rb'DOGEVSAM99 +(\S+)')
+
+class PrinterParser(object):
+    ''' Incremental parser for the sockdev printer byte stream
+
+        Bytes are fed in as they arrive from recv and only complete lines (ended
+        by CR, LF or form feed) are parsed, a record split across two recv calls
+        is kept until the rest of it arrives. Yields {'address', 'amount'} for
+        DOGECICS99 send requests (both False if the line is malformed, same as
+        before) and {'done': token} for DOGEVSAM99 job markers. '''
+
+    def __init__(self, log=None):
+        self.buffer = bytearray()
+        self.log = log or logger
+
+    def feed(self, data):
+        self.buffer += data
+        eol = max(self.buffer.rfind(b'\n'), self.buffer.rfind(b'\r'), self.buffer.rfind(b'\f')) + 1
+        if not eol:
+            return
+        block = bytes(self.buffer[:eol])
+        del self.buffer[:eol]
+        for command in self.parse(block):
+            yield command
+
+    def close(self):
+        ''' Parses whatever is left over once the printer stops sending '''
+        block = bytes(self.buffer)
+        self.buffer = bytearray()
+        for command in self.parse(block):
+            yield command
+
+    def parse(self, block):
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        for line in PRINTER_LINE.finditer(block):
+            line = line.group()
+            if line.startswith(b'DOGEVSAM99'):
+                done = DOGEVSAM99_RECORD.match(line)
+                if done:
+                    self.log.debug('Found finished VSAM job: %s', done.group(1).decode())
+                    yield {'done': done.group(1).decode()}
+                continue
+            if debug:
+                self.log.debug('Found DOGECICS transaction: %s', line.decode(errors='replace'))
+            record = DOGECICS99_RECORD.match(line)
+            if record:
+                address = record.group(1).decode()
+                amount = record.group(2).decode()
+                self.log.debug('Correct record entry appending %s %s', address, amount)
+                yield {'address' : address, 'amount' : amount}
+            else:
+                yield {'address' : False, 'amount' : False}
+
+def get_commands(timeout=2, hostname='localhost', port=3506, done_jobs=None, traffic=None, log=None):
+# From https://www.binarytides.com/receive-full-data-with-the-recv-socket-function-in-python/
+    log = log or logger
+    log.debug('Connecting to tk4- printer %s:%s to get transactions.', hostname, port)
+    if traffic:
+        s = traffic.printer(hostname, port)
+    else:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((hostname,port))
+    s.setblocking(0)
+
+    parser = PrinterParser(log=log)
+    doge_send = []
+    received = False
+    data=''
+    begin=time.time()
+
+    def collect(commands):
+        for command in commands:
+            if 'done' in command:
+                if done_jobs is not None:
+                    done_jobs.append(command['done'])
+            else:
+                doge_send.append(command)
+
+    while 1:
+        if received and time.time()-begin > timeout:
+            break
+        elif time.time()-begin > timeout*2:
+            break
+        
+        try:
+            data = s.recv(65536)
+            if data:
+                received = True
+                collect(parser.feed(data))
+                #change the beginning time for measurement
+                begin=time.time()
+            else:
+                # The printer closed the connection, nothing more is coming
+                break
+        except:
+            # Nothing waiting on the non blocking socket, don't spin
+            time.sleep(0.01)
+    s.close()
+    collect(parser.close())
+    return doge_send
+    
+def send_doge(address, amount=0, host='localhost', rpcUser=None, rpcPass=None, rpcPort=22555, timeout=10, traffic=None, log=None):
+    ''' Sends amount of dogecoin to address, raises RPCError if it wasn't sent
+
+        A send is never retried, one that timed out may have gone through. '''
+    log = log or logger
+    log.debug('Connecting to %s:%s to send %s to %s', host, rpcPort, amount, address)
+
+    server = rpc_server(host=host, rpcUser=rpcUser, rpcPass=rpcPass, rpcPort=rpcPort)
+    log.debug("Connecting to %s", server[1])
+
+    log.debug("Sending %s to %s", amount, address)
+    r = rpc_call(server, 'sendtoaddress', [address, amount], timeout=timeout, retry=False, traffic=traffic, log=log)
+    log.debug("Reply from dogecoin wallet: %s", r)
+    return r
+
+def send_amount(amount):
+    ''' Converts a DOGESEND amount as printed (1,234.5) to what sendtoaddress takes '''
+    return str(Decimal(float(amount.replace(',',''))).quantize(Decimal('1.00000000')))
+
+class Capture(object):
+    ''' --capture: records the wallet, reader and printer traffic of a run
+
+        Every wallet call (the JSON-RPC request, the reply or the error and
+        how long it took), every job sent to a reader and every block of
+        bytes read from the printer is appended, with the time it happened,
+        as a JSON line to a gzip file Replay can play back. The RPC password
+        isn't in any of it, the JCL's TK4- password is. '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = gzip.open(filename, 'at')
+        self.began = time.time()
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.write({'kind': 'start', 'time': self.began})
+
+    def write(self, event):
+        with self.lock:
+            self.file.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+    def call(self, event, call):
+        ''' Runs call and writes event with when it ran, how long it took and
+            the error it raised, if any '''
+        begin = time.time()
+        event['t'] = round(begin - self.began, 6)
+        try:
+            return call()
+        except (OSError, ValueError) as e:
+            # A reply that isn't JSON is replayed as a ValueError, whatever
+            # requests called it
+            event['error'] = 'ValueError' if isinstance(e, ValueError) else type(e).__name__
+            event['message'] = str(e)
+            raise
+        finally:
+            event['elapsed'] = round(time.time() - begin, 6)
+            self.write(event)
+
+    def rpc(self, payload, post):
+        event = {'kind': 'rpc', 'request': payload}
+
+        def call():
+            event['reply'] = post()
+            return event['reply']
+        return self.call(event, call)
+
+    def reader(self, target, jcl, send):
+        return self.call({'kind': 'reader', 'target': target, 'jcl': jcl.decode('ascii', 'replace')}, send)
+
+    def printer(self, hostname, port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((hostname,port))
+        with self.lock:
+            self.sessions += 1
+            session = self.sessions
+        return CapturedPrinter(self, s, session)
+
+    def close(self):
+        self.file.close()
+        return "Capture written to {}".format(self.filename)
+
+class CapturedPrinter(object):
+    ''' The printer socket of a Capture, records what's read from it '''
+
+    def __init__(self, capture, sock, session):
+        self.capture = capture
+        self.sock = sock
+        self.session = session
+        self.opened = time.time()
+        self.record(b'')
+
+    def record(self, data):
+        self.capture.write({'kind': 'printer', 'session': self.session, 't': round(time.time() - self.opened, 6),
+                            'data': base64.b64encode(data).decode('ascii')})
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+        if data:
+            self.record(data)
+        return data
+
+    def close(self):
+        self.sock.close()
+
+class Replay(object):
+    ''' --replay: plays a Capture file back instead of using the network
+
+        Wallet calls are answered from the capture, matched on the request
+        (or the next capture of the same method if the request changed),
+        jobs sent to a reader are compared with the captured ones and every
+        printer drain gets the next captured printer session. Replies, reader
+        sends and printer data take as long as they did, divided by speed.
+        With speed 0 everything is answered at once and a printer session
+        ends as soon as its data runs out instead of waiting for more. '''
+
+    def __init__(self, filename, speed=1.0, clock=time.time, sleep=time.sleep):
+        self.filename = filename
+        self.speed = speed
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.calls = []
+        self.jobs = deque()
+        sessions = OrderedDict()
+        with gzip.open(filename, 'rt') as f:
+            for line in f:
+                event = json.loads(line)
+                if event['kind'] == 'rpc':
+                    self.calls.append(event)
+                elif event['kind'] == 'reader':
+                    self.jobs.append(event)
+                elif event['kind'] == 'printer':
+                    data = base64.b64decode(event['data'])
+                    chunks = sessions.setdefault(event['session'], [])
+                    if data:
+                        chunks.append((event['t'], data))
+        self.sessions = deque(sessions.values())
+        self.stats = {'rpc': 0, 'missing': 0, 'reader': 0, 'differ': 0, 'printer': 0}
+        self.began = clock()
+        logger.debug("Replaying %s wallet calls, %s reader jobs and %s printer sessions from %s", len(self.calls), len(self.jobs), len(self.sessions), filename)
+
+    def pause(self, seconds):
+        if self.speed:
+            self.sleep(seconds / self.speed)
+
+    @staticmethod
+    def method(payload):
+        call = json.loads(payload)
+        return (call[0] if isinstance(call, list) and call else call).get('method')
+
+    def take(self, payload):
+        ''' Removes and returns the captured call for payload, None if there isn't one '''
+        with self.lock:
+            for match in (lambda event: event['request'] == payload,
+                          lambda event: self.method(event['request']) == self.method(payload)):
+                for index, event in enumerate(self.calls):
+                    if match(event):
+                        return self.calls.pop(index)
+
+    @staticmethod
+    def error(event):
+        if event['error'] == 'ValueError':
+            return ValueError(event['message'])
+        if hasattr(requests.exceptions, event['error']):
+            return getattr(requests.exceptions, event['error'])(event['message'])
+        return OSError(event['message'])
+
+    def rpc(self, payload, post):
+        event = self.take(payload)
+        if event is None:
+            with self.lock:
+                self.stats['missing'] += 1
+            raise RPCError("{} isn't in the capture {}".format(self.method(payload), self.filename))
+        with self.lock:
+            self.stats['rpc'] += 1
+        self.pause(event['elapsed'])
+        if 'error' in event:
+            raise self.error(event)
+        return event['reply']
+
+    def reader(self, target, jcl, send):
+        with self.lock:
+            event = self.jobs.popleft() if self.jobs else None
+            self.stats['reader'] += 1
+            if event is None or event['jcl'] != jcl.decode('ascii', 'replace'):
+                self.stats['differ'] += 1
+        if event:
+            self.pause(event['elapsed'])
+            if 'error' in event:
+                raise OSError(event['message'])
+
+    def printer(self, hostname, port):
+        with self.lock:
+            chunks = self.sessions.popleft() if self.sessions else []
+            self.stats['printer'] += 1
+        return ReplayedPrinter(chunks, self.speed, self.clock)
+
+    def close(self):
+        return ("Replayed {rpc} wallet calls ({missing} not in the capture), {reader} reader jobs "
+                "({differ} different from the capture) and {printer} printer drains in {elapsed:.3f}s").format(
+                    elapsed=self.clock() - self.began, **self.stats)
+
+class ReplayedPrinter(object):
+    ''' The printer socket of a Replay, hands out the captured data as it
+        becomes due '''
+
+    def __init__(self, chunks, speed, clock):
+        self.chunks = deque(chunks)
+        self.speed = speed
+        self.clock = clock
+        self.opened = clock()
+
+    def setblocking(self, flag):
+        pass
+
+    def recv(self, size):
+        if not self.chunks:
+            if not self.speed:
+                return b''
+            raise BlockingIOError()
+        due, data = self.chunks[0]
+        if self.speed and (self.clock() - self.opened) * self.speed < due:
+            raise BlockingIOError()
+        self.chunks.popleft()
+        return data
+
+    def close(self):
+        pass
+
+class LatencyTracer(object):
+    ''' End to end latency tracing for wallet transactions and DOGECICS99 sends
+
+        Each new wallet transaction gets a correlation ID when it is first seen
+        and is timestamped as it is rendered in to JCL, submitted to the reader
+        and finally confirmed by the job's DOGEVSAM99 marker on the printer.
+        Sends are timed from the printer drain to the sendtoaddress reply.
+        Completed traces and a per run histogram of every stage are appended
+        as JSON lines to the trace log, open traces are kept in a state file
+        because confirmation usually shows up on a later run. A trace whose
+        job never confirms (a lost deck, a failed job) is closed as timed out
+        after timeout seconds, and a transaction key no longer in the wallet
+        output is forgotten after the same time, so neither the state file
+        nor memory grows with the life of the wallet. The wallet and printer
+        sides of a run trace from their own threads, so every change is made
+        under a lock. '''
+
+    # Histogram bucket upper bounds in seconds
+    BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+    STAGES = ['seen', 'rendered', 'submitted', 'visible']
+    # Open traces and known keys kept at most, the oldest go first
+    MAX_OPEN = 1000
+    MAX_KNOWN = 100000
+
+    def __init__(self, trace_log=None, state_file=None, slo=None, timeout=86400):
+        self.trace_log = trace_log or path.join(running_folder, trace_file)
+        self.state_file = state_file or path.join(running_folder, trace_file + '.state')
+        self.slo = slo
+        self.timeout = timeout
+        self.latencies = {}
+        self.breaches = 0
+        self.timeouts = 0
+        self.baseline = False
+        self.lock = threading.RLock()
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            # Transaction key: when it was last in the wallet output
+            known = state['known']
+            self.known = known if isinstance(known, dict) else dict.fromkeys(known, time.time())
+            self.open = state['open']
+        except (IOError, ValueError, KeyError):
+            # First run, everything already in the wallet is the baseline
+            self.known = {}
+            self.open = {}
+            self.baseline = True
+
+    def save(self):
+        with open(self.state_file, 'w') as f:
+            json.dump({'known': self.known, 'open': self.open}, f, sort_keys=True)
+
+    def observe(self, records, now=None):
+        ''' Starts a trace for every transaction key not seen before. Returns the new IDs '''
+        with self.lock:
+            now = now or time.time()
+            new = []
+            for record in records:
+                key = record[:10]
+                if reserved_key(key):
+                    continue
+                seen = key in self.known
+                self.known[key] = now
+                if seen or self.baseline:
+                    continue
+                corr_id = 'R{}{:04X}'.format(key, random.getrandbits(16))
+                self.open[corr_id] = {'kind': 'recv', 'key': key, 'stages': {'seen': now}}
+                logger.debug("Trace %s started for transaction %s", corr_id, key)
+                new.append(corr_id)
+            if self.baseline:
+                logger.debug("No trace state, using the %s current transactions as the baseline", len(self.known))
+                self.baseline = False
+            self.expire(now)
+            return new
+
+    def expire(self, now):
+        ''' Times out traces that were never confirmed and forgets keys gone from the wallet '''
+        with self.lock:
+            oldest = sorted(self.open, key=lambda corr_id: min(self.open[corr_id]['stages'].values()))
+            for n, corr_id in enumerate(oldest):
+                started = min(self.open[corr_id]['stages'].values())
+                if now - started > self.timeout or len(oldest) - n > self.MAX_OPEN:
+                    trace = self.open.pop(corr_id)
+                    self.timeouts += 1
+                    logger.warning("Trace %s for transaction %s timed out after %.0fs, its VSAM update was never confirmed",
+                                   corr_id, trace['key'], now - started)
+                    self.finish(corr_id, trace, timed_out=now)
+            for key in [key for key, seen in self.known.items() if now - seen > self.timeout]:
+                del self.known[key]
+            if len(self.known) > self.MAX_KNOWN:
+                for key in sorted(self.known, key=self.known.get)[:len(self.known) - self.MAX_KNOWN]:
+                    del self.known[key]
+
+    def stage(self, stage, now=None, token=None):
+        ''' Timestamps every open receive trace that hasn't reached this stage yet '''
+        with self.lock:
+            now = now or time.time()
+            for corr_id, trace in self.open.items():
+                if trace['kind'] == 'recv' and stage not in trace['stages']:
+                    trace['stages'][stage] = now
+                    if token:
+                        trace['token'] = token
+
+    def confirmed(self, token, now=None):
+        ''' The job with this marker token finished, close the traces it carried '''
+        with self.lock:
+            now = now or time.time()
+            for corr_id in [c for c, t in self.open.items() if t.get('token') == token]:
+                trace = self.open.pop(corr_id)
+                trace['stages']['visible'] = now
+                self.finish(corr_id, trace)
+
+    def send(self, address, amount, printed, replied, txid=None):
+        ''' Records a DOGECICS99 send from printer drain to wallet reply '''
+        with self.lock:
+            corr_id = 'S{:08X}'.format(random.getrandbits(32))
+            self.finish(corr_id, {'kind': 'send', 'address': address, 'amount': amount, 'txid': txid,
+                                  'stages': {'printed': printed, 'replied': replied}})
+            return corr_id
+
+    def finish(self, corr_id, trace, timed_out=None):
+        ''' Logs a finished trace, timed_out is when an unconfirmed one was given up on '''
+        with self.lock:
+            stages = trace['stages']
+            order = [stage for stage in self.STAGES + ['printed', 'replied'] if stage in stages]
+            latency = {}
+            for previous, stage in zip(order, order[1:]):
+                latency['{}_to_{}'.format(previous, stage)] = stages[stage] - stages[previous]
+            entry = dict(trace, type=trace['kind'], id=corr_id, latency=latency)
+            del entry['kind']
+            if timed_out:
+                # Only how far it got, kept out of the histograms and the SLO
+                latency['total'] = timed_out - stages[order[0]]
+                entry['timed_out'] = True
+            else:
+                latency['total'] = stages[order[-1]] - stages[order[0]]
+                for name, seconds in latency.items():
+                    self.latencies.setdefault('{}.{}'.format(trace['kind'], name), []).append(seconds)
+                if self.slo and trace['kind'] == 'recv' and latency['total'] > self.slo:
+                    self.breaches += 1
+                    logger.warning("Transaction %s took %.1fs to reach VSAM, over the %ss freshness SLO", trace['key'], latency['total'], self.slo)
+                logger.debug("Trace %s finished: %s", corr_id, latency)
+            with open(self.trace_log, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def histogram(self, values):
+        values = sorted(values)
+        counts = [0] * (len(self.BUCKETS) + 1)
+        for value in values:
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+        return {'count': len(values), 'min': values[0], 'max': values[-1],
+                'p50': values[int(0.50 * (len(values) - 1))],
+                'p95': values[int(0.95 * (len(values) - 1))],
+                'buckets': dict(zip([str(b) for b in self.BUCKETS] + ['inf'], counts))}
+
+    def close(self, scheduler=None):
+        ''' Writes this run's histograms to the trace log and saves the open traces '''
+        with self.lock:
+            summary = {'type': 'run', 'time': time.time(), 'open': len(self.open), 'timed_out': self.timeouts,
+                       'slo': self.slo, 'slo_breaches': self.breaches,
+                       'histograms': {name: self.histogram(values) for name, values in sorted(self.latencies.items())}}
+            if scheduler:
+                summary['scheduler'] = scheduler.state()
+            with open(self.trace_log, 'a') as f:
+                f.write(json.dumps(summary) + '\n')
+            self.save()
+            return summary
+
+class AdaptiveScheduler(object):
+    ''' Polling intervals for --loop
+
+        Every poller (the wallet and the printer) starts at the minimum
+        interval. A pass that finds something to do (a new transaction, a
+        DOGESEND command, a finished VSAM job or a submitted job) snaps every
+        poller back to the minimum since more usually follows, and each idle
+        pass multiplies that poller's interval by backoff up to the maximum.
+        The current state is written to a small JSON file (and to the trace
+        run summary with --trace) so it can be watched. '''
+
+    def __init__(self, pollers=('wallet', 'printer'), minimum=2, maximum=300, backoff=2.0, state_file=None, clock=time.time, sleep=time.sleep):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.backoff = backoff
+        self.state_file = state_file or path.join(running_folder, schedule_file)
+        self.clock = clock
+        self.sleep = sleep
+        self.active = 0
+        self.last_activity = None
+        now = self.clock()
+        self.pollers = {name: {'interval': minimum, 'due': now, 'polls': 0, 'idle': 0} for name in pollers}
+
+    def due(self, now=None):
+        ''' Names of the pollers that are due now '''
+        now = self.clock() if now is None else now
+        return sorted(name for name, poller in self.pollers.items() if poller['due'] <= now)
+
+    def wait(self):
+        ''' Sleeps until the next poller is due and returns the ones that are '''
+        delay = min(poller['due'] for poller in self.pollers.values()) - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+        return self.due()
+
+    def record(self, polled, active, now=None):
+        ''' Updates the intervals after a pass over the polled pollers '''
+        now = self.clock() if now is None else now
+        for name in polled:
+            self.pollers[name]['polls'] += 1
+        if active:
+            self.active += 1
+            self.last_activity = now
+            for name, poller in self.pollers.items():
+                poller['interval'] = self.minimum
+                poller['idle'] = 0
+                poller['due'] = now + self.minimum if name in polled else min(poller['due'], now + self.minimum)
+        else:
+            for name in polled:
+                poller = self.pollers[name]
+                poller['idle'] += 1
+                poller['interval'] = min(poller['interval'] * self.backoff, self.maximum)
+                poller['due'] = now + poller['interval']
+
+    def mode(self):
+        intervals = [poller['interval'] for poller in self.pollers.values()]
+        if all(interval >= self.maximum for interval in intervals):
+            return 'idle'
+        if any(interval <= self.minimum for interval in intervals):
+            return 'active'
+        return 'backoff'
+
+    def state(self, now=None):
+        now = self.clock() if now is None else now
+        return {'mode': self.mode(), 'minimum': self.minimum, 'maximum': self.maximum,
+                'backoff': self.backoff, 'active_polls': self.active,
+                'last_activity': self.last_activity,
+                'pollers': {name: {'interval': poller['interval'], 'due_in': max(poller['due'] - now, 0),
+                                   'polls': poller['polls'], 'idle_polls': poller['idle']}
+                            for name, poller in sorted(self.pollers.items())}}
+
+    def save(self):
+        with open(self.state_file, 'w') as f:
+            json.dump(self.state(), f)
+
+class RunProfiler(object):
+    ''' --profile: cProfile and tracemalloc for one run of the script
+
+        Every thread started after start() (the printer drain, --profiles
+        wallets) gets its own cProfile, merged with the main thread's when the
+        stats are written. From python 3.12 cProfile uses sys.monitoring,
+        which only allows one profile and already sees every thread, so
+        there the threads are left to the main thread's. phase() is called at each boundary of a pass
+        (records built, JCL rendered, job sent, printer drained) and keeps the
+        memory in use, the peak so far and the top allocation sites and what
+        grew since the last phase. Only the latest tracemalloc snapshot is
+        kept, and the last max_phases phases, so --loop doesn't grow without
+        end. The time taken by phase() itself isn't profiled or counted in
+        the phase timings. A profile shared by every thread (3.12 and later)
+        can't be paused without losing the calls other threads make in the
+        meantime, so there the snapshots are taken back out of the stats
+        instead. stop() writes, to a time stamped set of files in
+        folder so runs can be compared:
+
+        * <stamp>.prof: cProfile stats (load with pstats or snakeviz)
+        * <stamp>.txt: the top functions by cumulative and own time, memory
+          per phase and the top allocation sites (and what grew) per phase
+        * <stamp>.json: the phase timings and memory numbers '''
+
+    def __init__(self, folder, top=25, max_phases=500):
+        self.folder = folder
+        self.top = top
+        self.profile = cProfile.Profile()
+        self.profiles = [self.profile]
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.phases = deque(maxlen=max_phases)
+        self.dropped = 0
+        self.shared = False
+        self.snapshot = None
+        self.overhead = 0.0
+        self.stamp = None
+
+    def thread_started(self, frame, event, arg):
+        # threading.setprofile hook, runs once in every new thread
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiling tool is already active: the main thread's
+            # (python 3.12 and later), pausing it pauses this thread too
+            sys.setprofile(None)
+            self.shared = True
+            self.local.profile = self.profile
+            return
+        self.local.profile = profile
+        with self.lock:
+            self.profiles.append(profile)
+
+    def start(self):
+        self.stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.began = time.time()
+        tracemalloc.start()
+        self.local.profile = self.profile
+        threading.setprofile(self.thread_started)
+        self.profile.enable()
+
+    def phase(self, name, wallet=None):
+        profile = getattr(self.local, 'profile', None)
+        if self.shared and profile is self.profile:
+            profile = None
+        if profile:
+            profile.disable()
+        try:
+            began = time.time()
+            if wallet:
+                name = '{} {}'.format(wallet, name)
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            with self.lock:
+                phase = {'phase': name, 'elapsed': began - self.began - self.overhead, 'current': current, 'peak': peak,
+                         'top': [str(stat) for stat in snapshot.statistics('lineno')[:self.top]],
+                         'grew': [], 'since': self.phases[-1]['phase'] if self.phases else None}
+                if self.snapshot:
+                    phase['grew'] = [str(stat) for stat in snapshot.compare_to(self.snapshot, 'lineno')[:self.top] if stat.size_diff > 0]
+                if len(self.phases) == self.phases.maxlen:
+                    self.dropped += 1
+                self.phases.append(phase)
+                self.snapshot = snapshot
+                self.overhead += time.time() - began
+            logger.debug("Phase %s: %.3fs, %s bytes in use, %s peak", name, phase['elapsed'], current, peak)
+        finally:
+            if profile:
+                profile.enable()
+
+    def stop(self):
+        ''' Stops profiling and writes the reports, returns the summary file name '''
+        self.profile.disable()
+        threading.setprofile(None)
+        self.local.profile = None
+        self.phase('end')
+        tracemalloc.stop()
+        self.snapshot = None
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        base = path.join(self.folder, self.stamp)
+
+        report = io.StringIO()
+        # Threads still running (a --loop's notify listener) are cut off here
+        with self.lock:
+            profiles = list(self.profiles)
+        # A thread that never got to run profiled code has no stats to merge
+        for profile in profiles:
+            profile.create_stats()
+        profiles = [profile for profile in profiles if profile.stats]
+        stats = pstats.Stats(*profiles, stream=report)
+        if self.shared:
+            for key in [key for key in stats.stats if key[0] == tracemalloc.__file__ or '_tracemalloc.' in key[2]]:
+                del stats.stats[key]
+        stats.dump_stats(base + '.prof')
+        stats.strip_dirs()
+        report.write("Top {} functions by cumulative time ({} threads)\n".format(self.top, len(profiles)))
+        stats.sort_stats('cumulative').print_stats(self.top)
+        report.write("Top {} functions by own time\n".format(self.top))
+        stats.sort_stats('tottime').print_stats(self.top)
+
+        report.write("Memory by phase (peak {:,} bytes)\n".format(max(phase['peak'] for phase in self.phases)))
+        if self.dropped:
+            report.write("(the first {} phases were dropped)\n".format(self.dropped))
+        for phase in self.phases:
+            report.write("\n{phase} at {elapsed:.3f}s: {current:,} bytes in use, {peak:,} peak\n".format(**phase))
+            for stat in phase['top']:
+                report.write("    {}\n".format(stat))
+            if phase['since']:
+                report.write("  grew since {}:\n".format(phase['since']))
+                for stat in phase['grew']:
+                    report.write("    {}\n".format(stat))
+        with open(base + '.txt', 'w') as f:
+            f.write(report.getvalue())
+        with open(base + '.json', 'w') as f:
+            json.dump({'time': self.began, 'phases': [{k: v for k, v in phase.items() if k not in ('top', 'grew', 'since')} for phase in self.phases]}, f)
+        return base + '.txt'
+
+class JSONFormatter(logging.Formatter):
+    ''' --log-json: one JSON object per log line with the raw arguments kept
+        as fields so the log can be filtered without parsing the message '''
+
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'function': record.funcName,
+                 'thread': record.threadName, 'message': record.getMessage()}
+        if isinstance(record.args, dict):
+            entry['args'] = record.args
+        elif record.args:
+            entry['args'] = list(record.args)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+
+# The module's logger, left to the program importing it to configure. The
+# command line gets its stderr handler from log_to_stderr()
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+# The command line's stderr handler once log_to_stderr() has made it
+ch = None
+
+def log_to_stderr(level=logging.WARNING, log_json=False):
+    ''' Logs to stderr at level, as text or JSON lines (--log-json), for the
+        command line. Can be called again to change the level or format. '''
+    global ch
+    if ch is None:
+        ch = logging.StreamHandler()
+        logger.addHandler(ch)
+    logger.setLevel(level)
+    ch.setLevel(level)
+    ch.setFormatter(JSONFormatter() if log_json else logging.Formatter('%(levelname)-8s :: %(funcName)-22s :: %(message)s'))
+
+def rpc_policy(args):
+    ''' The RPCPolicy for one run with the command line options '''
+    return RPCPolicy(call_timeout=args.rpc_timeout, run_deadline=args.run_deadline, retries=args.rpc_retries,
+                     retry_budget=args.retry_budget, hedge_after=args.hedge_after)
+
+def run(args, wallet=True, printer=True, scheduler=None, profiler=None, records=None):
+    ''' One pass of the pipeline: sync the wallet to VSAM and/or drain the printer
+        and send what DOGESEND asked for. Returns what happened so --loop can
+        tell an idle pass from a busy one. records, if given, are used instead
+        of asking the wallet (see notified_records).
+
+        The printer drain, and the sends it asks for, run in their own thread
+        alongside the wallet fetch, diff and render so a pass takes as long as
+        the slower of the two instead of both. With --coalesce the VSAM job
+        waits for the drain to see if the last job finished. Both are always
+        finished before run() returns and an error from either is raised. '''
+    def phase(name):
+        if profiler:
+            profiler.phase(name, getattr(args, 'profile', None))
+
+    # Each --profiles wallet keeps its state files in its own folder
+    folder = getattr(args, 'state_folder', None) or running_folder
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    # One deadline and retry budget for every dogecoind read of this run
+    policy = rpc_policy(args)
+    # --capture or --replay
+    traffic = getattr(args, 'traffic', None)
+
+    tracer = None
+    if args.trace and not args.test:
+        tracer = LatencyTracer(trace_log=path.join(folder, trace_file), state_file=path.join(folder, trace_file + '.state'), slo=args.trace_slo,
+                               timeout=args.trace_timeout)
+
+    submitted = False
+    done_jobs = []
+    drained = concurrent.futures.Future()
+
+    def uploaded(vsam_records):
+        # What's in VSAM now, the next pass only sends a job if the wallet changed
+        if args.snapshot:
+            logger.debug("updating: %s/%s", folder, snapshot_file)
+            RecordSnapshot.write("{}/{}".format(folder,snapshot_file), vsam_records)
+        else:
+            logger.debug("updating: %s/%s", folder, tmp_file)
+            with open("{}/{}".format(folder,tmp_file), "w") as records_file:
+                records_file.write('\n'.join(vsam_records))
+
+    def coalesce_queue():
+        queue = SubmissionQueue(lambda jcl: submit_vsam_update(args, jcl), user=args.username, password=args.password, state_file=path.join(folder, queue_file), stale_after=args.stale_after, owner=args.vsam_file, uploaded=uploaded)
+        for token in done_jobs:
+            queue.job_finished(token)
+        return queue
+
+    def printer_pass():
+        # Check if there's data on the printer queue, Process the entries, Send to dogecoind server
+        logger.debug("Getting records from tk4- Class D")
+        owner = args.vsam_file.upper()
+
+        def mine(command):
+            # Only this wallet's markers, and sends only if this wallet sends
+            if 'done' in command:
+                return token_owner(command['done']) in (None, owner)
+            return args.printer
+
+        try:
+            markers = []
+            read = get_commands(hostname=args.hostname, port=args.prtport, done_jobs=markers, traffic=traffic)
+            own = share_printer([{'done': token} for token in markers] + read, mine, stale_after=args.stale_after,
+                                owners=getattr(args, 'printer_owners', None))
+            done_jobs.extend(command['done'] for command in own if 'done' in command)
+            sending = [command for command in own if 'done' not in command]
+        except BaseException as e:
+            drained.set_exception(e)
+            raise
+        printed = time.time()
+        drained.set_result(sending)
+        phase('printer drained')
+        if tracer:
+            for token in done_jobs:
+                tracer.confirmed(token)
+        if len(sending) < 1:
+            logger.debug("Nothing to perform, exiting")
+        for line in sending:
+            logger.debug("Recieved Address: %s Amount: %s", line['amount'], line['address'])
+            if line['amount'] and line['address']:
+                m = send_amount(line['amount'])
+                logger.debug("Sending %s to %s", m, line['address'])
+                if not args.fake:
+                    txid = send_doge(address=line['address'], amount=m, host=args.rpchost, rpcUser=args.rpcuser, rpcPass=args.rpcpass, rpcPort=args.rpcport, timeout=args.rpc_timeout, traffic=traffic)
+                    if tracer:
+                        tracer.send(line['address'], m, printed, time.time(), txid=txid)
+                else:
+                    logger.debug("Fake Mode Enabled, not sending transactions printing to terminal")
+                    print("Fake Mode Send: {} {}".format(line['address'], m))
+                # TODO: Refresh the VSAM file after we send this transaction.
+            else:
+                logger.debug("Address incorrect or amount missing. Not sending")
+        return sending
+
+    # --coalesce drains the printer on a wallet pass even with --no-printer, for
+    # the DOGEVSAM99 markers only, the sends are left for the wallet that pays
+    draining = not args.test and ((printer and args.printer) or (wallet and args.coalesce))
+    printer_thread = None
+    if draining:
+        printer_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='printer')
+        printer_result = printer_thread.submit(printer_pass)
+
+    try:
+        if wallet:
+            # Get records from dogecoind, check if there's any new ones, create new VSAM file
+            budget = limit = None
+            if args.sort_budget:
+                # Only what fits on the volume comes out of the external sort
+                budget = int(args.sort_budget * 1024 * 1024)
+                limit = 7645 if args.summary else 7648
+            if records is not None:
+                vsam_records = records
+            elif args.from_archive:
+                since = until = None
+                if args.since:
+                    since = utc_day(args.since)
+                if args.until:
+                    until = utc_day(args.until, end=True)
+                vsam_records = RecordArchive(path.join(folder, archive_file)).records(start=since, end=until, workers=args.workers, budget=budget, limit=limit, reverse=args.start_records_at_one)
+            elif not args.fake:
+                cache = None
+                details = None
+                if args.enrich:
+                    cache = TransactionCache(state_file=path.join(folder, txcache_file), deep_confirmations=args.deep_confirmations)
+                    details = {}
+                vsam_records = get_records(host=args.rpchost, rpcUser=args.rpcuser, rpcPass=args.rpcpass, rpcPort=args.rpcport, workers=args.workers, cache=cache, details=details, policy=policy,
+                                           traffic=traffic, debug_sample=getattr(args, 'debug_sample', 1))
+                if cache is not None:
+                    logger.debug("Transaction cache: %s fetched, %s deeply confirmed hits, %s entries", cache.fetched, cache.hits, len(cache))
+                    cache.save()
+                    with open(path.join(folder, details_file), 'w') as f:
+                        json.dump(details, f, sort_keys=True)
+            else:
+                vsam_records = generate_fake_records(number_of_records = int(args.fake), workers=args.workers, budget=budget, limit=limit, reverse=args.start_records_at_one)
+
+            phase('records built')
+            if tracer:
+                tracer.observe(vsam_records)
+
+            # The deck is validated as it's rendered, summary and page directory cards included
+            chunks = None
+            problems = []
+            try:
+                if args.chunk_size:
+                    chunks = generate_IDCAMS_JCL_chunks(user=args.username,password=args.password,vsam_file=args.vsam_file,volume=args.volume,records=vsam_records, reverse=args.start_records_at_one, chunk_size=args.chunk_size, page_directory=args.page_directory, summary=args.summary, address_index=args.address_index, validate=True)
+                    doge_vsam_jcl = '\n'.join(chunk['jcl'] for chunk in chunks)
+                else:
+                    doge_vsam_jcl = generate_IDCAMS_JCL(user=args.username,password=args.password,vsam_file=args.vsam_file,volume=args.volume,records=vsam_records, reverse=args.start_records_at_one, page_directory=args.page_directory, summary=args.summary, address_index=args.address_index, validate=True)
+            except RecordError as e:
+                problems = e.problems
+                doge_vsam_jcl = ''
+            for problem in problems[:args.show_bad_cards]:
+                logger.error("Bad card %(card)s key %(key)s: %(problem)s", problem)
+            if problems:
+                logger.error("%s bad card(s) in the VSAM deck, not sending it so %s isn't deleted", len(problems), args.vsam_file)
+            elif args.archive and not args.from_archive:
+                RecordArchive(path.join(folder, archive_file)).append(vsam_records)
+            phase('JCL rendered')
+            if tracer:
+                tracer.stage('rendered')
+
+            # With --coalesce wait for the printer drain to see if the last VSAM job finished
+            queue = None
+            if args.coalesce and not args.test:
+                drained.result()
+                queue = coalesce_queue()
+
+            def submit():
+                nonlocal submitted
+                if problems:
+                    return False
+                token = None
+                if queue:
+                    # The queue records the upload whenever the held job goes
+                    ok = queue.offer(doge_vsam_jcl, vsam_records)
+                    if ok:
+                        token = queue.inflight['token']
+                else:
+                    # Tracing needs the DOGEVSAM99 marker to see when the job finished
+                    marker = ''
+                    if tracer:
+                        token = job_token(args.vsam_file)
+                        marker = '\n' + DONE_JCL.format(user=args.username.upper(), password=args.password.upper(), token=token)
+                    if chunks:
+                        chunks[-1]['jcl'] += marker
+                        ok = submit_vsam_chunks(args, chunks, folder=path.join(folder, chunk_folder))
+                    else:
+                        ok = submit_vsam_update(args, doge_vsam_jcl + marker)
+                    if ok:
+                        uploaded(vsam_records)
+                if ok and tracer:
+                    tracer.stage('submitted', token=token)
+                submitted = submitted or ok
+                return ok
+
+
+            if args.snapshot:
+                snapshot_path = "{}/{}".format(folder,snapshot_file)
+                snapshot = None if args.force else load_snapshot(snapshot_path)
+                if snapshot is None or not snapshot.matches(vsam_records):
+                    logger.debug("new records, forced update or no snapshot in %s", snapshot_path)
+                    if snapshot:
+                        snapshot.close()
+                    if not args.test:
+                        submit()
+                    else:
+                        print("TEST MODE printing Doge records and JCL")
+                        print(doge_vsam_jcl)
+                else:
+                    snapshot.close()
+                    logger.debug("no new records, update not required, force update with --force")
+            elif not os.path.isfile("{}/{}".format(folder,tmp_file)) or args.force:
+                # If the tmp file doesn't exist or we need to force an update for some reason
+                if not os.path.isfile("{}/{}".format(folder,tmp_file)):
+                    logger.debug("temp file %s/%s does not exist, creating", folder, tmp_file)
+                else:
+                    logger.debug("forced update")
+        
+                if not args.test:
+                    submit()
+                else:
+                    print("TEST MODE printing Doge records and JCL")
+                    print(doge_vsam_jcl)
+            else:
+                # we've already uploaded a file, do we have new records?
+                with open("{}/{}".format(folder,tmp_file), "r") as records_file:
+                    tmp = records_file.read()
+                if new_records(tmp, '\n'.join(vsam_records)):
+                    if not args.test:
+                        submit()
+                    else:
+                        print("Test mode, new records found, printing JCL and old records")
+                        print("OLD RECORDS: \n{}".format(tmp))
+                        print("NEW RECORDS: \n{}".format('\n'.join(vsam_records)))
+                        print("JCL:\n{}".format(doge_vsam_jcl))
+            phase('job sent')
+
+        if draining and not wallet and args.coalesce:
+            # The held job can go as soon as the last one's marker shows up
+            drained.result()
+            if done_jobs:
+                queue = coalesce_queue()
+                if queue.pump():
+                    submitted = True
+                    if tracer:
+                        tracer.stage('submitted', token=queue.inflight['token'])
+    except BaseException as e:
+        if printer_thread:
+            # Let any sends in flight finish before giving up on the pass
+            printer_thread.shutdown(wait=True)
+            if printer_result.exception() and printer_result.exception() is not e:
+                logger.error("Printer pass failed too: %s", printer_result.exception())
+        raise
+
+    sending = []
+    if printer_thread:
+        printer_thread.shutdown(wait=True)
+        sending = printer_result.result()
+
+    if tracer:
+        tracer.close(scheduler=scheduler)
+    return {'submitted': submitted, 'commands': len(sending or []), 'jobs': len(done_jobs)}
+
+TXID = re.compile(r'^[0-9a-fA-F]{64}$')
+
+class NotifyListener(object):
+    ''' --notify: txids from dogecoind's walletnotify, see notify_main
+
+        A thread accepts connections on a Unix domain socket, each one sends
+        one or more txids, a line each. wait() stands in for the --loop
+        scheduler's sleep: it returns as soon as a txid comes in, after giving
+        the rest of a burst delay seconds to arrive so they all go in one VSAM
+        update. take() returns the txids received since the last take().
+        Raises DogeError if filename is taken: by a listener that's still
+        running or by something that isn't a socket. '''
+
+    def __init__(self, filename, delay=1.0):
+        self.filename = filename
+        self.delay = delay
+        self.txids = OrderedDict()
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        if os.path.lexists(filename):
+            if not stat.S_ISSOCK(os.lstat(filename).st_mode):
+                raise DogeError("--notify-socket {} is there and isn't a socket, not replacing it".format(filename))
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            probe.settimeout(1)
+            try:
+                probe.connect(filename)
+            except OSError:
+                # Left behind by a listener that didn't shut down cleanly
+                os.remove(filename)
+            else:
+                raise DogeError("Another dogedcams.py --notify is listening on {}".format(filename))
+            finally:
+                probe.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(filename)
+        self.sock.listen(16)
+        self.thread = threading.Thread(target=self.serve, name='notify', daemon=True)
+        self.thread.start()
+        logger.debug("Listening for wallet notifications on %s", filename)
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                # Closed
+                return
+            data = b''
+            try:
+                conn.settimeout(5)
+                while len(data) < 65536:
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+            except OSError as e:
+                logger.warning("Reading a wallet notification failed: %s", e)
+            finally:
+                conn.close()
+            txids = [txid for txid in data.decode('ascii', 'replace').split() if TXID.match(txid)]
+            if txids:
+                with self.lock:
+                    for txid in txids:
+                        self.txids[txid.lower()] = True
+                    self.event.set()
+                logger.debug("Wallet notification for %s", ', '.join(txids))
+
+    def wait(self, seconds):
+        if self.event.wait(seconds) and self.delay:
+            time.sleep(self.delay)
+
+    def take(self):
+        with self.lock:
+            txids = list(self.txids)
+            self.txids.clear()
+            self.event.clear()
+        return txids
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+def notified_records(args, txids, folder=None, policy=None, log=None):
+    ''' The last uploaded records with the notified transactions merged in
+
+        Only the notified transactions (gettransaction) and the balances are
+        asked for, not the whole wallet, through args.traffic if there is
+        one. Returns None if nothing was uploaded yet, a full pass is needed
+        then. '''
+    folder = folder or running_folder
+    log = log or logger
+    traffic = getattr(args, 'traffic', None)
+    if args.snapshot:
+        snapshot = load_snapshot(path.join(folder, snapshot_file))
+        if snapshot is None:
+            return None
+        with snapshot:
+            deck = snapshot.records()
+    elif os.path.isfile(path.join(folder, tmp_file)):
+        with open(path.join(folder, tmp_file), 'r') as records_file:
+            deck = records_file.read().split('\n')
+    else:
+        return None
+
+    server = rpc_server(host=args.rpchost, rpcUser=args.rpcuser, rpcPass=args.rpcpass, rpcPort=args.rpcport)
+    rows = [(1, 0, "Available", rpc_call(server, 'getbalance', timeout=10, policy=policy, traffic=traffic, log=log)),
+            (2, 0, "Pending", rpc_call(server, 'getunconfirmedbalance', timeout=10, policy=policy, traffic=traffic, log=log))]
+    for txid in txids:
+        transaction = rpc_call(server, 'gettransaction', [txid], timeout=10, policy=policy, traffic=traffic, log=log)
+        # listtransactions has an entry per detail, get_records keeps the first
+        details = transaction.get('details') or [{}]
+        rows.append((transaction['timereceived'], details[0].get('address', ''), details[0].get('label', ''), details[0].get('amount', transaction.get('amount', 0))))
+        log.debug("Notified transaction %s: %s", txid, rows[-1])
+    cards = OrderedDict((card[:10], card) for card in deck)
+    for card in format_record_chunk(rows).decode('ascii').split('\n'):
+        cards[card[:10]] = card
+    return [cards[key] for key in sorted(cards)]
+
+def notify_main(argv):
+    ''' dogedcams.py notify: for dogecoind's walletnotify, hands the txid to
+        the --loop --notify process and exits '''
+    arg_parser = argparse.ArgumentParser(prog='dogedcams.py notify', description="Passes a wallet transaction to a running dogedcams.py --loop --notify. Set walletnotify={} notify %s in dogecoin.conf".format(path.abspath(__file__)),
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    arg_parser.add_argument('txid', help="Transaction id (walletnotify's %%s)", nargs='+')
+    arg_parser.add_argument('--socket', help="The --notify-socket of the running dogedcams.py", default=path.join(running_folder, notify_file))
+    args = arg_parser.parse_args(argv)
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(5)
+    try:
+        s.connect(args.socket)
+        s.sendall(('\n'.join(args.txid) + '\n').encode('ascii', 'replace'))
+    except OSError as e:
+        logger.warning("No dogedcams.py --notify listening on %s (%s), the next poll will pick up %s", args.socket, e, ' '.join(args.txid))
+        sys.exit(-1)
+    finally:
+        s.close()
+
+def load_profiles(filename, args, types=None, lists=None):
+    ''' Reads wallet profiles from an ini file
+
+        Every section is a wallet and starts as a copy of the command line
+        options, its keys (named like the options: rpchost, rpcport, rpcuser,
+        rpcpass, vsam_file, volume, printer, ...) override them. Each profile
+        gets its own state folder so temp files, queues and traces don't mix.
+        types maps option names to the type they're parsed with on the command
+        line, for options that default to None. lists names the options that
+        take several values (nargs), they're split on whitespace. '''
+    types = types or {}
+    lists = lists or ()
+    config = configparser.ConfigParser()
+    if not config.read(filename):
+        raise ValueError("Can't read wallet profiles from {}".format(filename))
+    profiles = []
+    for name in config.sections():
+        profile = argparse.Namespace(**vars(args))
+        profile.profile = name
+        profile.state_folder = path.join(running_folder, profile_folder, name)
+        for option in config[name]:
+            dest = option.replace('-', '_')
+            if not hasattr(args, dest):
+                logger.warning("Ignoring unknown option %s in profile %s", option, name)
+                continue
+            current = getattr(args, dest)
+            if isinstance(current, bool):
+                value = config[name].getboolean(option)
+            elif isinstance(current, int):
+                value = config[name].getint(option)
+            elif isinstance(current, float):
+                value = config[name].getfloat(option)
+            elif dest in lists:
+                value = [types[dest](item) if dest in types else item for item in config[name][option].split()]
+            elif dest in types:
+                value = types[dest](config[name][option])
+            else:
+                value = config[name][option]
+            setattr(profile, dest, value)
+        profiles.append(profile)
+    if not profiles:
+        raise ValueError("No wallet profiles in {}".format(filename))
+    return profiles
+
+def sync_profiles(profiles, parallel=4, **kwargs):
+    ''' Runs every wallet profile at once, at most parallel at a time
+
+        VSAM jobs all go through one reader queue so only one connection to
+        the reader is open at any time. A profile that fails is logged and
+        doesn't stop the others. Returns each profile's run() result (None
+        if it failed) by profile name. '''
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader_queue:
+        for profile in profiles:
+            profile.reader_queue = reader_queue
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+            futures = {pool.submit(run, profile, **kwargs): profile.profile for profile in profiles}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                    logger.debug("Profile %s synced: %s", name, results[name])
+                except (Exception, SystemExit) as e:
+                    logger.error("Profile %s failed: %r", name, e)
+                    results[name] = None
+    return results
+
+class DogeSync(object):
+    ''' Wallet to VSAM sync for python programs that don't want to run the script
+
+        Takes the RPC, reader and printer settings (named like the command line
+        options) and keeps the last records submitted, in memory and, with a
+        state_folder, in its doge.tmp so a restart doesn't resend them. Every
+        step is its own method: fetch() the records, diff() them against the
+        last ones submitted, render() the JCL, submit() it and drain_sends()
+        from the printer. sync() does the first four. Nothing exits, errors
+        are raised as RPCError, ReaderError, PrinterError or RecordError (all
+        DogeError). One DogeSync can be used from several threads, only one
+        job is sent to the reader and one printer drain runs at a time.
+
+        It logs to logger (the module's, which has only a NullHandler, by
+        default) and talks to the wallet, reader and printer through traffic
+        (a Capture or a Replay, straight to the network by default).
+        debug_sample is --debug-sample. '''
+
+    def __init__(self, rpchost='localhost', rpcport=22555, rpcuser=None, rpcpass=None,
+                 hostname='localhost', rdrport=3505, prtport=3506, readers=None,
+                 rdrtimeout=10, rdrretries=2, username='herc01', password='cul8tr',
+                 vsam_file='DOGE.VSAM', volume='pub012', reverse=True, page_directory=True,
+                 summary=True, address_index=False, workers=None, state_folder=None,
+                 rpc_timeout=10, run_deadline=None, rpc_retries=2, retry_budget=4, hedge_after=None,
+                 logger=None, traffic=None, debug_sample=1):
+        # send_vsam_update() takes the command line options
+        self.args = argparse.Namespace(rpchost=rpchost, rpcport=rpcport, rpcuser=rpcuser, rpcpass=rpcpass,
+                                       hostname=hostname, rdrport=rdrport, prtport=prtport, readers=readers,
+                                       rdrtimeout=rdrtimeout, rdrretries=rdrretries, print=False,
+                                       username=username, password=password, vsam_file=vsam_file, volume=volume,
+                                       traffic=traffic)
+        self.reverse = reverse
+        self.page_directory = page_directory
+        self.summary = summary
+        self.address_index = address_index
+        self.workers = workers
+        self.state_folder = state_folder
+        self.rpc_timeout = rpc_timeout
+        self.run_deadline = run_deadline
+        self.rpc_retries = rpc_retries
+        self.retry_budget = retry_budget
+        self.hedge_after = hedge_after
+        self.logger = logger or logging.getLogger(__name__)
+        self.traffic = traffic
+        self.debug_sample = debug_sample
+        self.submitted = None
+        self.lock = threading.Lock()
+        self.reader_lock = threading.Lock()
+        self.printer_lock = threading.Lock()
+
+    def last_records(self):
+        ''' The records last submitted, None if nothing was '''
+        with self.lock:
+            if self.submitted is None and self.state_folder:
+                filename = path.join(self.state_folder, tmp_file)
+                if os.path.isfile(filename):
+                    with open(filename, 'r') as records_file:
+                        self.submitted = records_file.read().split('\n')
+            return self.submitted
+
+    def policy(self):
+        ''' A new RPCPolicy, its run deadline starts now '''
+        return RPCPolicy(call_timeout=self.rpc_timeout, run_deadline=self.run_deadline, retries=self.rpc_retries,
+                         retry_budget=self.retry_budget, hedge_after=self.hedge_after)
+
+    def fetch(self, cache=None, details=None, policy=None):
+        ''' Gets the wallet records from dogecoind, see get_records(). Without
+            a policy every fetch gets a new one. '''
+        a = self.args
+        return get_records(host=a.rpchost, rpcUser=a.rpcuser, rpcPass=a.rpcpass, rpcPort=a.rpcport,
+                           workers=self.workers, cache=cache, details=details, policy=policy or self.policy(),
+                           traffic=self.traffic, log=self.logger, debug_sample=self.debug_sample)
+
+    def diff(self, records):
+        ''' True if records aren't what was last submitted '''
+        last = self.last_records()
+        return last is None or new_records('\n'.join(last), '\n'.join(records))
+
+    def render(self, records):
+        ''' The IDCAMS JCL that loads records, RecordError if the deck is bad '''
+        return generate_IDCAMS_JCL(user=self.args.username, password=self.args.password, vsam_file=self.args.vsam_file,
+                                   volume=self.args.volume, records=records, reverse=self.reverse,
+                                   page_directory=self.page_directory, summary=self.summary,
+                                   address_index=self.address_index, validate=True)
+
+    def submit(self, jcl, records=None):
+        ''' Sends jcl to the reader(s) and remembers records as submitted
+
+            Raises ReaderError unless every reader took the job. '''
+        with self.reader_lock:
+            try:
+                ok = send_vsam_update(self.args, jcl, log=self.logger)
+            except OSError as e:
+                raise ReaderError("Sending JCL to {}:{} failed: {}".format(self.args.hostname, self.args.rdrport, e))
+        if not ok:
+            raise ReaderError("JCL submission failed for reader(s): {}".format(' '.join(self.args.readers)))
+        if records is not None:
+            with self.lock:
+                self.submitted = list(records)
+                if self.state_folder:
+                    if not os.path.isdir(self.state_folder):
+                        os.makedirs(self.state_folder)
+                    with open(path.join(self.state_folder, tmp_file), 'w') as records_file:
+                        records_file.write('\n'.join(self.submitted))
+
+    def sync(self, force=False):
+        ''' fetch(), diff(), render() and submit(), returns False if there was
+            nothing new to submit '''
+        records = self.fetch()
+        if not force and not self.diff(records):
+            return False
+        self.submit(self.render(records), records)
+        return True
+
+    def drain_sends(self, timeout=2, send=True):
+        ''' Reads DOGESEND requests from the printer and sends them
+
+            Returns a dict (address, amount and txid) for every request, the
+            txid is None when send is False. The printer is drained before
+            anything is sent so if a send fails the RPCError raised has the
+            ones already sent in sends and the rest in pending. '''
+        with self.printer_lock:
+            try:
+                commands = get_commands(timeout=timeout, hostname=self.args.hostname, port=self.args.prtport,
+                                        traffic=self.traffic, log=self.logger)
+            except OSError as e:
+                raise PrinterError("Reading the printer {}:{} failed: {}".format(self.args.hostname, self.args.prtport, e))
+        commands = [line for line in commands if line['amount'] and line['address']]
+        sends = []
+        for number, line in enumerate(commands):
+            entry = {'address': line['address'], 'amount': send_amount(line['amount']), 'txid': None}
+            if send:
+                a = self.args
+                try:
+                    entry['txid'] = send_doge(address=entry['address'], amount=entry['amount'], host=a.rpchost,
+                                              rpcUser=a.rpcuser, rpcPass=a.rpcpass, rpcPort=a.rpcport,
+                                              timeout=self.rpc_timeout, traffic=self.traffic, log=self.logger)
+                except RPCError as e:
+                    e.sends = sends
+                    e.pending = commands[number:]
+                    raise
+            sends.append(entry)
+        return sends
+
+def main():
+    """Main function for running the script"""
+    log_to_stderr()
+    if sys.argv[1:2] in (['report'], ['query']):
+        report_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['notify']:
+        notify_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['emulate']:
+        emulate_main(sys.argv[2:])
+        return
+    desc = '''DOGEdcams data generator for DOGE Bank. Used to send and receive funds between KICKS on TK4- and DogeCICS.'''
     arg_parser = argparse.ArgumentParser(description=desc, 
                         usage='%(prog)s [options]', 
                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     arg_parser.add_argument('-d', '--debug', help="Print lots of debugging statements", action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.WARNING)
+    arg_parser.add_argument('--debug-sample', help="With --debug only log every Nth per transaction message", type=int, default=1)
+    arg_parser.add_argument('--log-json', help="Log as JSON lines instead of text", action="store_true")
     arg_parser.add_argument('-t', '--test', help="Test sending JCL to TK4-", action="store_true")
     arg_parser.add_argument('-p', '--print', help="Print JCL being sent to TK4", action="store_true")
     arg_parser.add_argument('-f', '--force', help="Force VSAM update even if no changes to wallet", action="store_true")
@@ -339,91 +3691,167 @@ def main():
     arg_parser.add_argument('--password', help="TK4- password for JCL", default='cul8tr')
     arg_parser.add_argument('--vsam_file', help="TK4- VSAM file used by dogekicks", default='DOGE.VSAM')
     arg_parser.add_argument('--volume', help="TK4- volume to store VSAM file", default='pub012')
-    arg_parser.add_argument('--rdrport', help="TK4- Reader sockdev port", default=3505)
-    arg_parser.add_argument('--prtport', help="TK4- Printer sockdev port", default=3506)
+    arg_parser.add_argument('--rdrport', help="TK4- Reader sockdev port", type=int, default=3505)
+    arg_parser.add_argument('--prtport', help="TK4- Printer sockdev port", type=int, default=3506)
     arg_parser.add_argument('--hostname',  help="TK4- sockdev host", default="localhost")
+    arg_parser.add_argument('--readers', help="Submit the VSAM JCL to multiple TK4- readers at once, as host[:port] (space or comma separated). Overrides --hostname/--rdrport for submission", nargs='+', default=None)
+    arg_parser.add_argument('--rdrtimeout', help="Seconds to wait for each --readers connection", type=float, default=10)
+    arg_parser.add_argument('--rdrretries', help="Number of retries for each --readers target that fails", type=int, default=2)
     arg_parser.add_argument('--rpcuser', help="Crypto wallet username", default=None)
     arg_parser.add_argument('--rpcpass', help="Crypto wallet password", default=None)
     arg_parser.add_argument('--rpchost', help="Crypto wallet hostname", default="localhost")
     arg_parser.add_argument('--rpcport', help="Crypto wallet port", default="22555")
+    arg_parser.add_argument('--rpc-timeout', help="Seconds to wait for each wallet call", type=float, default=10)
+    arg_parser.add_argument('--run-deadline', help="Stop asking the wallet for anything once a run has taken this many seconds (sends already read from the printer still go out)", type=float, default=None)
+    arg_parser.add_argument('--rpc-retries', help="Number of times a wallet read (never a send) that timed out or failed to connect is retried", type=int, default=2)
+    arg_parser.add_argument('--retry-budget', help="Most wallet read retries in one run", type=int, default=4)
+    arg_parser.add_argument('--hedge-after', help="Send a wallet read again on a second connection if it hasn't answered in this many seconds, the first reply wins", type=float, default=None)
+    arg_parser.add_argument('--chunk-size', help="Split the VSAM load in to multiple IDCAMS jobs of this many records each", type=int, default=None)
+    arg_parser.add_argument('--resubmit-chunk', help="Resubmit only this chunk number from the last chunked load and exit", type=int, default=None)
+    arg_parser.add_argument('--coalesce', help="Only keep the latest VSAM job and hold it until the previous job has printed its completion marker to class D", action="store_true")
+    arg_parser.add_argument('--stale-after', help="Seconds before a --coalesce job that never reported back is considered lost", type=int, default=900)
+    arg_parser.add_argument('--trace', help="Trace transactions from wallet to VSAM (and sends from printer to wallet) and log the latency of each stage to doge.trace", action="store_true")
+    arg_parser.add_argument('--trace-slo', help="Warn when a traced transaction takes longer than this many seconds to reach VSAM", type=float, default=None)
+    arg_parser.add_argument('--trace-timeout', help="Give up on a traced transaction whose VSAM update isn't confirmed after this many seconds", type=float, default=86400)
+    arg_parser.add_argument('--no-page-directory', help="Don't build the DOGETRAN page directory (VSAM_FILE.PAGES), only use this with the old DOGETRAN", action="store_false", dest="page_directory")
+    arg_parser.add_argument('--no-summary', help="Don't add the DOGEMAIN dashboard summary records (keys 3 to 5), only use this with the old DOGEMAIN", action="store_false", dest="summary")
+    arg_parser.add_argument('--address-index', help="Also build an alternate index and path (VSAM_FILE.AIX/VSAM_FILE.PATH) on the wallet address", action="store_true")
+    arg_parser.add_argument('--show-bad-cards', help="Number of bad cards to log when the VSAM deck fails validation (it's never sent)", type=int, default=20)
+    arg_parser.add_argument('--workers', help="Number of processes used to format the VSAM records (default: one per CPU). Only used for more than {} records".format(FORMAT_CHUNK_SIZE), type=int, default=None)
+    arg_parser.add_argument('--sort-budget', help="Sort --fake and --from-archive records on disk, holding at most this many MB of records in memory (default: sort in memory)", type=float, default=None)
+    arg_parser.add_argument('--snapshot', help="Keep the last uploaded records in a memory mapped fixed width snapshot ({}) instead of {}".format(snapshot_file, tmp_file), action="store_true")
+    arg_parser.add_argument('--profiles', help="Ini file of wallet profiles to sync instead of the single wallet, one section per wallet with any of these options (rpchost, rpcport, rpcuser, rpcpass, vsam_file, volume, printer, ...)", default=None)
+    arg_parser.add_argument('--parallel', help="Number of --profiles wallets synced at the same time", type=int, default=4)
+    arg_parser.add_argument('--no-printer', help="Don't drain the class D printer or send anything (for --profiles sharing a printer with another profile)", action="store_false", dest="printer")
+    arg_parser.add_argument('--archive', help="Keep every wallet transaction in the {} columnar archive, not just the 7648 that fit in VSAM".format(archive_file), action="store_true")
+    arg_parser.add_argument('--from-archive', help="Build the VSAM file from the archive instead of the wallet (see --since/--until)", action="store_true")
+    arg_parser.add_argument('--since', help="With --from-archive only use transactions from this date (YYYY-MM-DD, UTC)", default=None)
+    arg_parser.add_argument('--until', help="With --from-archive only use transactions up to and including this date (YYYY-MM-DD, UTC)", default=None)
+    arg_parser.add_argument('--capture', help="Record the wallet calls, reader jobs and printer output of this run (gzip JSON lines) for --replay", default=None)
+    arg_parser.add_argument('--replay', help="Play a --capture file back instead of talking to the wallet, reader and printer", default=None)
+    arg_parser.add_argument('--replay-speed', help="--replay at this many times the captured speed, 0 for as fast as possible", type=float, default=1)
+    arg_parser.add_argument('--profile', help="Profile this run: write cProfile stats, a hot function summary and tracemalloc snapshots of every phase to --profile-dir", action="store_true", dest="profiling")
+    arg_parser.add_argument('--profile-dir', help="Folder for --profile output (default: doge.prof next to this script)", default=None)
+    arg_parser.add_argument('--profile-top', help="Number of functions and allocation sites in the --profile summary", type=int, default=25)
+    arg_parser.add_argument('--enrich', help="Add txid, confirmations and fee from gettransaction to {} (cached in {})".format(details_file, txcache_file), action="store_true")
+    arg_parser.add_argument('--deep-confirmations', help="With --enrich, transactions with at least this many confirmations are never fetched again", type=int, default=100)
+    arg_parser.add_argument('--loop', help="Keep running, polling the wallet and printer more often after activity and backing off when idle, instead of running once", action="store_true")
+    arg_parser.add_argument('--notify', help="With --loop, listen on --notify-socket for txids from walletnotify (dogedcams.py notify %%s) and put just those transactions in VSAM straight away", action="store_true")
+    arg_parser.add_argument('--notify-socket', help="Unix domain socket for --notify (default: {} next to this script)".format(notify_file), default=None)
+    arg_parser.add_argument('--notify-delay', help="Seconds to wait for more --notify txids before updating VSAM", type=float, default=1)
+    arg_parser.add_argument('--poll-min', help="Shortest --loop poll interval in seconds", type=float, default=2)
+    arg_parser.add_argument('--poll-max', help="Longest --loop poll interval in seconds", type=float, default=300)
+    arg_parser.add_argument('--poll-backoff', help="Multiply a --loop poll interval by this after every idle poll", type=float, default=2)
     arg_parser.add_argument('--start-records-at-one', help="If there are more than 7648 records in DOGE the script will only put the 7,648 most resent transactions in VSAM. This flag reverses that action to store the first 7,648 records", action="store_false")
     args = arg_parser.parse_args()	
 
     # Update logger level based on args
-    logger.setLevel(args.loglevel)
-    ch.setLevel(args.loglevel)
+    log_to_stderr(args.loglevel, args.log_json)
+    args.debug_sample = max(1, args.debug_sample)
+    # The Capture (--capture) or Replay (--replay) the wallet, reader and
+    # printer traffic goes through, None for the network as is
+    args.traffic = None
 
     # Print debug information
-    logger.debug("Using the following script options - Debug: True, Test: {}, Print: {}, Force: {}".format(args.test, args.print, args.force))
-    logger.debug("Using the following TK4- options - Hostname: {}, Username: {}, Password: {}, VSAM File: {}, Volume: {}, Reader Port: {}, Printer Port: {}".format(
-                args.hostname, args.username, "*"*len(args.password), args.vsam_file, args.volume, args.rdrport, args.prtport))
-    logger.debug("Using the following Dogecoin options - RPC Host: {}, RPC User: {}, RPC Pass: {} RPC Port: {}".format(
-                args.rpchost, args.rpcuser, "*"*len(args.rpchost), args.rpcport))
+    logger.debug("Using the following script options - Debug: True, Test: %s, Print: %s, Force: %s", args.test, args.print, args.force)
+    logger.debug("Using the following TK4- options - Hostname: %s, Username: %s, Password: %s, VSAM File: %s, Volume: %s, Reader Port: %s, Printer Port: %s",
+                args.hostname, args.username, "*"*len(args.password), args.vsam_file, args.volume, args.rdrport, args.prtport)
+    logger.debug("Using the following Dogecoin options - RPC Host: %s, RPC User: %s, RPC Pass: %s RPC Port: %s",
+                args.rpchost, args.rpcuser, "*"*len(args.rpchost), args.rpcport)
     if args.test:
         logger.debug("Test mode enabled, not getting transactions from TK4- Queue")
     if args.fake:
-        logger.debug("Generating {} fake records.".format(args.fake))
+        logger.debug("Generating %s fake records.", args.fake)
 
-    # Get records from dogecoind, check if there's any new ones, create new VSAM file
-    if not args.fake:
-        vsam_records = get_records(host=args.rpchost, rpcUser=args.rpcuser, rpcPass=args.rpcpass, rpcPort=args.rpcport)
-    else:
-        vsam_records = generate_fake_records(number_of_records = int(args.fake))
+    if args.resubmit_chunk:
+        logger.debug("Resubmitting chunk %s from %s/%s", args.resubmit_chunk, running_folder, chunk_folder)
+        if not resubmit_chunk(args, args.resubmit_chunk):
+            sys.exit(-1)
+        return
 
-    doge_vsam_jcl = generate_IDCAMS_JCL(user=args.username,password=args.password,vsam_file=args.vsam_file,volume=args.volume,records=vsam_records, reverse=args.start_records_at_one)
+    profiles = None
+    if args.profiles:
+        try:
+            types = {action.dest: action.type for action in arg_parser._actions if action.type}
+            lists = {action.dest for action in arg_parser._actions if action.nargs in ('+', '*')}
+            profiles = load_profiles(args.profiles, args, types=types, lists=lists)
+        except (ValueError, configparser.Error) as e:
+            logger.critical(e)
+            sys.exit(-1)
+        logger.debug("Syncing wallet profiles %s", ', '.join(profile.profile for profile in profiles))
 
+    def sync(**kwargs):
+        if profiles:
+            results = sync_profiles(profiles, parallel=args.parallel, **kwargs)
+            return any(any(result.values()) for result in results.values() if result)
+        return any(run(args, **kwargs).values())
 
-    if not os.path.isfile("{}/{}".format(running_folder,tmp_file)) or args.force:
-        # If the tmp file doesn't exist or we need to force an update for some reason
-        if not os.path.isfile("{}/{}".format(running_folder,tmp_file)):
-            logger.debug("temp file {}/{} does not exist, creating".format(running_folder,tmp_file))
-        else:
-            logger.debug("forced update")
-        
-        if not args.test:
-            send_jcl(hostname=args.hostname,port=args.rdrport, jcl=doge_vsam_jcl, print_jcl=args.print)
-            logger.debug("creating: {}/{}".format(running_folder,tmp_file) )
-            with open("{}/{}".format(running_folder,tmp_file), "w") as records_file:
-                records_file.write('\n'.join(vsam_records))
-        else:
-            print("TEST MODE printing Doge records and JCL")
-            print(doge_vsam_jcl)
-    else:
-        # we've already uploaded a file, do we have new records?
-        with open("{}/{}".format(running_folder,tmp_file), "r") as records_file:
-            tmp = records_file.read()
-        if new_records(tmp, '\n'.join(vsam_records)):
-            if not args.test:
-                send_jcl(hostname=args.hostname,port=args.rdrport, jcl=doge_vsam_jcl, print_jcl=args.print)
-                logger.debug("updating: {}/{}".format(running_folder,tmp_file) )
-                with open("{}/{}".format(running_folder,tmp_file), "w") as records_file:
-                    records_file.write('\n'.join(vsam_records))
-            else:
-                print("Test mode, new records found, printing JCL and old records")
-                print("OLD RECORDS: \n{}".format(tmp))
-                print("NEW RECORDS: \n{}".format('\n'.join(vsam_records)))
-                print("JCL:\n{}".format(doge_vsam_jcl))
-                
-
-    # Check if there's data on the printer queue, Process the entries, Send to dogecoind server
-    if not args.test:
-        logger.debug("Getting records from tk4- Class D")
-        sending = get_commands()
-        if len(sending) < 1:
-            logger.debug("Nothing to perform, exiting")
-        for line in sending:
-            logger.debug("Recieved Address: {} Amount: {}".format(line['amount'], line['address']))
-            if line['amount'] and line['address']:
-                m = str(Decimal(float(line['amount'].replace(',',''))).quantize(Decimal('1.00000000')))
-                logger.debug("Sending {} to {}".format(m,line['address']))
-                if not args.fake:
-                    send_doge(address=line['address'], amount=m, host=args.rpchost, rpcUser=args.rpcuser, rpcPass=args.rpcpass, rpcPort=args.rpcport)
-                else:
-                    logger.debug("Fake Mode Enabled, not sending transactions printing to terminal")
-                    print("Fake Mode Send: {} {}".format(line['address'], m))
-                # TODO: Refresh the VSAM file after we send this transaction.
-            else:
-                logger.debug("Address incorrect or amount missing. Not sending".format())
+    if args.capture:
+        args.traffic = Capture(args.capture)
+    elif args.replay:
+        args.traffic = Replay(args.replay, speed=args.replay_speed)
+        # The credentials only go in the URL, the replay never uses it
+        args.rpcuser = args.rpcuser or 'replay'
+        args.rpcpass = args.rpcpass or 'replay'
+    for profile in profiles or []:
+        profile.traffic = args.traffic
+        # Markers in the shared printer backlog for any other VSAM file are dropped
+        profile.printer_owners = {other.vsam_file.upper() for other in profiles}
+
+    profiler = None
+    if args.profiling:
+        profiler = RunProfiler(args.profile_dir or path.join(running_folder, profile_dir), top=args.profile_top)
+        profiler.start()
+
+    listener = None
+    try:
+        if not args.loop:
+            try:
+                sync(profiler=profiler)
+            except DogeError as e:
+                logger.critical(e)
+                sys.exit(-1)
+            return
+
+        if args.notify and profiles:
+            logger.warning("--notify only works for a single wallet, not --profiles")
+        elif args.notify:
+            try:
+                listener = NotifyListener(args.notify_socket or path.join(running_folder, notify_file), delay=args.notify_delay)
+            except DogeError as e:
+                logger.critical(e)
+                sys.exit(-1)
+
+        # A wallet notification cuts the wait short
+        scheduler = AdaptiveScheduler(minimum=args.poll_min, maximum=args.poll_max, backoff=args.poll_backoff, sleep=listener.wait if listener else time.sleep)
+        logger.debug("Polling the wallet and printer every %s to %s seconds", args.poll_min, args.poll_max)
+        while True:
+            due = scheduler.wait()
+            txids = listener.take() if listener else []
+            try:
+                records = None
+                if txids and 'wallet' not in due:
+                    # A full wallet pass would pick them up anyway
+                    records = notified_records(args, txids, policy=rpc_policy(args))
+                    logger.debug("Updating VSAM with %s notified transaction(s)%s", len(txids), '' if records is not None else ', nothing uploaded yet so getting the whole wallet')
+                if due or txids:
+                    active = sync(wallet='wallet' in due or bool(txids), printer='printer' in due, scheduler=scheduler, profiler=profiler, records=records)
+            except (socket.error, requests.exceptions.RequestException, DogeError) as e:
+                logger.error("Poll of %s failed: %s", ', '.join(due + txids), e)
+                active = False
+            # Notified updates leave the polling intervals alone so an idle
+            # wallet still backs off
+            if due:
+                scheduler.record(due, active=active)
+            scheduler.save()
+    finally:
+        if listener:
+            listener.close()
+        if profiler:
+            summary = profiler.stop()
+            print("Profile written to {}".format(summary))
+        if args.traffic:
+            print(args.traffic.close())
 
 if __name__ == '__main__':
     main()
@@ -7,6 +7,11 @@ import sys
 import os
 from unittest.mock import Mock, patch, mock_open, MagicMock
 from decimal import Decimal
+import json
+import time
+import argparse
+import socket
+import threading
 
 # Add PYTHON directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../PYTHON'))
@@ -141,6 +146,298 @@ class TestGenerateIDCAMSJCL:
         assert "9999999999" in jcl
 
 
+@pytest.mark.unit
+class TestPageDirectory:
+    """Test the DOGETRAN page directory"""
+
+    def test_page_directory_start_keys(self):
+        """Test one record per 7 transactions with the first key on each page"""
+        records = dogedcams.generate_fake_records(number_of_records=16)
+        keys = sorted(r[:10] for r in records[2:-1])
+        pages = dogedcams.generate_page_directory(records)
+
+        assert len(pages) == 3
+        assert pages[0] == '0000000001 {} 00003'.format(keys[0])
+        assert pages[1][:10] == '0000000002'
+        assert pages[1][11:21] == keys[7]
+        assert pages[2][11:21] == keys[14]
+
+    def test_page_directory_empty_wallet(self):
+        """Test an empty wallet still gets a page pointing at the control record"""
+        records = dogedcams.generate_fake_records(number_of_records=1)
+        assert dogedcams.generate_page_directory(records) == ['0000000001 9999999999 00001']
+
+    def test_page_directory_in_jcl(self):
+        """Test the page directory cluster is built in the same job"""
+        records = dogedcams.generate_fake_records(number_of_records=10)
+        jcl = dogedcams.generate_IDCAMS_JCL(vsam_file='doge.vsam', records=records)
+        assert 'DEFINE CLUSTER' in jcl
+        assert 'OUTDATASET(DOGE.VSAM.PAGES)' in jcl
+        jcl = dogedcams.generate_IDCAMS_JCL(vsam_file='doge.vsam', records=records, page_directory=False)
+        assert 'PAGES' not in jcl
+
+
+@pytest.mark.unit
+class TestSummaryRecords:
+    """Test the DOGEMAIN dashboard summary records"""
+
+    record = "{key:010d} {address:<034} {label:<10.10} {amount:+018.8f}"
+
+    def test_summary_records(self):
+        """Test balances, total and the last two transactions are precomputed"""
+        records = [
+            self.record.format(key=1, address=0, label="Available", amount=1234.5),
+            self.record.format(key=2, address=0, label="Pending", amount=-0.25),
+            self.record.format(key=1600000000, address='addr', label="Old", amount=1.0),
+            self.record.format(key=1600086400, address='addr', label="Kraken", amount=-1234567.5),
+            self.record.format(key=1600172800, address='addr', label="WOW MONEY", amount=42.125),
+            self.record.format(key=9999999999, address='0', amount=0, label='Control Record'),
+        ]
+        summary = dogedcams.generate_summary_records(records, now=1600172800)
+
+        assert summary[0] == ('0000000003 +0000123450000000 -0000000025000000 '
+                              '+0000123425000000 09/15/2020')
+        assert summary[1] == '0000000004 R 09/14/2020 Kraken     - 1,234,567.50000000 DOGE'
+        assert summary[2] == '0000000005 G 09/15/2020 WOW MONEY  +        42.12500000 DOGE'
+        assert len(summary[1]) == 60
+        assert len(summary[1][13:]) == 47
+
+    def test_summary_records_in_jcl(self):
+        """Test the summary records go between the balances and the transactions"""
+        records = dogedcams.generate_fake_records(number_of_records=1)
+        jcl = dogedcams.generate_IDCAMS_JCL(records=records, page_directory=False)
+        cards = jcl.split('//INDATA1  DD *\n')[1].split('\n/*')[0].split('\n')
+        assert [card[:10] for card in cards] == ['0000000001', '0000000002', '0000000003',
+                                                 '0000000004', '0000000005', '9999999999']
+
+
+@pytest.mark.unit
+class TestAddressIndex:
+    """Test the wallet address alternate index"""
+
+    def test_address_index_in_jcl(self):
+        """Test AIX, PATH and BLDINDEX are only added when asked for"""
+        records = dogedcams.generate_fake_records(number_of_records=10)
+        jcl = dogedcams.generate_IDCAMS_JCL(vsam_file='doge.vsam', records=records, address_index=True)
+        assert 'NAME( DOGE.VSAM.AIX )' in jcl
+        assert 'RELATE( DOGE.VSAM )' in jcl
+        assert 'KEYS( 34,11 )' in jcl
+        assert 'NONUNIQUEKEY' in jcl
+        assert 'PATHENTRY( DOGE.VSAM.AIX )' in jcl
+        assert 'BLDINDEX INDATASET(DOGE.VSAM)' in jcl
+        assert jcl.index('REPRO INFILE(INDATA1)') < jcl.index('BLDINDEX')
+        assert 'ALTERNATEINDEX' not in dogedcams.generate_IDCAMS_JCL(records=records)
+
+    def test_address_index_record_size(self):
+        """Test the AIX record size fits the busiest address"""
+        records = ['{:010d} {:<34} label      +00000001.00000000'.format(i, 'addr{}'.format(i % 2 or i))
+                   for i in range(10, 30)]
+        step = dogedcams.generate_address_index('DOGE.VSAM', 'PUB012', records)
+        # addr1 appears 10 times: 5 byte header + 34 byte key + 10 prime keys of 10 bytes
+        assert 'RECORDSIZE ( ' in step
+        assert ',139 )' in step
+
+
+@pytest.mark.unit
+class TestFormatRecords:
+    """Test the multi process record formatting"""
+
+    def test_workers_match_single_process(self):
+        """Test chunks formatted in worker processes join back in key order"""
+        rows = [(random_key, 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', 'label', (random_key % 1000) / 7.0)
+                for random_key in range(1000000250, 1000000000, -1)]
+        single = dogedcams.format_records(rows, workers=1, chunk_size=40)
+        multi = dogedcams.format_records(rows, workers=2, chunk_size=40)
+        assert single == multi
+        cards = multi.split(b'\n')
+        assert len(cards) == 250
+        assert cards == sorted(cards)
+        assert all(len(card) == 75 for card in cards)
+
+    def test_matches_record_layout(self):
+        """Test the positional format matches the original record layout"""
+        card = dogedcams.format_records([(9999999999, '0', 'Control Record', 0)])
+        assert card == '{key:010d} {address:<034} {label:<10.10} {amount:+018.8f}'.format(
+            key=9999999999, address='0', label='Control Record', amount=0).encode()
+
+
+@pytest.mark.unit
+class TestExternalSorter:
+    """Test sorting records on disk"""
+
+    def test_spills_merges_and_dedups(self, tmp_path):
+        """Test runs are spilled at the budget and merged in key order without duplicates"""
+        records = dogedcams.generate_fake_records(number_of_records=500)
+        shuffled = records + records[100:150]
+        import random
+        random.shuffle(shuffled)
+        with dogedcams.ExternalSorter(budget=4096, folder=str(tmp_path)) as sorter:
+            sorter.extend(shuffled)
+            assert len(sorter.runs) > 5
+            assert len(os.listdir(str(tmp_path))) == len(sorter.runs)
+            assert list(sorter.merged()) == records
+            assert sorter.duplicates == 50
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_first_card_wins(self):
+        """Test the first card added with a key is the one kept"""
+        with dogedcams.ExternalSorter(budget=200) as sorter:
+            sorter.extend(['0000000005 first', '0000000003 x', '0000000005 second', '0000000004 y'])
+            assert list(sorter.merged()) == ['0000000003 x', '0000000004 y', '0000000005 first']
+
+    @pytest.mark.parametrize('reverse', [True, False])
+    @pytest.mark.parametrize('count', [5, 9, 10, 11, 40])
+    def test_window_matches_window_records(self, count, reverse):
+        """Test windowing during the merge keeps the same records as window_records"""
+        records = dogedcams.generate_fake_records(number_of_records=count)
+        with dogedcams.ExternalSorter(budget=1000) as sorter:
+            sorter.extend(reversed(records))
+            assert sorter.merged(limit=10, reverse=reverse) == dogedcams.window_records(list(records), reverse=reverse, limit=10)
+
+    def test_fake_records_and_archive_with_budget(self, tmp_path):
+        """Test --sort-budget fake and archive decks are sorted, windowed and valid"""
+        records = dogedcams.generate_fake_records(number_of_records=20000, budget=100000, limit=7645, reverse=True)
+        assert len(records) == 7645
+        assert records == sorted(records)
+        assert dogedcams.validate_records(records) == []
+
+        archive = dogedcams.RecordArchive(str(tmp_path / 'doge.archive'))
+        archive.BLOCK_ROWS = 1000
+        archive.append(dogedcams.generate_fake_records(number_of_records=3000))
+        archive.append(dogedcams.generate_fake_records(number_of_records=3000))
+        expected = archive.records(limit=2000, reverse=False)
+        assert archive.records(budget=50000, limit=2000, reverse=False) == expected
+        assert len(expected) == 2000
+
+
+@pytest.mark.unit
+class TestRecordSnapshot:
+    """Test the memory mapped record snapshot"""
+
+    def test_lookup_and_tail(self, tmp_path):
+        """Test key lookups, slicing and the digest compare"""
+        records = dogedcams.generate_fake_records(number_of_records=50)
+        filename = str(tmp_path / 'doge.snap')
+        dogedcams.RecordSnapshot.write(filename, list(reversed(records)))
+        assert not (tmp_path / 'doge.snap.tmp').exists()
+        assert (tmp_path / 'doge.snap').stat().st_size == 80 * (len(records) + 1)
+
+        with dogedcams.RecordSnapshot(filename) as snapshot:
+            assert len(snapshot) == len(records)
+            assert snapshot.verify()
+            assert snapshot.matches(records)
+            assert not snapshot.matches(records[:-1])
+            assert snapshot.get(9999999999) == records[-1]
+            assert snapshot.get('0000000001') == records[0]
+            assert 3 not in snapshot
+            for record in records:
+                assert snapshot.find(record[:10]) is not None
+            assert snapshot.tail(10) == records[-10:]
+            assert snapshot.tail(7648) == records
+            assert snapshot.record(-1) == records[-1]
+
+    def test_bad_snapshot_is_ignored(self, tmp_path):
+        """Test a truncated or foreign file isn't used"""
+        filename = str(tmp_path / 'doge.snap')
+        dogedcams.RecordSnapshot.write(filename, dogedcams.generate_fake_records(number_of_records=5))
+        with open(filename, 'r+b') as f:
+            f.truncate(200)
+        assert dogedcams.load_snapshot(filename) is None
+        (tmp_path / 'doge.snap').write_text('')
+        assert dogedcams.load_snapshot(filename) is None
+        assert dogedcams.load_snapshot(str(tmp_path / 'missing')) is None
+
+
+@pytest.mark.unit
+class TestAdaptiveScheduler:
+    """Test the --loop polling scheduler"""
+
+    def make(self, tmp_path):
+        clock = [1000.0]
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            clock[0] += seconds
+
+        scheduler = dogedcams.AdaptiveScheduler(minimum=2, maximum=30, backoff=2,
+                                                state_file=str(tmp_path / 'doge.schedule'),
+                                                clock=lambda: clock[0], sleep=sleep)
+        return scheduler, clock, slept
+
+    def test_backs_off_when_idle(self, tmp_path):
+        """Test idle polls back off exponentially up to the maximum"""
+        scheduler, clock, slept = self.make(tmp_path)
+        assert scheduler.wait() == ['printer', 'wallet']
+        intervals = []
+        for i in range(6):
+            scheduler.record(['printer', 'wallet'], active=False)
+            intervals.append(scheduler.pollers['wallet']['interval'])
+            scheduler.wait()
+        assert intervals == [4, 8, 16, 30, 30, 30]
+        assert slept == [4, 8, 16, 30, 30, 30]
+        assert scheduler.state()['mode'] == 'idle'
+
+    def test_activity_tightens_every_poller(self, tmp_path):
+        """Test a busy printer poll pulls the backed off wallet poll in"""
+        scheduler, clock, slept = self.make(tmp_path)
+        for i in range(4):
+            scheduler.record(['printer', 'wallet'], active=False)
+        assert scheduler.pollers['wallet']['due'] == 1030
+        scheduler.record(['printer'], active=True)
+        assert scheduler.pollers['wallet']['interval'] == 2
+        assert scheduler.wait() == ['printer', 'wallet']
+        assert clock[0] == 1002
+
+        scheduler.save()
+        with open(str(tmp_path / 'doge.schedule')) as f:
+            state = json.load(f)
+        assert state['mode'] == 'active'
+        assert state['active_polls'] == 1
+        assert state['pollers']['printer']['polls'] == 5
+
+
+@pytest.mark.unit
+class TestGenerateIDCAMSJCLChunks:
+    """Test the chunked IDCAMS job generation"""
+
+    def test_chunks_are_key_ordered(self):
+        """Test first chunk defines the cluster and later chunks only REPRO"""
+        records = dogedcams.generate_fake_records(number_of_records=25)
+        chunks = dogedcams.generate_IDCAMS_JCL_chunks(vsam_file='test.vsam', records=records, chunk_size=10, page_directory=False)
+
+        assert len(chunks) == 3
+        assert 'DEFINE CLUSTER' in chunks[0]['jcl']
+        for chunk in chunks[1:]:
+            assert 'DEFINE CLUSTER' not in chunk['jcl']
+            assert 'DELETE' not in chunk['jcl']
+            assert 'OUTDATASET(TEST.VSAM)' in chunk['jcl']
+            assert 'REPLACE' in chunk['jcl']
+        for previous, chunk in zip(chunks, chunks[1:]):
+            assert previous['last_key'] < chunk['first_key']
+        # Plus the three dashboard summary records
+        assert sum(chunk['records'] for chunk in chunks) == len(records) + 3
+        assert chunks[-1]['last_key'] == '9999999999'
+
+    def test_resubmit_single_chunk(self, tmp_path):
+        """Test the manifest tracks chunks so one can be resubmitted alone"""
+        records = dogedcams.generate_fake_records(number_of_records=25)
+        chunks = dogedcams.generate_IDCAMS_JCL_chunks(records=records, chunk_size=10)
+        args = Mock(readers=None, hostname='localhost', rdrport=3505, print=False, vsam_file='DOGE.VSAM')
+
+        with patch('dogedcams.send_jcl', side_effect=[None, ConnectionRefusedError('down')]) as mock_send:
+            assert dogedcams.submit_vsam_chunks(args, chunks, folder=str(tmp_path)) is False
+        assert mock_send.call_count == 2
+        manifest = dogedcams.load_chunk_manifest(folder=str(tmp_path))
+        assert [c['status'] for c in manifest['chunks']] == ['submitted', 'failed', 'pending']
+
+        with patch('dogedcams.send_jcl') as mock_send:
+            assert dogedcams.resubmit_chunk(args, 2, folder=str(tmp_path)) is True
+        assert mock_send.call_args[1]['jcl'] == chunks[1]['jcl']
+        manifest = dogedcams.load_chunk_manifest(folder=str(tmp_path))
+        assert manifest['chunks'][1]['status'] == 'submitted'
+
+
 @pytest.mark.unit
 class TestGetRecords:
     """Test the get_records function with mocked RPC calls"""
@@ -187,7 +484,7 @@ class TestGetRecords:
         mock_post.side_effect = requests.exceptions.ConnectTimeout()
         
         with patch('configparser.ConfigParser.read_string'):
-            with pytest.raises(SystemExit):
+            with pytest.raises(dogedcams.RPCError):
                 dogedcams.get_records(
                     host='localhost',
                     rpcUser='testuser',
@@ -195,6 +492,1001 @@ class TestGetRecords:
                 )
 
 
+@pytest.mark.unit
+class TestTransactionCache:
+    """Test the gettransaction enrichment cache"""
+
+    def reply(self, payload, confirmations):
+        return Mock(json=lambda: [{'id': call['id'], 'error': None,
+                                   'result': {'txid': call['params'][0], 'fee': -0.01,
+                                              'confirmations': confirmations[call['params'][0]]}}
+                                  for call in json.loads(payload)])
+
+    def test_deeply_confirmed_are_not_refetched(self, tmp_path):
+        """Test only new and shallow transactions are fetched, in batches"""
+        confirmations = {'tx{}'.format(i): i * 50 for i in range(5)}
+        transactions = [{'txid': txid, 'confirmations': c} for txid, c in confirmations.items()]
+        state_file = str(tmp_path / 'doge.txcache')
+
+        cache = dogedcams.TransactionCache(state_file=state_file, deep_confirmations=100)
+        with patch('dogedcams.requests.post', side_effect=lambda url, headers, data, timeout: self.reply(data, confirmations)) as post:
+            assert dogedcams.enrich_transactions(('http://x', 'http://x'), transactions, cache, batch_size=2) == 5
+            assert post.call_count == 3
+        cache.save()
+
+        cache = dogedcams.TransactionCache(state_file=state_file, deep_confirmations=100)
+        assert len(cache) == 5
+        with patch('dogedcams.requests.post', side_effect=lambda url, headers, data, timeout: self.reply(data, confirmations)) as post:
+            # tx2, tx3 and tx4 have 100+ confirmations and are left alone
+            assert dogedcams.enrich_transactions(('http://x', 'http://x'), transactions, cache, batch_size=2) == 2
+            assert post.call_count == 1
+            assert [call['params'][0] for call in json.loads(post.call_args[1]['data'])] == ['tx0', 'tx1']
+        assert cache.hits == 3
+        assert cache.get('tx4')['fee'] == -0.01
+
+    def test_bad_batch_replies_are_skipped(self, tmp_path):
+        """Test a null id, an unknown id or a whole batch error don't lose the other transactions"""
+        transactions = [{'txid': 'tx{}'.format(i), 'confirmations': 1} for i in range(6)]
+        good = {'txid': 'tx0', 'fee': -0.01, 'confirmations': 1}
+        replies = [Mock(json=lambda: [{'id': 0, 'error': None, 'result': good},
+                                      {'id': None, 'error': {'code': -32600, 'message': 'Invalid Request'}, 'result': None}]),
+                   Mock(json=lambda: {'id': None, 'error': {'code': -32700, 'message': 'Parse error'}, 'result': None}),
+                   Mock(json=lambda: [{'id': 7, 'error': None, 'result': dict(good, txid='tx5')},
+                                      {'id': 1, 'error': None, 'result': dict(good, txid='tx5')}])]
+        cache = dogedcams.TransactionCache(state_file=str(tmp_path / 'doge.txcache'))
+        with patch('dogedcams.requests.post', side_effect=replies), \
+             patch.object(dogedcams.logger, 'warning') as warning:
+            assert dogedcams.enrich_transactions(('http://x', 'http://x'), transactions, cache, batch_size=2) == 6
+        assert sorted(cache.entries) == ['tx0', 'tx5']
+        assert cache.fetched == 2
+        assert warning.call_count == 3
+
+    def test_least_recently_used_is_dropped(self, tmp_path):
+        """Test the cache stays within capacity"""
+        cache = dogedcams.TransactionCache(state_file=str(tmp_path / 'doge.txcache'), capacity=2)
+        cache.put({'txid': 'a'})
+        cache.put({'txid': 'b'})
+        cache.get('a')
+        cache.put({'txid': 'c'})
+        assert 'a' in cache and 'c' in cache and 'b' not in cache
+
+
+@pytest.mark.unit
+class TestProfiles:
+    """Test syncing several wallet profiles"""
+
+    def test_profiles_override_options(self, tmp_path):
+        """Test each ini section becomes its own copy of the options"""
+        ini = tmp_path / 'wallets.ini'
+        ini.write_text('[DEFAULT]\nvolume = pub001\n\n'
+                       '[doge]\nrpcuser = doge\n\n'
+                       '[ltc]\nrpcport = 9332\nvsam_file = LTC.VSAM\nprinter = no\nchunk-size = 500\n')
+        args = argparse.Namespace(rpcport='22555', rpcuser=None, vsam_file='DOGE.VSAM', volume='pub012',
+                                  printer=True, chunk_size=None, stale_after=900)
+        doge, ltc = dogedcams.load_profiles(str(ini), args, types={'chunk_size': int})
+        assert (doge.profile, doge.rpcuser, doge.vsam_file, doge.volume, doge.printer) == ('doge', 'doge', 'DOGE.VSAM', 'pub001', True)
+        assert (ltc.rpcport, ltc.vsam_file, ltc.printer, ltc.chunk_size) == ('9332', 'LTC.VSAM', False, 500)
+        assert doge.state_folder != ltc.state_folder
+        assert args.vsam_file == 'DOGE.VSAM'
+
+    def test_profile_lists(self, tmp_path):
+        """Test options that take several values are split in to a list"""
+        ini = tmp_path / 'wallets.ini'
+        ini.write_text('[doge]\nreaders = hostA:3505 hostB,hostC:3515\n')
+        args = argparse.Namespace(readers=None)
+        doge, = dogedcams.load_profiles(str(ini), args, lists={'readers'})
+        assert doge.readers == ['hostA:3505', 'hostB,hostC:3515']
+        assert dogedcams.parse_reader_targets(doge.readers) == [('hostA', 3505), ('hostB', 3505), ('hostC', 3515)]
+
+    def test_profiles_run_together_through_one_reader(self):
+        """Test wallets sync in parallel but reach the reader one at a time"""
+        reading = []
+        overlaps = []
+
+        def send(args, jcl):
+            reading.append(args.profile)
+            if len(reading) > 1:
+                overlaps.append(list(reading))
+            time.sleep(0.05)
+            reading.remove(args.profile)
+            return True
+
+        def run(args, **kwargs):
+            time.sleep(0.2)
+            return {'submitted': dogedcams.submit_vsam_update(args, 'JCL'), 'commands': 0, 'jobs': 0}
+
+        profiles = [argparse.Namespace(profile=name) for name in ('doge', 'ltc', 'test')]
+        begin = time.time()
+        with patch('dogedcams.run', side_effect=run), patch('dogedcams.send_vsam_update', side_effect=send):
+            results = dogedcams.sync_profiles(profiles, parallel=3)
+        assert time.time() - begin < 0.5
+        assert sorted(results) == ['doge', 'ltc', 'test']
+        assert all(result['submitted'] for result in results.values())
+        assert overlaps == []
+
+    def test_single_wallet_uses_script_folder(self, capsys):
+        """Test a plain run without --profiles keeps its state next to the script"""
+        with patch.object(sys, 'argv', ['dogedcams.py', '--fake', '5', '--test', '--force']):
+            dogedcams.main()
+        assert 'DEFINE CLUSTER' in capsys.readouterr().out
+
+    def test_failed_profile_does_not_stop_the_others(self):
+        """Test one wallet exiting doesn't take the rest down"""
+        def run(args, **kwargs):
+            if args.profile == 'ltc':
+                sys.exit(-1)
+            return {'submitted': True}
+
+        profiles = [argparse.Namespace(profile=name) for name in ('doge', 'ltc')]
+        with patch('dogedcams.run', side_effect=run):
+            assert dogedcams.sync_profiles(profiles) == {'doge': {'submitted': True}, 'ltc': None}
+
+    def test_shared_printer(self, tmp_path):
+        """Test a printer = no wallet only takes its own markers and leaves the rest for the others"""
+        printed = [{'address': 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', 'amount': '1.00'}]
+
+        def get_commands(done_jobs=None, **kwargs):
+            done_jobs.extend(['LTC.VSAM.0A0B0C0D', 'DOGE.VSAM.1A2B3C4D'])
+            return list(printed)
+
+        argv = ['dogedcams.py', '--rpcuser', 'u', '--rpcpass', 'p', '--force', '--coalesce']
+        with patch.object(dogedcams, 'running_folder', str(tmp_path)), \
+             patch('dogedcams.get_records', return_value=dogedcams.generate_fake_records(number_of_records=5)), \
+             patch('dogedcams.get_commands', side_effect=get_commands), \
+             patch('dogedcams.send_doge', return_value='txid') as send, \
+             patch('dogedcams.send_jcl'):
+            with patch.object(sys, 'argv', argv + ['--vsam_file', 'LTC.VSAM', '--no-printer']):
+                dogedcams.main()
+            send.assert_not_called()
+            backlog = json.loads((tmp_path / dogedcams.printer_file).read_text())
+            assert [command.get('done') for command in backlog] == ['DOGE.VSAM.1A2B3C4D', None]
+            # The paying wallet gets the send and its marker from the backlog
+            printed = []
+            with patch.object(sys, 'argv', argv):
+                dogedcams.main()
+            send.assert_called_once()
+            assert send.call_args[1]['address'] == 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu'
+            assert [command['done'] for command in json.loads((tmp_path / dogedcams.printer_file).read_text())] == ['LTC.VSAM.0A0B0C0D']
+
+    def test_shared_printer_backlog_expires(self, tmp_path):
+        """Test unclaimed sends and markers of wallets that are gone don't stay in the backlog"""
+        filename = str(tmp_path / dogedcams.printer_file)
+        send = {'address': 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', 'amount': '1.00'}
+        backlog = [dict(send, seen=time.time() - 1000), {'done': 'LTC.VSAM.0A0B0C0D', 'seen': time.time() - 10},
+                   {'done': 'OLD.VSAM.0A0B0C0D', 'seen': time.time() - 10}]
+        with open(filename, 'w') as f:
+            json.dump(backlog, f)
+        with patch.object(dogedcams.logger, 'warning') as warning:
+            own = dogedcams.share_printer([send], lambda command: False, stale_after=900, filename=filename,
+                                          owners={'DOGE.VSAM', 'LTC.VSAM'})
+        assert own == []
+        kept = json.loads(open(filename).read())
+        assert [(command.get('done'), command.get('address')) for command in kept] == [
+            ('LTC.VSAM.0A0B0C0D', None), (None, send['address'])]
+        assert warning.call_count == 2
+        assert 'DOGESEND' in warning.call_args_list[0][0][0]
+        assert warning.call_args_list[1][0][2] == 'OLD.VSAM'
+
+
+@pytest.mark.unit
+class TestLogging:
+    """Test lazy, sampled and JSON logging"""
+
+    def get_records(self, transactions, **kwargs):
+        replies = [Mock(json=lambda: {'result': 1000.0}), Mock(json=lambda: {'result': 50.0}),
+                   Mock(json=lambda: {'result': transactions})]
+        with patch('dogedcams.requests.post', side_effect=replies), \
+             patch('builtins.open', mock_open(read_data='rpcuser=testuser\n')), \
+             patch('configparser.ConfigParser.read_string'):
+            return dogedcams.get_records(rpcUser='testuser', rpcPass='testpass', **kwargs)
+
+    def transactions(self, count):
+        return [{'timereceived': 1600000000 + i, 'address': 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu',
+                 'amount': 1.0, 'label': 'Test'} for i in range(count)]
+
+    def test_per_record_debug_is_sampled(self, caplog):
+        """Test --debug-sample only logs every Nth transaction"""
+        with caplog.at_level(dogedcams.logging.DEBUG, logger='dogedcams'):
+            records = self.get_records(self.transactions(9), debug_sample=3)
+        added = [r for r in caplog.records if r.getMessage().startswith('Adding the following record: 16')]
+        assert len(records) == 12
+        assert len(added) == 3
+
+    def test_no_record_formatting_at_warning(self, caplog):
+        """Test per transaction messages aren't built at the default level"""
+        with caplog.at_level(dogedcams.logging.WARNING, logger='dogedcams'), \
+             patch.object(dogedcams.logger, 'debug') as debug:
+            self.get_records(self.transactions(50))
+        assert all('Adding the following record: %s' != call[0][0] for call in debug.call_args_list)
+
+    def test_json_formatter(self):
+        """Test --log-json keeps the message and its arguments"""
+        record = dogedcams.logging.LogRecord('dogedcams', dogedcams.logging.ERROR, __file__, 1,
+                                             'Submitting chunk %s failed: %s', (3, 'down'), None, func='submit')
+        entry = json.loads(dogedcams.JSONFormatter().format(record))
+        assert entry['message'] == 'Submitting chunk 3 failed: down'
+        assert entry['args'] == [3, 'down']
+        assert entry['level'] == 'ERROR'
+        assert entry['function'] == 'submit'
+
+
+@pytest.mark.unit
+class TestRunProfiler:
+    """Test --profile output"""
+
+    def test_profile_reports_every_phase(self, tmp_path):
+        """Test stats, summary and per phase memory are written"""
+        profiler = dogedcams.RunProfiler(str(tmp_path / 'prof'), top=50)
+        profiler.start()
+        records = dogedcams.generate_fake_records(number_of_records=200)
+        profiler.phase('records built')
+        dogedcams.generate_IDCAMS_JCL(records=records)
+        profiler.phase('JCL rendered', wallet='doge')
+        summary = profiler.stop()
+
+        base = summary[:-len('.txt')]
+        assert os.path.isfile(base + '.prof')
+        with open(summary) as f:
+            report = f.read()
+        assert 'generate_fake_records' in report
+        assert 'records built at' in report
+        assert 'doge JCL rendered at' in report
+        assert 'grew since records built' in report
+        with open(base + '.json') as f:
+            phases = json.load(f)['phases']
+        assert [phase['phase'] for phase in phases] == ['records built', 'doge JCL rendered', 'end']
+        assert all(phase['peak'] >= phase['current'] for phase in phases)
+
+    def test_profile_threads_not_itself(self, tmp_path):
+        """Test worker threads are profiled, phase() isn't and only max_phases are kept"""
+        import concurrent.futures
+        profiler = dogedcams.RunProfiler(str(tmp_path / 'prof'), top=50, max_phases=3)
+        profiler.start()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            records = pool.submit(dogedcams.generate_fake_records, number_of_records=200).result()
+        for i in range(5):
+            profiler.phase('pass {}'.format(i))
+        summary = profiler.stop()
+        with open(summary) as f:
+            report = f.read()
+        assert 'generate_fake_records' in report
+        assert 'filter_traces' not in report
+        assert 'the first 3 phases were dropped' in report
+        with open(summary[:-len('.txt')] + '.json') as f:
+            assert [phase['phase'] for phase in json.load(f)['phases']] == ['pass 3', 'pass 4', 'end']
+
+    def test_profile_started_threads(self, tmp_path):
+        """Test threads started under the profiler are in the stats on every python (sys.monitoring from 3.12)"""
+        import threading
+        import pstats
+        profiler = dogedcams.RunProfiler(str(tmp_path / 'prof'))
+        profiler.start()
+        threads = [threading.Thread(target=dogedcams.generate_fake_records, kwargs={'number_of_records': 50}),
+                   threading.Thread(target=profiler.phase, args=('in a thread',))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        summary = profiler.stop()
+        functions = [function for _, _, function in pstats.Stats(summary[:-len('.txt')] + '.prof').stats]
+        assert 'generate_fake_records' in functions
+        assert 'take_snapshot' not in functions
+
+
+@pytest.mark.unit
+class TestValidateRecords:
+    """Test the record deck validation"""
+
+    def test_good_deck(self):
+        """Test generated records pass"""
+        assert dogedcams.validate_records(dogedcams.generate_fake_records(number_of_records=500)) == []
+
+    def test_bad_cards_are_reported(self):
+        """Test every kind of bad card is pinpointed"""
+        records = dogedcams.generate_fake_records(number_of_records=10)
+        records[3] = records[2]
+        records[5], records[6] = records[6], records[5]
+        records[7] = records[7][:11] + 'bc1qar0srrr7xfkvy5l643lydnw9re59gtzzwf5mdq' + records[7][45:]
+        records[8] = records[8][:-18] + '+123456789.12345678'
+        del records[-1]
+        problems = dogedcams.validate_records(records)
+        assert [(problem['card'], problem['problem'].split(' ')[0]) for problem in problems] == [
+            (4, 'duplicate'), (7, 'key'), (8, 'card'), (9, 'a'), (11, 'control')]
+
+    def test_long_card(self):
+        """Test a card over 80 bytes is caught"""
+        records = dogedcams.generate_fake_records(number_of_records=2)
+        records[1] = records[1] + ' ' * 10
+        assert 'RECORDSIZE' in dogedcams.validate_records(records)[0]['problem']
+
+    def test_same_problems_without_numpy(self):
+        """Test the packed numpy check and the plain python one find the same cards"""
+        records = dogedcams.generate_fake_records(number_of_records=10)
+        records[2] = records[2][:46] + 'Café      ' + records[2][56:]
+        records[4] = records[3]
+        records[6] = records[6][:57] + '*' + records[6][58:]
+        pages = dogedcams.generate_page_directory(records, rows=3)
+        pages[1] = pages[1][:-1]
+        with_numpy = dogedcams.validate_records(records, pages)
+        with patch.object(dogedcams, 'numpy', None):
+            assert dogedcams.validate_records(records, pages) == with_numpy
+        assert [(problem['card'], problem['problem']) for problem in with_numpy] == [
+            (3, "card has characters that can't be sent to the reader"), (5, 'duplicate key'),
+            (7, "card doesn't match the key/address/label/amount layout"),
+            (14, 'page directory a field overflows its column, card is 26 bytes instead of 27')]
+
+    def test_the_deck_as_sent_is_checked(self):
+        """Test a dashboard total too big for its column stops the job"""
+        records = dogedcams.generate_fake_records(number_of_records=5)
+        records[0] = '0000000001 {:<034} {:<10.10} {:+018.8f}'.format(0, 'Available', 60000000)
+        records[1] = '0000000002 {:<034} {:<10.10} {:+018.8f}'.format(0, 'Pending', 50000000)
+        assert dogedcams.validate_records(records) == []
+        with pytest.raises(dogedcams.RecordError) as bad:
+            dogedcams.generate_IDCAMS_JCL(records=records, validate=True)
+        assert [(problem['card'], problem['key']) for problem in bad.value.problems] == [(3, '0000000003')]
+        with pytest.raises(dogedcams.RecordError):
+            dogedcams.generate_IDCAMS_JCL_chunks(records=records, chunk_size=2, validate=True)
+        # Without the summary cards the same deck is fine
+        assert 'DEFINE CLUSTER' in dogedcams.generate_IDCAMS_JCL(records=records, summary=False, validate=True)
+
+    def test_bad_deck_is_not_sent(self, capsys):
+        """Test run() never submits a deck that failed validation"""
+        bad = dogedcams.generate_fake_records(number_of_records=5)[:-1]
+        with patch('dogedcams.generate_fake_records', return_value=bad), \
+             patch('dogedcams.submit_vsam_update') as submit, \
+             patch('dogedcams.get_commands', return_value=[]), \
+             patch.object(sys, 'argv', ['dogedcams.py', '--fake', '5', '--force', '--no-printer']):
+            dogedcams.main()
+        submit.assert_not_called()
+
+
+@pytest.mark.unit
+class TestOverlappedRun:
+    """Test the printer pass running alongside the wallet pass"""
+
+    argv = ['dogedcams.py', '--rpcuser', 'u', '--rpcpass', 'p', '--force']
+
+    def slow(self, seconds, result=None, error=None):
+        def call(*args, **kwargs):
+            time.sleep(seconds)
+            if error:
+                raise error
+            return result
+        return call
+
+    def meet(self, barrier, met, name, result):
+        """A call that only returns before the timeout if the other side is running too"""
+        def call(*args, **kwargs):
+            try:
+                barrier.wait()
+                met.append(name)
+            except threading.BrokenBarrierError:
+                pass
+            return result
+        return call
+
+    def test_wall_time_is_the_longest_phase(self, tmp_path):
+        """Test the printer drain and sends overlap the wallet fetch and render"""
+        records = dogedcams.generate_fake_records(number_of_records=20)
+        command = [{'address': 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', 'amount': '1.00'}]
+        # Each side waits for the other in the middle of its phase, run one
+        # after the other the first to get there gives up and neither meets
+        both = threading.Barrier(2, timeout=5)
+        met = []
+        with patch.object(dogedcams, 'running_folder', str(tmp_path)), \
+             patch('dogedcams.get_records', side_effect=self.meet(both, met, 'wallet', records)), \
+             patch('dogedcams.get_commands', side_effect=self.meet(both, met, 'printer', command)), \
+             patch('dogedcams.send_doge', return_value='txid') as send, \
+             patch('dogedcams.send_jcl') as submit, \
+             patch.object(sys, 'argv', self.argv):
+            dogedcams.main()
+        assert sorted(met) == ['printer', 'wallet']
+        send.assert_called_once()
+        submit.assert_called_once()
+
+    def test_profile_sees_the_printer_thread(self, tmp_path):
+        """Test --profile has the printer drain's CPU, not just the wallet pass"""
+        records = dogedcams.generate_fake_records(number_of_records=20)
+        with patch.object(dogedcams, 'running_folder', str(tmp_path)), \
+             patch('dogedcams.get_records', return_value=records), \
+             patch('dogedcams.get_commands', side_effect=self.slow(0.1, [])), \
+             patch('dogedcams.send_jcl'), \
+             patch.object(sys, 'argv', self.argv + ['--profile', '--profile-dir', str(tmp_path / 'prof')]):
+            dogedcams.main()
+        summary, = [name for name in os.listdir(str(tmp_path / 'prof')) if name.endswith('.txt')]
+        with open(str(tmp_path / 'prof' / summary)) as f:
+            report = f.read()
+        assert 'printer_pass' in report
+        assert 'printer drained at' in report
+
+    def test_printer_errors_are_raised_after_the_wallet_pass(self, tmp_path):
+        """Test a failed drain doesn't stop the VSAM job and is still raised"""
+        records = dogedcams.generate_fake_records(number_of_records=20)
+        with patch.object(dogedcams, 'running_folder', str(tmp_path)), \
+             patch('dogedcams.get_records', side_effect=self.slow(0.1, records)), \
+             patch('dogedcams.get_commands', side_effect=ConnectionRefusedError('printer down')), \
+             patch('dogedcams.send_jcl') as submit, \
+             patch.object(sys, 'argv', self.argv):
+            with pytest.raises(ConnectionRefusedError):
+                dogedcams.main()
+        submit.assert_called_once()
+
+    def test_sends_finish_when_the_wallet_pass_fails(self, tmp_path):
+        """Test a wallet error waits for the sends in flight before the run gives up"""
+        command = [{'address': 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', 'amount': '1.00'}]
+        with patch.object(dogedcams, 'running_folder', str(tmp_path)), \
+             patch('dogedcams.get_records', side_effect=dogedcams.RPCError('wallet down')), \
+             patch('dogedcams.get_commands', return_value=command), \
+             patch('dogedcams.send_doge', side_effect=self.slow(0.2, 'txid')) as send, \
+             patch.object(sys, 'argv', self.argv):
+            with pytest.raises(SystemExit):
+                dogedcams.main()
+        send.assert_called_once()
+
+    def test_coalesce_waits_for_the_drain(self, tmp_path):
+        """Test --coalesce releases the held job once the drain shows the last one finished"""
+        records = dogedcams.generate_fake_records(number_of_records=20)
+        queue = dogedcams.SubmissionQueue(None, state_file=str(tmp_path / 'doge.queue'))
+        queue.inflight = {'token': 'CAFEF00D', 'submitted': time.time()}
+        queue.save()
+
+        def get_commands(done_jobs=None, **kwargs):
+            time.sleep(0.2)
+            done_jobs.append('CAFEF00D')
+            return []
+
+        with patch.object(dogedcams, 'running_folder', str(tmp_path)), \
+             patch('dogedcams.get_records', return_value=records), \
+             patch('dogedcams.get_commands', side_effect=get_commands), \
+             patch('dogedcams.send_jcl') as submit, \
+             patch.object(sys, 'argv', self.argv + ['--coalesce']):
+            dogedcams.main()
+        submit.assert_called_once()
+        assert dogedcams.SubmissionQueue(None, state_file=str(tmp_path / 'doge.queue')).inflight['token'] != 'CAFEF00D'
+
+
+@pytest.mark.unit
+class TestCaptureReplay:
+    """Test recording traffic and playing it back offline"""
+
+    transactions = [{'timereceived': 1600000000 + i, 'address': 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu',
+                     'amount': 1.5, 'label': 'Test'} for i in range(5)]
+    printed = b"DOGECICS99 nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu 1,234.50\n"
+
+    def capture(self, filename):
+        import requests
+        replies = [Mock(json=lambda: {'result': 100.0, 'error': None}), requests.exceptions.ReadTimeout('slow'),
+                   Mock(json=lambda: {'result': 1.0, 'error': None}),
+                   Mock(json=lambda: {'result': self.transactions, 'error': None})]
+        sock = Mock()
+        sock.recv.side_effect = [self.printed, BlockingIOError()] + [BlockingIOError()] * 1000
+        capture = dogedcams.Capture(filename)
+        with patch('dogedcams.requests.post', side_effect=replies), \
+             patch('dogedcams.socket.socket', return_value=sock):
+            policy = dogedcams.RPCPolicy(sleep=Mock())
+            records = dogedcams.get_records(rpcUser='u', rpcPass='p', policy=policy, traffic=capture)
+            dogedcams.send_jcl(jcl='//DOGEVSM JOB', traffic=capture)
+            commands = dogedcams.get_commands(timeout=0.05, traffic=capture)
+            capture.close()
+        return records, commands, sock
+
+    def test_replay_without_network(self, tmp_path):
+        """Test a replay gives the same records and commands with no wallet, reader or printer"""
+        filename = str(tmp_path / 'doge.capture')
+        records, commands, sock = self.capture(filename)
+        assert sock.sendall.call_args[0][0] == b'//DOGEVSM JOB'
+        assert len(commands) == 1
+
+        replay = dogedcams.Replay(filename, speed=0)
+        with patch('dogedcams.requests.post', side_effect=AssertionError('network used')), \
+             patch('dogedcams.socket.socket', side_effect=AssertionError('network used')):
+            begin = time.time()
+            assert dogedcams.get_records(rpcUser='u', rpcPass='p', policy=dogedcams.RPCPolicy(sleep=Mock()), traffic=replay) == records
+            dogedcams.send_jcl(jcl='//DOGEVSM JOB CHANGED', traffic=replay)
+            assert dogedcams.get_commands(timeout=2, traffic=replay) == commands
+            # Nothing is waited for at full speed, not even the printer going quiet
+            assert time.time() - begin < 0.5
+        assert replay.stats == {'rpc': 4, 'missing': 0, 'reader': 1, 'differ': 1, 'printer': 1}
+
+    def test_replay_speed(self, tmp_path):
+        """Test captured wallet latency is replayed divided by the speed"""
+        filename = str(tmp_path / 'doge.capture')
+        capture = dogedcams.Capture(filename)
+        with patch('dogedcams.requests.post', side_effect=self.slow_reply):
+            dogedcams.rpc_call(('http://x', 'http://x'), 'getbalance', traffic=capture)
+            capture.close()
+        sleep = Mock()
+        replay = dogedcams.Replay(filename, speed=4, sleep=sleep)
+        assert dogedcams.rpc_call(('http://x', 'http://x'), 'getbalance', traffic=replay) == 7.0
+        with pytest.raises(dogedcams.RPCError, match="isn't in the capture"):
+            dogedcams.rpc_call(('http://x', 'http://x'), 'getbalance', traffic=replay)
+        assert 0.05 <= sleep.call_args[0][0] < 0.1
+
+    def slow_reply(self, *args, **kwargs):
+        time.sleep(0.2)
+        return Mock(json=lambda: {'result': 7.0, 'error': None})
+
+
+@pytest.mark.unit
+class TestWalletNotify:
+    """Test walletnotify txids reaching a running --loop --notify"""
+
+    txid = 'ab' * 32
+
+    def test_notify_reaches_listener(self, tmp_path):
+        """Test dogedcams.py notify hands txids to the listener and wakes it up"""
+        socket_file = str(tmp_path / 'doge.notify')
+        listener = dogedcams.NotifyListener(socket_file, delay=0)
+        try:
+            begin = time.time()
+            dogedcams.notify_main([self.txid, '--socket', socket_file])
+            listener.wait(5)
+            assert time.time() - begin < 2
+            assert listener.take() == [self.txid]
+            dogedcams.notify_main([self.txid.upper(), 'not-a-txid', '--socket', socket_file])
+            listener.wait(5)
+            assert listener.take() == [self.txid]
+            assert listener.take() == []
+        finally:
+            listener.close()
+        assert not os.path.exists(socket_file)
+
+    def test_notify_socket_is_not_taken_over(self, tmp_path):
+        """Test a second listener leaves a running listener's socket and a regular file alone"""
+        socket_file = str(tmp_path / 'doge.notify')
+        listener = dogedcams.NotifyListener(socket_file, delay=0)
+        try:
+            with pytest.raises(dogedcams.DogeError):
+                dogedcams.NotifyListener(socket_file, delay=0)
+            dogedcams.notify_main([self.txid, '--socket', socket_file])
+            listener.wait(5)
+            assert listener.take() == [self.txid]
+        finally:
+            listener.close()
+        not_a_socket = tmp_path / 'doge.conf'
+        not_a_socket.write_text('rpcuser=doge\n')
+        with pytest.raises(dogedcams.DogeError):
+            dogedcams.NotifyListener(str(not_a_socket), delay=0)
+        assert not_a_socket.read_text() == 'rpcuser=doge\n'
+
+    def test_stale_notify_socket_is_replaced(self, tmp_path):
+        """Test a socket left behind with nothing listening is replaced"""
+        socket_file = str(tmp_path / 'doge.notify')
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(socket_file)
+        stale.close()
+        assert os.path.exists(socket_file)
+        listener = dogedcams.NotifyListener(socket_file, delay=0)
+        try:
+            dogedcams.notify_main([self.txid, '--socket', socket_file])
+            listener.wait(5)
+            assert listener.take() == [self.txid]
+        finally:
+            listener.close()
+
+    def test_notify_without_listener(self, tmp_path):
+        """Test walletnotify with nothing listening fails without hanging"""
+        with pytest.raises(SystemExit):
+            dogedcams.notify_main([self.txid, '--socket', str(tmp_path / 'doge.notify')])
+
+    def test_notified_records_only_fetch_the_transaction(self, tmp_path):
+        """Test a notification merges one gettransaction in to the last upload"""
+        deck = dogedcams.generate_fake_records(number_of_records=10)
+        (tmp_path / 'doge.tmp').write_text('\n'.join(deck))
+        args = argparse.Namespace(snapshot=False, rpchost='localhost', rpcport=22555, rpcuser='u', rpcpass='p')
+        transaction = {'txid': self.txid, 'amount': 12.5, 'timereceived': 1700000000,
+                       'details': [{'address': 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', 'category': 'receive', 'amount': 12.5, 'label': 'Tip'}]}
+        replies = [Mock(json=lambda: {'result': 5.0, 'error': None}), Mock(json=lambda: {'result': 0.0, 'error': None}),
+                   Mock(json=lambda: {'result': transaction, 'error': None})]
+        with patch('dogedcams.requests.post', side_effect=replies) as post:
+            records = dogedcams.notified_records(args, [self.txid], folder=str(tmp_path))
+        assert [json.loads(call[1]['data'])['method'] for call in post.call_args_list] == ['getbalance', 'getunconfirmedbalance', 'gettransaction']
+        assert len(records) == len(deck) + 1
+        assert records == sorted(records)
+        assert records[0].startswith('0000000001') and records[0].endswith('+00000005.00000000')
+        assert any(record.startswith('1700000000') and 'Tip' in record for record in records)
+        assert dogedcams.validate_records(records) == []
+        assert dogedcams.notified_records(args, [self.txid], folder=str(tmp_path / 'nothing')) is None
+
+
+@pytest.mark.unit
+class TestRecordArchive:
+    """Test the columnar transaction archive"""
+
+    def test_append_only_new_transactions(self, tmp_path):
+        """Test repeated syncs only add what's new and the records round trip"""
+        filename = str(tmp_path / 'doge.archive')
+        records = dogedcams.generate_fake_records(number_of_records=300)
+        archive = dogedcams.RecordArchive(filename)
+        assert archive.append(records[:150]) == 148
+        assert archive.append(records) == 151
+        assert archive.append(records) == 0
+
+        archive = dogedcams.RecordArchive(filename)
+        assert len(archive) == 299
+        assert len(archive.blocks) == 2
+        rebuilt = archive.records()
+        # Available and Pending are the synced balances, not a sum of the history
+        assert rebuilt == records
+        assert len(archive.addresses) == 1
+        assert dogedcams.validate_records(rebuilt) == []
+        assert archive.records(budget=1024) == records
+        assert archive.records(start=int(records[10][:10]), end=int(records[20][:10]))[:2] == records[:2]
+
+    def test_from_archive_dates_are_utc(self, tmp_path, monkeypatch):
+        """Test --since/--until pick the same UTC days as the report subcommand"""
+        monkeypatch.setenv('TZ', 'America/Sao_Paulo')
+        time.tzset()
+        try:
+            with patch.object(dogedcams, 'running_folder', str(tmp_path)), \
+                 patch('dogedcams.RecordArchive.records', return_value=dogedcams.generate_fake_records(5)) as records, \
+                 patch.object(sys, 'argv', ['dogedcams.py', '--from-archive', '--since', '2021-01-01', '--until', '2021-01-31', '--test', '--force']):
+                dogedcams.main()
+        finally:
+            monkeypatch.delenv('TZ')
+            time.tzset()
+        assert (records.call_args[1]['start'], records.call_args[1]['end']) == (1609459200, 1612137599)
+
+    def test_append_reads_only_overlapping_blocks(self, tmp_path):
+        """Test a sync of recent transactions only reads the blocks they could be in"""
+        archive = dogedcams.RecordArchive(str(tmp_path / 'doge.archive'))
+        rows = [(1500000000 + i, 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', 'label', i) for i in range(40)]
+        records = dogedcams.format_records(rows).decode().split('\n')
+        for start in range(0, 40, 10):
+            archive.append(records[start:start + 10])
+        with patch.object(archive, 'read_block', wraps=archive.read_block) as read_block:
+            assert archive.append(records[35:]) == 0
+        assert read_block.call_count == 1
+        assert len(archive) == 40
+
+    def test_range_scan_skips_blocks(self, tmp_path):
+        """Test min/max keys keep a range scan to the blocks it needs"""
+        filename = str(tmp_path / 'doge.archive')
+        archive = dogedcams.RecordArchive(filename)
+        rows = [(1500000000 + i, 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', 'label{}'.format(i % 3), i) for i in range(30)]
+        records = dogedcams.format_records(rows).decode().split('\n')
+        for start in range(0, 30, 10):
+            archive.append(records[start:start + 10])
+        with patch.object(archive, 'read_block', wraps=archive.read_block) as read_block:
+            found = archive.scan(1500000012, 1500000017)
+        assert read_block.call_count == 1
+        assert [row[0] for row in found] == list(range(1500000012, 1500000018))
+        assert found[0][2] == 'label0' and found[0][3] == 12
+
+    def test_torn_block_is_ignored(self, tmp_path):
+        """Test a block cut short by a crash is dropped and overwritten"""
+        filename = str(tmp_path / 'doge.archive')
+        records = dogedcams.generate_fake_records(number_of_records=20)
+        dogedcams.RecordArchive(filename).append(records[:10])
+        size = os.path.getsize(filename)
+        dogedcams.RecordArchive(filename).append(records)
+        with open(filename, 'r+b') as f:
+            f.truncate(os.path.getsize(filename) - 5)
+        archive = dogedcams.RecordArchive(filename)
+        assert len(archive) == 8
+        assert archive.append(records) == 11
+        assert len(dogedcams.RecordArchive(filename)) == 19
+        assert os.path.getsize(filename) > size
+
+
+@pytest.mark.unit
+class TestReport:
+    """Test the report/query subcommand"""
+
+    def archive(self, folder):
+        # 2021-01-01, 2021-01-31 and 2021-02-01 UTC
+        rows = [(1609459200, 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', 'Kraken', 100),
+                (1612051200, 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', 'MTGOX', -25.5),
+                (1612137600, 'nXYZabcdefghijklmnopqrstuvwxyz1234', 'Kraken', 0.00000001)]
+        records = dogedcams.format_records(rows).decode().split('\n')
+        dogedcams.RecordArchive(os.path.join(folder, dogedcams.archive_file)).append(records)
+
+    @pytest.mark.parametrize('use_numpy', [True, False])
+    def test_reports(self, tmp_path, use_numpy):
+        """Test every report gives the same answer with and without numpy"""
+        if use_numpy:
+            pytest.importorskip('numpy')
+        self.archive(str(tmp_path))
+        ledger = dogedcams.load_ledger(str(tmp_path))
+        with patch.object(dogedcams, 'numpy', dogedcams.numpy if use_numpy else None):
+            assert dogedcams.report(ledger, 'monthly') == (['month', 'count', 'received', 'sent', 'net'], [
+                ('2021-01', 2, '100.00000000', '-25.50000000', '74.50000000'),
+                ('2021-02', 1, '0.00000001', '0.00000000', '0.00000001')])
+            assert dogedcams.report(ledger, 'balance', period='day')[1] == [
+                ('2021-01-01', 1, '100.00000000', '100.00000000'),
+                ('2021-01-31', 1, '-25.50000000', '74.50000000'),
+                ('2021-02-01', 1, '0.00000001', '74.50000001')]
+            assert dogedcams.report(ledger, 'labels')[1] == [
+                ('Kraken', 2, '100.00000001', '0.00000000', '100.00000001'),
+                ('MTGOX', 1, '0.00000000', '-25.50000000', '-25.50000000')]
+            assert dogedcams.report(ledger, 'monthly', since=1612051200, label='Kraken')[1] == [
+                ('2021-02', 1, '0.00000001', '0.00000000', '0.00000001')]
+
+    def test_report_subcommand(self, tmp_path, capsys):
+        """Test the subcommand reads local files only and writes JSON"""
+        self.archive(str(tmp_path))
+        with patch.object(sys, 'argv', ['dogedcams.py', 'report', 'labels', '--output', 'json', '--folder', str(tmp_path)]), \
+             patch('dogedcams.requests.post') as post, patch('dogedcams.socket.socket') as sock:
+            dogedcams.main()
+        post.assert_not_called()
+        sock.assert_not_called()
+        assert json.loads(capsys.readouterr().out)[1] == {'label': 'MTGOX', 'count': 1, 'received': '0.00000000',
+                                                           'sent': '-25.50000000', 'net': '-25.50000000'}
+
+
+@pytest.mark.unit
+class TestKSDS:
+    """Test the emulated KSDS and the emulate subcommand"""
+
+    def deck(self, transactions=30):
+        rows = [(1, 0, 'Available', 100), (2, 0, 'Pending', 0), (9999999999, '0', 'Control Record', 0)]
+        rows += [(1600000000 + n, 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', 'Kraken', 1) for n in range(transactions)]
+        return dogedcams.format_records(rows).decode().split('\n')
+
+    def test_browse(self):
+        """Test STARTBR, READNEXT, READPREV and RESETBR follow CICS"""
+        vsam = dogedcams.KSDS(self.deck(3))
+        vsam.startbr('1600000000')
+        assert vsam.readnext()[:10] == '1600000000'
+        assert vsam.readnext()[:10] == '1600000001'
+        # Changing direction returns the same record again
+        assert vsam.readprev()[:10] == '1600000001'
+        assert vsam.readprev()[:10] == '1600000000'
+        assert vsam.readprev()[:10] == '0000000002'
+        vsam.resetbr('1600000002')
+        assert vsam.readprev()[:10] == '1600000002'
+        vsam.resetbr('9999999999')
+        assert vsam.readnext()[:10] == '9999999999'
+        with pytest.raises(dogedcams.CICSCondition) as condition:
+            vsam.readnext()
+        assert condition.value.condition == 'ENDFILE'
+        vsam.endbr()
+        vsam.startbr('1500000000')
+        with pytest.raises(dogedcams.CICSCondition) as condition:
+            vsam.readprev()
+        assert condition.value.condition == 'NOTFND'
+        vsam.endbr()
+        with pytest.raises(dogedcams.CICSCondition):
+            vsam.read('1600000099')
+        assert vsam.read('0000000001')[:10] == '0000000001'
+
+    def test_ci_and_ca_accounting(self):
+        """Test a browse counts CI and control area crossings and buffer misses"""
+        # 2 records per CI, 2 CIs per control area
+        vsam = dogedcams.KSDS(self.deck(9), ci_size=176, cis_per_ca=2, buffers=1)
+        assert vsam.describe() == '12 records, 2 per CI, 6 CIs in 3 control areas, 2 index levels'
+        vsam.startbr('0000000001')
+        # Root and sequence set, then the first data CI
+        assert vsam.reset() == {'requests': 1, 'index_io': 2, 'data_io': 1, 'ci_moves': 0, 'ca_moves': 0, 'compares': 5}
+        for _ in range(6):
+            vsam.readnext()
+        stats = vsam.reset()
+        assert (stats['ci_moves'], stats['ca_moves'], stats['data_io']) == (2, 1, 2)
+        # Back in to the CI that was dropped from the only buffer
+        for _ in range(3):
+            vsam.readprev()
+        assert vsam.reset()['data_io'] == 1
+        vsam.endbr()
+        # Free space spreads the same records over more CIs
+        assert dogedcams.KSDS(self.deck(9), ci_size=176, cis_per_ca=2, ci_free=50).data_cis == 12
+
+    def test_back_it_up(self):
+        """Test the old PF7 (BACK-IT-UP 15 TIMES) lands on the same page as the page directory"""
+        deck = self.deck(30)
+        vsam = dogedcams.KSDS(deck)
+        directory = dogedcams.KSDS(dogedcams.generate_page_directory(deck))
+        transactions = [card[:10] for card in sorted(deck) if not dogedcams.reserved_key(card[:10])]
+        page2 = dogedcams.dogetran_browse(vsam, dogedcams.dogetran_browse(vsam, '0000000002'))
+        page3 = dogedcams.dogetran_browse(vsam, page2)
+        assert page2 == transactions[13]
+        assert dogedcams.dogetran_browse(vsam, page3, back=True) == page2
+        assert vsam.reset()['requests'] == 3 * 10 + 25
+        assert dogedcams.dogetran_page(vsam, directory, 3) == 5
+        assert vsam.stats['requests'] + directory.stats['requests'] == 10
+        assert directory.read('0000000003')[11:21] == transactions[14]
+
+    def test_emulate_subcommand(self, capsys):
+        """Test the subcommand compares layouts without calling the wallet or the mainframe"""
+        with patch.object(sys, 'argv', ['dogedcams.py', 'emulate', '--fake', '200', '--baseline', '--output', 'json']), \
+             patch('dogedcams.requests.post') as post, patch('dogedcams.socket.socket') as sock:
+            dogedcams.main()
+        post.assert_not_called()
+        sock.assert_not_called()
+        rows = json.loads(capsys.readouterr().out)
+        screens = {(row['layout'], row['program'], row['screen']): row for row in rows}
+        assert screens[('summary+pages', 'DOGEMAIN', 'dashboard')]['requests'] == 3
+        assert screens[('browse', 'DOGEMAIN', 'dashboard')]['requests'] == 8
+        assert screens[('summary+pages', 'DOGETRAN', 'PF7 page 1')]['requests'] == 10
+        assert screens[('browse', 'DOGETRAN', 'PF7 page 1')]['requests'] == 25
+        assert screens[('browse', 'DOGEDEET', 'PF8')]['requests'] == 3
+        assert screens[('browse', 'total', '')]['requests'] == sum(row['requests'] for row in rows if row['layout'] == 'browse' and row['program'] != 'total')
+
+
+@pytest.mark.unit
+class TestDogeSync:
+    """Test the embeddable DogeSync steps"""
+
+    def replies(self, balance):
+        return [Mock(json=lambda: {'result': balance, 'error': None}), Mock(json=lambda: {'result': 0.0, 'error': None}),
+                Mock(json=lambda: {'result': [{'timereceived': 1600000000, 'address': 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu',
+                                               'amount': 1.0, 'label': 'Test'}], 'error': None})]
+
+    def test_sync_only_submits_changes(self, tmp_path):
+        """Test sync() submits new records once and keeps them in the state folder"""
+        doge = dogedcams.DogeSync(rpcuser='u', rpcpass='p', state_folder=str(tmp_path))
+        with patch('dogedcams.requests.post', side_effect=self.replies(10.0) + self.replies(10.0) + self.replies(11.0)), \
+             patch('dogedcams.send_jcl') as send:
+            assert doge.sync() is True
+            assert doge.sync() is False
+            # A restarted service picks up what was submitted
+            assert dogedcams.DogeSync(state_folder=str(tmp_path)).last_records() == doge.last_records()
+            assert doge.sync() is True
+        assert send.call_count == 2
+        assert 'DEFINE CLUSTER' in send.call_args[1]['jcl']
+
+    def test_errors_are_raised_not_exits(self):
+        """Test RPC, reader, printer and deck errors are DogeErrors"""
+        import requests
+        doge = dogedcams.DogeSync(rpcuser='u', rpcpass='p')
+        with patch('dogedcams.requests.post', side_effect=requests.exceptions.ConnectionError('refused')):
+            with pytest.raises(dogedcams.RPCError):
+                doge.fetch()
+        with patch('dogedcams.requests.post', return_value=Mock(json=lambda: {'result': None, 'error': {'code': -28, 'message': 'Rescanning...'}})):
+            with pytest.raises(dogedcams.RPCError, match='Rescanning'):
+                doge.fetch()
+        with patch('dogedcams.send_jcl', side_effect=ConnectionRefusedError('down')):
+            with pytest.raises(dogedcams.ReaderError):
+                doge.submit('//JCL', ['x'])
+        assert doge.last_records() is None
+        with patch('dogedcams.get_commands', side_effect=ConnectionRefusedError('down')):
+            with pytest.raises(dogedcams.PrinterError):
+                doge.drain_sends()
+        with pytest.raises(dogedcams.RecordError) as bad:
+            doge.render(['short card'])
+        assert bad.value.problems
+
+    def test_drain_sends_keeps_track_of_failed_sends(self):
+        """Test a failed send reports what was and wasn't sent"""
+        doge = dogedcams.DogeSync(rpcuser='u', rpcpass='p')
+        commands = [{'address': 'A', 'amount': '1,000.5'}, {'address': '', 'amount': '1'},
+                    {'address': 'B', 'amount': '2'}, {'address': 'C', 'amount': '3'}]
+        with patch('dogedcams.get_commands', return_value=commands), \
+             patch('dogedcams.send_doge', side_effect=['tx1', dogedcams.RPCError('down')]) as send:
+            with pytest.raises(dogedcams.RPCError) as failed:
+                doge.drain_sends()
+        assert send.call_args_list[0][1]['amount'] == '1000.50000000'
+        assert failed.value.sends == [{'address': 'A', 'amount': '1000.50000000', 'txid': 'tx1'}]
+        assert [line['address'] for line in failed.value.pending] == ['B', 'C']
+
+    def test_shared_between_threads(self):
+        """Test only one job reaches the reader at a time"""
+        import concurrent.futures
+        doge = dogedcams.DogeSync()
+        active = []
+        overlap = []
+
+        def send_jcl(**kwargs):
+            active.append(1)
+            overlap.append(len(active))
+            time.sleep(0.01)
+            active.pop()
+
+        with patch('dogedcams.send_jcl', side_effect=send_jcl):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+                list(pool.map(lambda i: doge.submit('//JCL', [str(i)]), range(8)))
+        assert max(overlap) == 1
+        assert len(doge.last_records()) == 1
+
+    def test_own_logger_and_traffic(self, tmp_path):
+        """Test a DogeSync uses its logger and traffic, not the command line's"""
+        import logging
+        import subprocess
+        handlers = subprocess.run([sys.executable, '-c', 'import dogedcams; print([type(h).__name__ for h in dogedcams.logger.handlers])'],
+                                  cwd=os.path.dirname(dogedcams.__file__), capture_output=True, text=True, check=True).stdout
+        assert handlers.strip() == "['NullHandler']"
+
+        # Nothing is shared between instances through the module
+        assert not hasattr(dogedcams, 'traffic') and not hasattr(dogedcams, 'debug_sample')
+
+        log = logging.getLogger('test.dogesync')
+        filename = str(tmp_path / 'doge.capture')
+        doge = dogedcams.DogeSync(rpcuser='u', rpcpass='p', logger=log, traffic=dogedcams.Capture(filename), debug_sample=2)
+        sock = Mock()
+        sock.recv.side_effect = [b"DOGEVSAM99 DOGE.VSAM.0000ABCD\n", BlockingIOError()] + [BlockingIOError()] * 1000
+        with patch.object(log, 'isEnabledFor', return_value=True), \
+             patch.object(log, 'debug') as debug, \
+             patch.object(dogedcams.logger, 'debug') as module_debug, \
+             patch('dogedcams.requests.post', side_effect=self.replies(10.0)), \
+             patch('dogedcams.socket.socket', return_value=sock):
+            doge.fetch()
+            doge.submit('//JCL', ['x'])
+            assert doge.drain_sends(timeout=0.05) == []
+        doge.traffic.close()
+        assert debug.called and not module_debug.called
+        assert any(call[0][0].startswith('Adding the following record: %s') for call in debug.call_args_list)
+        assert any(call[0][0] == 'Found finished VSAM job: %s' for call in debug.call_args_list)
+        assert sock.sendall.call_args[0][0] == b'//JCL'
+
+        replay = dogedcams.Replay(filename, speed=0)
+        doge = dogedcams.DogeSync(rpcuser='u', rpcpass='p', traffic=replay)
+        with patch('dogedcams.requests.post', side_effect=AssertionError('network used')):
+            assert doge.fetch()[0].startswith('0000000001')
+        # A bad sample size is an error, not someone else's setting
+        with pytest.raises(ValueError):
+            dogedcams.DogeSync(rpcuser='u', rpcpass='p', traffic=replay, debug_sample=0).fetch()
+
+
+@pytest.mark.unit
+class TestRPCPolicy:
+    """Test wallet call deadlines, retries and hedging"""
+
+    server = ('http://u:p@localhost:22555', 'http://u:*@localhost:22555')
+
+    def ok(self, result):
+        return Mock(json=lambda: {'result': result, 'error': None})
+
+    def test_reads_are_retried_within_budget(self):
+        """Test timed out reads are retried after a jittered back off until the budget runs out"""
+        import requests
+        sleep = Mock()
+        policy = dogedcams.RPCPolicy(retries=2, retry_budget=3, backoff=0.5, sleep=sleep)
+        warming = Mock(json=lambda: {'result': None, 'error': {'code': -28, 'message': 'Rescanning...'}})
+        with patch('dogedcams.requests.post', side_effect=[requests.exceptions.ReadTimeout(), warming, self.ok(5.0)]) as post:
+            assert dogedcams.rpc_call(self.server, 'getbalance', policy=policy) == 5.0
+        assert post.call_count == 3
+        assert sleep.call_args_list[0][0][0] <= 0.5 and sleep.call_args_list[1][0][0] <= 1.0
+        # One retry left in the budget
+        with patch('dogedcams.requests.post', side_effect=requests.exceptions.ConnectionError('refused')) as post:
+            with pytest.raises(dogedcams.RPCError, match='Could not connect'):
+                dogedcams.rpc_call(self.server, 'listtransactions', policy=policy)
+        assert post.call_count == 2
+        assert policy.retried == 3
+
+    def test_sends_are_never_retried(self):
+        """Test a send that timed out isn't sent again"""
+        import requests
+        with patch('dogedcams.requests.post', side_effect=requests.exceptions.ReadTimeout()) as post:
+            with pytest.raises(dogedcams.RPCError, match='may have gone through'):
+                dogedcams.send_doge('nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', '1.00000000', rpcUser='u', rpcPass='p', timeout=3)
+        assert post.call_count == 1
+        assert post.call_args[1]['timeout'] == 3
+
+    def test_run_deadline(self):
+        """Test calls get what's left of the run deadline and none start after it"""
+        now = [100.0]
+        policy = dogedcams.RPCPolicy(call_timeout=10, run_deadline=15, clock=lambda: now[0], sleep=Mock())
+        assert policy.timeout('getbalance') == 10
+        now[0] = 110.0
+        assert policy.timeout('getbalance') == 5
+        now[0] = 114.5
+        # A 1s back off would end past the deadline so there's no retry
+        with patch('dogedcams.random.uniform', return_value=1.0):
+            assert policy.retry(0) is None
+        now[0] = 115.0
+        with patch('dogedcams.requests.post') as post:
+            with pytest.raises(dogedcams.RPCTimeout):
+                dogedcams.rpc_call(self.server, 'listtransactions', policy=policy)
+        post.assert_not_called()
+
+    def test_hedged_read(self):
+        """Test a slow read is raced against a second request"""
+        calls = []
+
+        def post(url, headers, data, timeout):
+            calls.append(time.time())
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return self.ok('slow')
+            return self.ok('fast')
+
+        policy = dogedcams.RPCPolicy(hedge_after=0.05)
+        begin = time.time()
+        with patch('dogedcams.requests.post', side_effect=post):
+            assert dogedcams.rpc_call(self.server, 'getbalance', policy=policy) == 'fast'
+        assert time.time() - begin < 0.4
+        assert len(calls) == 2
+
+
 @pytest.mark.unit
 class TestSendJCL:
     """Test the send_jcl function"""
@@ -225,6 +1517,121 @@ class TestSendJCL:
         mock_sock_instance.connect.assert_called_once()
 
 
+@pytest.mark.unit
+class TestSendJCLAll:
+    """Test submitting one JCL job to multiple readers"""
+
+    def test_parse_reader_targets(self):
+        """Test host[:port] parsing with default port"""
+        targets = dogedcams.parse_reader_targets(['primary:3505,standby', 'test:4505'], default_port=3505)
+        assert targets == [('primary', 3505), ('standby', 3505), ('test', 4505)]
+
+    @patch('socket.socket')
+    def test_send_jcl_all_success(self, mock_socket):
+        """Test every reader gets the same encoded buffer"""
+        mock_sock_instance = Mock()
+        mock_socket.return_value = mock_sock_instance
+
+        results = dogedcams.send_jcl_all([('a', 3505), ('b', 3505)], jcl="//TEST JOB")
+
+        assert results['a:3505']['status'] == 'sent'
+        assert results['b:3505']['status'] == 'sent'
+        assert mock_sock_instance.sendall.call_count == 2
+        for call in mock_sock_instance.sendall.call_args_list:
+            assert call[0][0] == b"//TEST JOB"
+
+    @patch('dogedcams.time.sleep')
+    @patch('dogedcams.send_jcl')
+    def test_send_jcl_all_retry_and_fail(self, mock_send_jcl, mock_sleep):
+        """Test a failing reader is retried and reported without affecting others"""
+        def fake_send(hostname, port, jcl, timeout, **kwargs):
+            if hostname == 'down':
+                raise ConnectionRefusedError('refused')
+        mock_send_jcl.side_effect = fake_send
+
+        results = dogedcams.send_jcl_all([('up', 3505), ('down', 3505)], jcl="//TEST JOB", retries=2)
+
+        assert results['up:3505']['status'] == 'sent'
+        assert results['up:3505']['attempts'] == 1
+        assert results['down:3505']['status'] == 'failed'
+        assert results['down:3505']['attempts'] == 3
+        assert 'refused' in results['down:3505']['error']
+
+
+@pytest.mark.unit
+class TestSubmissionQueue:
+    """Test the coalescing VSAM job queue"""
+
+    def test_coalesces_while_job_in_flight(self, tmp_path):
+        """Test only the latest snapshot is sent once the previous job finishes"""
+        submitted = []
+        state = str(tmp_path / 'queue.json')
+        queue = dogedcams.SubmissionQueue(lambda jcl: submitted.append(jcl) or True, state_file=state)
+
+        assert queue.offer('//JOB1') is True
+        assert queue.offer('//JOB2') is False
+        assert queue.offer('//JOB3') is False
+        assert len(submitted) == 1
+        assert 'DOGEVSAM99 {}'.format(queue.inflight['token']) in submitted[0]
+
+        # A new run picks up the held job from the state file
+        queue = dogedcams.SubmissionQueue(lambda jcl: submitted.append(jcl) or True, state_file=state)
+        assert queue.pending == '//JOB3'
+        queue.job_finished(queue.inflight['token'])
+        assert queue.pump() is True
+        assert len(submitted) == 2
+        assert submitted[1].startswith('//JOB3')
+
+    def test_stale_job_does_not_block(self, tmp_path):
+        """Test a job that never reports back stops holding the queue"""
+        submitted = []
+        queue = dogedcams.SubmissionQueue(lambda jcl: submitted.append(jcl) or True, state_file=str(tmp_path / 'q'), stale_after=60)
+        queue.offer('//JOB1')
+        queue.inflight['submitted'] -= 120
+        assert queue.offer('//JOB2') is True
+
+    def test_released_job_is_recorded(self, tmp_path):
+        """Test a held job released by a printer only pass isn't sent again by the next wallet pass"""
+        first = dogedcams.generate_fake_records(number_of_records=10)
+        second = dogedcams.generate_fake_records(number_of_records=12)
+        markers = []
+
+        def get_commands(done_jobs=None, **kwargs):
+            done_jobs.extend(markers)
+            return []
+
+        argv = ['dogedcams.py', '--rpcuser', 'u', '--rpcpass', 'p', '--coalesce']
+        with patch.object(dogedcams, 'running_folder', str(tmp_path)), \
+             patch('dogedcams.get_commands', side_effect=get_commands), \
+             patch('dogedcams.send_jcl') as submit, \
+             patch('dogedcams.run', wraps=dogedcams.run) as run, \
+             patch.object(sys, 'argv', argv):
+            with patch('dogedcams.get_records', return_value=first):
+                dogedcams.main()
+            with patch('dogedcams.get_records', return_value=second):
+                dogedcams.main()
+                assert submit.call_count == 1
+                markers.append(dogedcams.SubmissionQueue(None, state_file=str(tmp_path / dogedcams.queue_file)).inflight['token'])
+                dogedcams.run(run.call_args[0][0], wallet=False)
+                assert submit.call_count == 2
+                assert (tmp_path / dogedcams.tmp_file).read_text() == '\n'.join(second)
+                markers[:] = []
+                dogedcams.main()
+        assert submit.call_count == 2
+
+    @patch('socket.socket')
+    def test_get_commands_done_markers(self, mock_socket):
+        """Test completion markers are collected from the printer"""
+        mock_sock_instance = Mock()
+        mock_socket.return_value = mock_sock_instance
+        mock_sock_instance.recv.side_effect = [b"JES2 STUFF\nDOGEVSAM99 0A1B2C3D\n", b'']
+
+        done_jobs = []
+        with patch('time.time', side_effect=[0, 0.1, 0.2, 5.0, 10.0, 20.0]):
+            dogedcams.get_commands(timeout=2, done_jobs=done_jobs)
+        assert done_jobs == ['0A1B2C3D']
+
+
 @pytest.mark.unit
 class TestGetCommands:
     """Test the get_commands function"""
@@ -252,6 +1659,35 @@ class TestGetCommands:
             assert 'amount' in commands[0]
 
 
+@pytest.mark.unit
+class TestPrinterParser:
+    """Test the incremental printer stream parser"""
+
+    def test_record_split_across_chunks(self):
+        """Test a DOGECICS99 line split over two recv calls is not lost"""
+        parser = dogedcams.PrinterParser()
+        assert list(parser.feed(b"JOB LOG\r\nDOGECICS99 nYLEKeZtqNSCA")) == []
+        commands = list(parser.feed(b"hMNKTFpFgZcnvf1DbFiSu     1,100.50000000\r\n"))
+        assert commands == [{'address': 'nYLEKeZtqNSCAhMNKTFpFgZcnvf1DbFiSu', 'amount': '1,100.50000000'}]
+
+    def test_multiple_records_and_form_feeds(self):
+        """Test one chunk with several records, carriage control and form feeds"""
+        parser = dogedcams.PrinterParser()
+        data = (b"\fDOGECICS99 addr1 1.00000000\r\n"
+                b"1DOGECICS99 addr2             22.50000000\n"
+                b"DOGEVSAM99 0A1B2C3D\f"
+                b"DOGECICS99 garbage\n"
+                b"DOGECICS99 addr3 3.00000000")
+        commands = list(parser.feed(data)) + list(parser.close())
+        assert commands == [
+            {'address': 'addr1', 'amount': '1.00000000'},
+            {'address': 'addr2', 'amount': '22.50000000'},
+            {'done': '0A1B2C3D'},
+            {'address': False, 'amount': False},
+            {'address': 'addr3', 'amount': '3.00000000'},
+        ]
+
+
 @pytest.mark.unit
 class TestSendDoge:
     """Test the send_doge function"""
@@ -275,3 +1711,85 @@ class TestSendDoge:
         
         # Verify the post was called
         mock_post.assert_called_once()
+
+
+@pytest.mark.unit
+class TestLatencyTracer:
+    """Test transaction latency tracing"""
+
+    def test_transaction_trace(self, tmp_path):
+        """Test a transaction is traced from first seen to VSAM confirmation"""
+        log = tmp_path / 'doge.trace'
+        state = str(tmp_path / 'doge.trace.state')
+        old = ['0000000001 x', '1600000000 old', '9999999999 x']
+
+        tracer = dogedcams.LatencyTracer(trace_log=str(log), state_file=state)
+        assert tracer.observe(old) == []  # first run is the baseline
+        tracer.close()
+
+        tracer = dogedcams.LatencyTracer(trace_log=str(log), state_file=state, slo=5)
+        ids = tracer.observe(old + ['1600000100 new'], now=100)
+        assert len(ids) == 1
+        tracer.stage('rendered', now=101)
+        tracer.stage('submitted', now=102, token='ABCD1234')
+        tracer.close()
+
+        tracer = dogedcams.LatencyTracer(trace_log=str(log), state_file=state, slo=5)
+        tracer.confirmed('ABCD1234', now=110)
+        summary = tracer.close()
+
+        entries = [json.loads(line) for line in log.read_text().splitlines()]
+        trace = [e for e in entries if e['type'] == 'recv'][0]
+        assert trace['id'] == ids[0]
+        assert trace['latency'] == {'seen_to_rendered': 1, 'rendered_to_submitted': 1,
+                                    'submitted_to_visible': 8, 'total': 10}
+        assert summary['slo_breaches'] == 1
+        assert summary['histograms']['recv.total']['buckets']['10'] == 1
+        assert summary['open'] == 0
+
+    def test_unconfirmed_traces_time_out(self, tmp_path):
+        """Test traces that never confirm are logged as timed out and old keys are forgotten"""
+        log = tmp_path / 'doge.trace'
+        state = str(tmp_path / 'doge.trace.state')
+        tracer = dogedcams.LatencyTracer(trace_log=str(log), state_file=state, timeout=60)
+        tracer.observe(['1600000000 old'], now=1000)
+        tracer.close()
+
+        tracer = dogedcams.LatencyTracer(trace_log=str(log), state_file=state, slo=5, timeout=60)
+        lost = tracer.observe(['1600000100 lost'], now=1010)
+        tracer.stage('submitted', now=1011, token='ABCD1234')
+        kept = tracer.observe(['1600000100 lost', '1600000200 kept'], now=1069)
+        assert set(tracer.open) == set(lost + kept)
+        tracer.observe(['1600000200 kept'], now=1080)
+        assert list(tracer.open) == kept
+        assert set(tracer.known) == {'1600000100', '1600000200'}
+        tracer.observe(['1600000200 kept'], now=1200)
+        assert tracer.open == {}
+        assert list(tracer.known) == ['1600000200']
+        summary = tracer.close()
+
+        entries = [json.loads(line) for line in log.read_text().splitlines()]
+        timed_out = [e for e in entries if e['type'] == 'recv' and e.get('timed_out')]
+        assert [e['id'] for e in timed_out] == lost + kept
+        assert timed_out[0]['latency'] == {'seen_to_submitted': 1, 'total': 70}
+        assert summary['timed_out'] == 2
+        assert summary['slo_breaches'] == 0
+        assert summary['histograms'] == {}
+        assert json.loads(open(state).read())['known'] == {'1600000200': 1200}
+
+    def test_open_traces_are_capped(self, tmp_path):
+        """Test the oldest open traces time out when there are too many"""
+        tracer = dogedcams.LatencyTracer(trace_log=str(tmp_path / 't'), state_file=str(tmp_path / 's'))
+        tracer.observe([], now=1000)
+        tracer.MAX_OPEN = 3
+        first = tracer.observe(['16000000{:02d} x'.format(n) for n in range(2)], now=1001)
+        rest = tracer.observe(['16000000{:02d} x'.format(n) for n in range(5)], now=1002)
+        assert sorted(tracer.open) == sorted(rest)
+        assert tracer.close()['timed_out'] == len(first)
+
+    def test_send_trace(self, tmp_path):
+        """Test sends are traced from printer drain to wallet reply"""
+        tracer = dogedcams.LatencyTracer(trace_log=str(tmp_path / 't'), state_file=str(tmp_path / 's'))
+        tracer.send('addr', '1.00000000', printed=10, replied=10.5, txid='txid')
+        summary = tracer.close()
+        assert summary['histograms']['send.total']['max'] == 0.5